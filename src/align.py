@@ -0,0 +1,264 @@
+import numpy as np
+
+from bar_dates import barsize_to_seconds
+
+"""
+This module will handle the as-of alignment of indicators computed on
+several timeframes to the bars of a base timeframe (i.e the 1 hour adx and
+the 4 hours macd known at every 1 min bar), in one feature matrix.
+
+A bar is stamped with the start of its period but its indicator values are
+only known at its close : the close of a bar is the start of the next one,
+or start + barsize if there's a gap (weekends) before it. A base bar gets
+the values of the last bar of every timeframe closed at its own close, so
+there is no lookahead. The rows of the base bars are found at once with
+np.searchsorted.
+
+FeatureMatrix keeps the matrix of a symbol up to date in live mode : only
+the rows of the new base bars, and of the last one, are computed again.
+"""
+
+
+class FeatureMatrix:
+    """
+    The features of a symbol aligned on the bars of a base barsize, taken
+    from the market data and the indicator cache of an IBApi object.
+
+    ...
+
+    Attributes
+    ----------
+    symbol : str
+    base_barsize : str
+        The barsize of the rows (i.e "1 min").
+    specs : list of tuple
+        (barsize, indicator name, *params) of every feature, i.e
+        ("1 hour", "adx", 14). All the output columns of the indicator are
+        features (see columns).
+    columns : list of str
+        The names of the columns of the matrix, i.e "1 hour adx(14) 1".
+
+    Methods (external)
+    -------
+    update
+    """
+
+    def __init__(self, ib, symbol, base_barsize, specs):
+        self.ib = ib
+        self.symbol = symbol
+        self.base_barsize = base_barsize
+        self.specs = [tuple(spec) for spec in specs]
+        self.columns = []
+        self._matrix = None
+        self._size = 0
+        self._versions = None
+
+    # external use
+    def update(self):
+        """
+        aligns the features of the base bars added or revised since the
+        last update, all of them when older bars changed.
+
+        Returns:
+            np.ndarray: read-only array of shape (nb of base bars, nb of
+            features), NaN where a feature isn't known yet.
+        """
+        market = self.ib.market
+        base = market.get(self.symbol, self.base_barsize)
+        if base == None:
+            return np.empty((0, len(self.columns)), dtype=np.float64)
+        features = []
+        versions = [base.version]
+        for barsize, name, *params in self.specs:
+            series = market.get(self.symbol, barsize)
+            versions.append(None if series == None else series.version)
+            features.append((barsize, self.ib.indicators.get(
+                self.symbol, barsize, name, *params)))
+
+        start = 0
+        if versions == self._versions and self._size <= base.size:
+            start = max(self._size - 1, 0)
+        bars = base.view()
+        rows = align(bars[start:, 0], self.base_barsize, features,
+                     next_start=bars[start + 1:, 0])
+        if start == 0:
+            self.columns = get_columns(self.specs, features)
+        self._store(start, rows, base.size)
+        self._versions = versions
+        values = self._matrix[:self._size]
+        values.flags.writeable = False
+        return values
+
+    # internal use
+    def _store(self, start, rows, size):
+        if not isinstance(self._matrix, np.ndarray) or \
+                self._matrix.shape[0] < size or \
+                self._matrix.shape[1] != rows.shape[1]:
+            matrix = np.empty((max(size * 5 // 4, 16), rows.shape[1]),
+                              dtype=np.float64)
+            if isinstance(self._matrix, np.ndarray) and start:
+                matrix[:start] = self._matrix[:start]
+            self._matrix = matrix
+        self._matrix[start:size] = rows
+        self._size = size
+
+
+# external use :
+def align(timestamps, barsize, features, next_start=None):
+    """
+    builds the feature matrix of base bars.
+
+    Args:
+        timestamps (np.ndarray): the timestamps of the base bars.
+        barsize (str): the barsize of the base bars (i.e "1 min").
+        features (list of tuple): (barsize, indicator output) of every
+        feature. The first column of an output is the timestamps of its
+        bars, the others are features.
+        next_start (np.ndarray, optional): the timestamps of the base bars
+        after the first one, when timestamps is the end of a longer
+        series (see FeatureMatrix). Defaults to None which means
+        timestamps[1:].
+
+    Returns:
+        np.ndarray: array of shape (nb of base bars, nb of features), the
+        values of the last bar of every feature closed at the close of the
+        base bar, NaN before the first one.
+    """
+    if not isinstance(next_start, np.ndarray):
+        next_start = timestamps[1:]
+    close_times = get_close_times(timestamps, barsize, next_start)
+    nb_of_columns = sum(values.shape[1] - 1 for _, values in features)
+    out = np.empty((timestamps.shape[0], nb_of_columns), dtype=np.float64)
+    column = 0
+    for feature_barsize, values in features:
+        width = values.shape[1] - 1
+        indexes = asof_indexes(close_times, values[:, 0], feature_barsize)
+        known = indexes >= 0
+        out[:, column:column + width] = np.nan
+        out[known, column:column + width] = values[indexes[known], 1:]
+        column += width
+    return out
+
+
+def asof_indexes(times, timestamps, barsize):
+    """
+    returns the index of the last bar closed at each time (-1 if there is
+    none).
+
+    Args:
+        times (np.ndarray): sorted times.
+        timestamps (np.ndarray): the timestamps (starts) of the bars.
+        barsize (str): the barsize of the bars.
+    """
+    if times.shape[0] == 0:
+        return np.empty(0, dtype=np.intp)
+    # a bar closes after its start and before the next one : only the last
+    # 2 bars started before times[0] can be the answer among the older bars,
+    # the others are skipped (a few new base bars in live mode)
+    first = max(int(np.searchsorted(timestamps, times[0])) - 2, 0)
+    close_times = get_close_times(timestamps[first:], barsize,
+                                  timestamps[first + 1:])
+    indexes = np.searchsorted(close_times, times, side="right") - 1
+    return np.where(indexes >= 0, indexes + first, -1)
+
+
+def get_close_times(timestamps, barsize, next_start):
+    """
+    returns the close of every bar : the start of the next bar, or start +
+    barsize if it's earlier (a gap or the last bar).
+    """
+    close_times = timestamps + barsize_to_seconds(barsize)
+    nb_of_next = min(next_start.shape[0], close_times.shape[0])
+    np.minimum(close_times[:nb_of_next], next_start[:nb_of_next],
+               out=close_times[:nb_of_next])
+    return close_times
+
+
+def get_columns(specs, features):
+    columns = []
+    for (barsize, name, *params), (_, values) in zip(specs, features):
+        label = f"{barsize} {name}({', '.join(str(p) for p in params)})"
+        columns += [f"{label} {i}" for i in range(1, values.shape[1])]
+    return columns
+
+
+# program :
+if __name__ == "__main__":
+    import time
+
+    import indicators
+    from bar_store import BarStore
+    from indicator_cache import IndicatorCache
+    from resample import resample
+
+    class FakeIB:
+        def __init__(self):
+            self.market = BarStore()
+            self.indicators = IndicatorCache(self.market)
+
+    # a year of 1 min bars without the weekends
+    rng = np.random.default_rng(0)
+    timestamps = 1.6e9 + 60 * np.arange(365 * 1440, dtype=np.float64)
+    timestamps = timestamps[(timestamps // 86400 + 4) % 7 < 5]
+    close = 1.2 + np.cumsum(rng.normal(0, 1e-4, timestamps.shape[0]))
+    open_ = np.concatenate(([close[0]], close[:-1]))
+    bars = np.column_stack((timestamps, open_,
+                            np.maximum(open_, close) + 5e-5,
+                            np.minimum(open_, close) - 5e-5, close))
+    hours, four_hours = resample(bars, "1 hour"), resample(bars, "4 hours")
+    specs = [("1 hour", "adx", 14), ("4 hours", "macd", 12, 26, 9),
+             ("1 min", "rsi", 14)]
+    features = [("1 hour", indicators.adx(hours, 14)),
+                ("4 hours", indicators.macd(four_hours, 12, 26, 9)),
+                ("1 min", indicators.rsi(bars, 14))]
+
+    start = time.perf_counter()
+    matrix = align(bars[:, 0], "1 min", features)
+    elapsed = time.perf_counter() - start
+    print(f"{matrix.shape} feature matrix of {bars.shape[0]} bars in "
+          f"{elapsed * 1000:.1f} ms")
+
+    # checked against a loop, over a fixed sorted sample of the bars : the
+    # loop walks every feature once, its last closed bar only moves forward
+    sample = np.sort(rng.choice(bars.shape[0], 2000, replace=False))
+    expected = np.empty((sample.shape[0], matrix.shape[1]))
+    column = 0
+    for barsize, values in features:
+        seconds = barsize_to_seconds(barsize)
+        width = values.shape[1] - 1
+        j = -1
+        for row, i in enumerate(sample):
+            close_time = bars[i, 0] + 60
+            if i + 1 < bars.shape[0]:
+                close_time = min(close_time, bars[i + 1, 0])
+            while j + 1 < values.shape[0]:
+                bar_close = values[j + 1, 0] + seconds
+                if j + 2 < values.shape[0]:
+                    bar_close = min(bar_close, values[j + 2, 0])
+                if bar_close > close_time:
+                    break
+                j += 1
+            expected[row, column:column + width] = np.nan if j < 0 \
+                else values[j, 1:]
+        column += width
+    same = np.allclose(matrix[sample], expected, equal_nan=True)
+    assert same
+    print("same as a loop :", same)
+
+    # live : the 1 min bars arrive one by one, derived to 1 hour and 4 hours
+    ib = FakeIB()
+    ib.market.reset("EUR/USD", "1 min").extend(bars[:-2000])
+    ib.market.derive("EUR/USD", "1 hour", "1 min")
+    ib.market.derive("EUR/USD", "4 hours", "1 min")
+    live = FeatureMatrix(ib, "EUR/USD", "1 min", specs)
+    live.update()
+    start = time.perf_counter()
+    for bar in bars[-2000:]:
+        ib.market.get("EUR/USD", "1 min").upsert(*bar)
+        values = live.update()
+    elapsed = time.perf_counter() - start
+    same = np.allclose(values, matrix, equal_nan=True)
+    assert same
+    print(f"live update : {elapsed / 2000 * 1e6:.0f} us per bar, same as "
+          f"batch : {same}")
+    print(live.columns)
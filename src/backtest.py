@@ -0,0 +1,290 @@
+import numpy as np
+
+import indicators
+
+"""
+This module will handle the backtesting of strategies on market data. The
+whole backtest is computed with numpy array operations, without a loop over
+the bars.
+
+A strategy is a function taking market data (format of market_data.get_data)
+and returning the target position for every bar (1 long, -1 short, 0 flat,
+np.nan to keep the previous position). The target of a bar is decided on its
+close and filled on the open of the next bar.
+"""
+
+# variables :
+seconds_per_year = 365 * 86400
+
+
+class BacktestResults:
+    """
+    The results of a backtest (see run), ready for plot.plot_strategy_results.
+
+    ...
+
+    Attributes
+    ----------
+    data : np.ndarray
+        The market data the strategy was run on.
+    positions : np.ndarray
+        The position held at the close of every bar (in units).
+    pnl : np.ndarray
+        The profit of every bar, commissions included.
+    equity : np.ndarray
+        The value of the account at the close of every bar.
+    drawdown : np.ndarray
+        The distance between the equity and its highest value so far
+        (negative or 0).
+    fills : dict of np.ndarray
+        "index" (bar of the fill), "price" and "quantity" (signed) of every
+        order filled.
+    trades : dict of np.ndarray
+        "entry_index", "exit_index", "entry_price", "exit_price",
+        "position" (signed), "pnl" and "closed" (False for the trade still
+        open at the end, valued at the last close) of every trade.
+    stats : dict
+        Summary of the backtest (see get_stats).
+
+    Methods (external)
+    -------
+    summary
+    """
+
+    def __init__(self, data, positions, pnl, equity, drawdown, fills, trades,
+                 stats):
+        self.data = data
+        self.positions = positions
+        self.pnl = pnl
+        self.equity = equity
+        self.drawdown = drawdown
+        self.fills = fills
+        self.trades = trades
+        self.stats = stats
+
+    def __repr__(self):
+        return f"BacktestResults({len(self.data)} bars, " + \
+            f"{self.stats['nb_of_trades']} trades, " + \
+            f"pnl {self.stats['total_pnl']:.2f})"
+
+    @property
+    def timestamps(self):
+        return self.data[:, 0]
+
+    def summary(self):
+        """returns the stats as printable lines."""
+        return "\n".join(f"{key} : {value:.4g}" if isinstance(value, float)
+                         else f"{key} : {value}"
+                         for key, value in self.stats.items())
+
+
+# external use :
+def run(data, signals, size=1, commission=0.0, slippage=0.0,
+        initial_capital=10000):
+    """
+    backtests target positions on market data.
+
+    Args:
+        data (np.ndarray): market data (format of market_data.get_data).
+        signals (np.ndarray): the target position of every bar (see the
+        module docstring), or a strategy function returning them.
+        size (float, optional): the number of units of a position of 1.
+        Defaults to 1.
+        commission (float, optional): commission on every fill, as a
+        fraction of the traded value. Defaults to 0.
+        slippage (float, optional): price difference between the open and
+        the fill price, against the order. Defaults to 0.
+        initial_capital (float, optional): Defaults to 10000.
+
+    Returns:
+        BacktestResults: the results.
+    """
+    if callable(signals):
+        signals = signals(data)
+    targets = forward_fill(np.asarray(signals, dtype=np.float64))
+    nb_of_bars = data.shape[0]
+    open_ = data[:, 1]
+    close = data[:, 4]
+
+    # the target of a bar is filled on the open of the next one
+    positions = np.zeros(nb_of_bars, dtype=np.float64)
+    positions[1:] = targets[:-1] * size
+    previous_positions = np.concatenate(([0.0], positions[:-1]))
+    quantities = positions - previous_positions
+    fill_prices = open_ + slippage * np.sign(quantities)
+    costs = np.abs(quantities) * fill_prices * commission
+
+    previous_close = np.concatenate((close[:1], close[:-1]))
+    pnl = previous_positions * (close - previous_close) + \
+        quantities * (close - fill_prices) - costs
+    equity = initial_capital + np.cumsum(pnl)
+    drawdown = equity - np.maximum.accumulate(
+        np.maximum(equity, initial_capital))
+
+    filled = np.flatnonzero(quantities)
+    fills = {"index": filled, "price": fill_prices[filled],
+             "quantity": quantities[filled]}
+    trades = get_trades(positions, fills, close, commission)
+    stats = get_stats(data, pnl, equity, drawdown, trades, initial_capital)
+    return BacktestResults(data, positions, pnl, equity, drawdown, fills,
+                           trades, stats)
+
+
+def ema_crossover(data, fast=12, slow=26):
+    """long when the fast ema is above the slow one, short otherwise."""
+    fast_ema = indicators.ema(data, fast)[:, 1]
+    slow_ema = indicators.ema(data, slow)[:, 1]
+    return np.sign(fast_ema - slow_ema)
+
+
+def macd_crossover(data, fast=12, slow=26, signal=9):
+    """long when the macd line is above the signal line, short otherwise."""
+    histogram = indicators.macd(data, fast, slow, signal)[:, 3]
+    return np.sign(histogram)
+
+
+def rsi_reversal(data, period=14, oversold=30, overbought=70):
+    """
+    long when the rsi goes below oversold, short when it goes above
+    overbought, keeps the position in between.
+    """
+    rsi = indicators.rsi(data, period)[:, 1]
+    signals = np.full(data.shape[0], np.nan)
+    signals[rsi < oversold] = 1
+    signals[rsi > overbought] = -1
+    return signals
+
+
+def adx_trend(data, period=14, threshold=25):
+    """
+    follows the strongest directional index while the adx is above
+    threshold, flat otherwise.
+    """
+    values = indicators.adx(data, period)
+    signals = np.sign(values[:, 2] - values[:, 3])
+    signals[~(values[:, 1] > threshold)] = 0
+    return signals
+
+
+strategies = {"ema crossover": ema_crossover, "macd crossover": macd_crossover,
+              "rsi reversal": rsi_reversal, "adx trend": adx_trend}
+
+
+# internal use :
+def forward_fill(a):
+    """replaces the NaN by the previous value (0 before the first one)."""
+    valid = ~np.isnan(a)
+    indexes = np.where(valid, np.arange(a.shape[0]), 0)
+    np.maximum.accumulate(indexes, out=indexes)
+    out = a[indexes]
+    out[:np.argmax(valid) if valid.any() else a.shape[0]] = 0
+    return out
+
+
+def get_trades(positions, fills, close, commission):
+    """
+    splits the positions in trades : a trade starts at a fill and lasts
+    while the position doesn't change. The commission of a fill is split
+    between the trade it reduces or closes and the trade it opens, by
+    quantity (i.e 1 -> 0.5 charges 0.5 to the trade of 1).
+    """
+    starts = fills["index"]
+    entry_positions = positions[starts]
+    entry_prices = fills["price"]
+    # a trade ends at the next fill, the last one may still be open
+    exits = np.append(starts[1:], positions.shape[0] - 1)
+    exit_prices = np.append(entry_prices[1:], close[-1:])[:starts.shape[0]]
+    closed = np.ones(starts.shape[0], dtype=bool)
+    if starts.shape[0] and positions[-1] != 0:
+        closed[-1] = False
+        exit_prices[-1] = close[-1]
+
+    previous_positions = entry_positions - fills["quantity"]
+    reduced = np.where(previous_positions * entry_positions < 0,
+                       np.abs(previous_positions),
+                       np.maximum(np.abs(previous_positions) -
+                                  np.abs(entry_positions), 0))
+    opened = np.abs(fills["quantity"]) - reduced
+    unit_costs = entry_prices * commission
+    entry_costs = opened * unit_costs
+    exit_costs = np.append((reduced * unit_costs)[1:], 0)[:starts.shape[0]]
+    pnl = entry_positions * (exit_prices - entry_prices) - entry_costs - \
+        exit_costs
+
+    is_trade = entry_positions != 0
+    return {"entry_index": starts[is_trade], "exit_index": exits[is_trade],
+            "entry_price": entry_prices[is_trade],
+            "exit_price": exit_prices[is_trade],
+            "position": entry_positions[is_trade], "pnl": pnl[is_trade],
+            "closed": closed[is_trade]}
+
+
+def get_stats(data, pnl, equity, drawdown, trades, initial_capital):
+    nb_of_trades = trades["pnl"].shape[0]
+    wins = trades["pnl"][trades["pnl"] > 0]
+    losses = trades["pnl"][trades["pnl"] < 0]
+    returns = pnl / np.concatenate(([initial_capital], equity[:-1]))
+
+    sharpe = np.nan
+    if data.shape[0] > 1 and np.std(returns) > 0:
+        bar_duration = np.median(np.diff(data[:, 0]))
+        bars_per_year = seconds_per_year / bar_duration
+        sharpe = np.mean(returns) / np.std(returns) * np.sqrt(bars_per_year)
+
+    peaks = equity - drawdown
+    return {
+        "total_pnl": float(equity[-1] - initial_capital) if len(equity)
+        else 0.0,
+        "total_return": float(equity[-1] / initial_capital - 1) if len(equity)
+        else 0.0,
+        "nb_of_trades": nb_of_trades,
+        "win_rate": wins.shape[0] / nb_of_trades if nb_of_trades else np.nan,
+        "profit_factor": float(wins.sum() / -losses.sum()) if losses.shape[0]
+        else np.nan,
+        "max_drawdown": float(drawdown.min()) if len(drawdown) else 0.0,
+        "max_drawdown_pct": float((drawdown / peaks).min()) if len(drawdown)
+        else 0.0,
+        "sharpe": float(sharpe),
+    }
+
+
+# program :
+if __name__ == "__main__":
+    import time
+
+    from data import market_data as test_data
+
+    # a year of 1 minute bars
+    rng = np.random.default_rng(0)
+    nb_of_bars = 365 * 24 * 60
+    close = 1.2 + np.cumsum(rng.normal(0, 1e-4, nb_of_bars))
+    open_ = np.concatenate(([close[0]], close[:-1]))
+    data = np.column_stack((1.6e9 + 60 * np.arange(nb_of_bars), open_,
+                            np.maximum(open_, close) + 5e-5,
+                            np.minimum(open_, close) - 5e-5, close))
+    for name, strategy in strategies.items():
+        start = time.perf_counter()
+        results = run(data, strategy, size=10000, commission=2e-5)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<15} {nb_of_bars} bars in {elapsed * 1000:.0f} ms :",
+              results)
+
+    # checks the vectorized pnl against a loop over the bars
+    results = run(test_data, rsi_reversal, size=10000, commission=2e-5,
+                  slippage=1e-5)
+    cash, position = 10000.0, 0.0
+    equity = []
+    for i, bar in enumerate(test_data):
+        quantity = results.positions[i] - position
+        if quantity != 0:
+            price = bar[1] + 1e-5 * np.sign(quantity)
+            cash -= quantity * price + abs(quantity) * price * 2e-5
+            position = results.positions[i]
+        equity.append(cash + position * bar[4])
+    same_equity = np.allclose(equity, results.equity)
+    same_pnl = np.isclose(results.trades["pnl"].sum(),
+                          results.stats["total_pnl"])
+    assert same_equity and same_pnl
+    print("same equity as a loop :", same_equity,
+          "  same pnl as the trades :", same_pnl)
+    print(results.summary())
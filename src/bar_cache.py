@@ -0,0 +1,157 @@
+import os
+import os.path
+import tempfile
+import time
+
+import numpy as np
+
+import settings
+from bar_dates import (barsize_to_seconds, duration_to_seconds,
+                       seconds_to_duration, to_end_datetime)
+
+"""
+This module will handle the local cache of market data. The bars of every
+(symbol, barsize) are saved in a .npy file (same format as
+market_data.get_data) that can be memory-mapped, so the data of the last
+session is available at startup and only the missing bars have to be asked
+to interactive brokers.
+"""
+
+# variables :
+cache_dir = settings.get_settings("bar_cache_dir")
+max_gap = 4 * 86400  # shorter gaps are weekends or holidays
+
+
+# external use :
+def load(symbol, barsize, mmap=True):
+    """
+    returns the cached bars of a symbol and barsize.
+
+    Args:
+        symbol (str): The security's symbol (i.e "EUR/USD").
+        barsize (str): The barsize (i.e "5 mins").
+        mmap (bool, optional): Whether to memory-map the file instead of
+        reading it. Defaults to True.
+
+    Returns:
+        np.ndarray: array([[timestamp, open, high, low, close], ...]), empty
+        if there is no cache.
+    """
+    path = get_path(symbol, barsize)
+    if not os.path.exists(path):
+        return np.empty((0, 5), dtype=np.float64)
+    try:
+        bars = np.load(path, mmap_mode="r" if mmap else None)
+    except (OSError, ValueError):
+        return np.empty((0, 5), dtype=np.float64)
+    if bars.ndim != 2 or bars.shape[1] != 5:
+        return np.empty((0, 5), dtype=np.float64)
+    return bars
+
+
+def save(symbol, barsize, bars):
+    """
+    saves the bars of a symbol and barsize, replacing the old cache
+    atomically.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = get_path(symbol, barsize)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, np.ascontiguousarray(bars, dtype=np.float64))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_all(market):
+    """saves the bars of every symbol and barsize of a BarStore."""
+    for symbol, barsize in market.keys():
+        bars = market.get(symbol, barsize).view()
+        if bars.shape[0]:
+            save(symbol, barsize, bars)
+
+
+def missing_ranges(bars, barsize, duration, now=None):
+    """
+    returns the parts of the requested period that are not in the cached
+    bars : the tail since the last cached bar (which is asked again since it
+    might not have been complete), the head before the first one and the
+    internal gaps longer than {{max_gap}} (shorter ones can be a closed
+    market).
+
+    Args:
+        bars (np.ndarray): the cached bars.
+        barsize (str): The barsize (i.e "5 mins").
+        duration (str): The requested duration (i.e "2 M").
+        now (float, optional): The current timestamp.
+
+    Returns:
+        list of tuple: (end_datetime, duration) of the requests to send, the
+        most recent first. end_datetime is "" for the tail (up to now).
+    """
+    now = time.time() if now == None else now
+    start = now - duration_to_seconds(duration)
+    bar_length = barsize_to_seconds(barsize)
+    timestamps = bars[:, 0]
+    timestamps = timestamps[timestamps >= start]
+    if timestamps.shape[0] == 0:
+        return [("", duration)]
+
+    ranges = [("", seconds_to_duration(now - timestamps[-1] + bar_length))]
+    gaps = np.flatnonzero(np.diff(timestamps) > max(max_gap, 2 * bar_length))
+    for i in gaps[::-1]:
+        gap_start, gap_end = timestamps[i], timestamps[i + 1]
+        ranges.append((to_end_datetime(gap_end),
+                       seconds_to_duration(gap_end - gap_start)))
+    if timestamps[0] - start > 2 * bar_length:
+        ranges.append((to_end_datetime(timestamps[0]),
+                       seconds_to_duration(timestamps[0] - start)))
+    return ranges
+
+
+def trim(bars, duration, now=None):
+    """returns the bars within the duration (i.e "2 M") before now."""
+    now = time.time() if now == None else now
+    start = now - duration_to_seconds(duration)
+    return bars[np.searchsorted(bars[:, 0], start):]
+
+
+# internal use :
+def get_path(symbol, barsize):
+    name = f"{symbol}_{barsize}".replace("/", "-").replace(" ", "-")
+    return os.path.join(cache_dir, f"{name}.npy")
+
+
+def on_settings_change(key, value):
+    global cache_dir
+    cache_dir = value
+
+
+# program :
+settings.subscribe(on_settings_change, "bar_cache_dir")
+
+if __name__ == "__main__":
+    # loading time of the cache of a year of 1 minute bars
+    from data import market_data as test_data
+
+    nb_of_bars = 370_000
+    bars = np.empty((nb_of_bars, 5), dtype=np.float64)
+    bars[:, 0] = time.time() - 60 * np.arange(nb_of_bars)[::-1]
+    bars[:, 1:] = np.resize(test_data[:, 1:], (nb_of_bars, 4))
+    save("TEST/BENCH", "1 min", bars)
+    for mmap in (True, False):
+        start = time.perf_counter()
+        loaded = load("TEST/BENCH", "1 min", mmap=mmap)
+        loaded = np.array(loaded)
+        elapsed = time.perf_counter() - start
+        assert np.array_equal(loaded, bars)
+        print(f"loaded {nb_of_bars} bars (mmap={mmap}) in "
+              f"{elapsed * 1000:.1f} ms")
+    os.remove(get_path("TEST/BENCH", "1 min"))
+
+    holes = np.delete(bars, np.s_[100_000:110_000], axis=0)
+    print(missing_ranges(holes[:-30], "1 min", "1 Y"))
@@ -0,0 +1,201 @@
+from datetime import datetime
+import time
+
+import numpy as np
+
+"""
+This module will handle the conversion of the bar dates sent by interactive
+brokers to timestamps. The dates can have 3 formats :
+    - "yyyyMMdd" for daily bars,
+    - "yyyyMMdd  HH:mm:ss" for intraday bars requested with formatDate=1,
+    - "1623965460" (epoch seconds) for intraday bars requested with
+        formatDate=2.
+The first two are in the local time of the computer, like
+datetime.timestamp().
+It also converts the barsize and duration strings of the requests to
+seconds.
+"""
+
+# variables :
+date_length = 8
+# seconds per unit of the barsize and duration strings of interactive brokers
+barsize_units = {"sec": 1, "secs": 1, "min": 60, "mins": 60, "hour": 3600,
+                 "hours": 3600, "day": 86400, "days": 86400, "week": 604800,
+                 "weeks": 604800, "month": 2592000, "months": 2592000}
+duration_units = {"S": 1, "D": 86400, "W": 604800, "M": 2592000,
+                  "Y": 31536000}
+
+
+# external use :
+def to_timestamp(date):
+    """
+    converts the date of one bar to a timestamp.
+
+    Args:
+        date (str): the date of the bar (BarData.date).
+
+    Returns:
+        float: the timestamp.
+    """
+    if len(date) == date_length:
+        return datetime.strptime(date, r"%Y%m%d").timestamp()
+
+    if date.isdigit():
+        return float(date)
+
+    date = " ".join(date.split()[:2])
+    return datetime.strptime(date, r"%Y%m%d %H:%M:%S").timestamp()
+
+
+def to_timestamps(dates):
+    """
+    converts the dates of many bars to timestamps at once with numpy instead
+    of parsing every date with strptime. All the dates must have the same
+    format, which is the case for the bars of one request.
+
+    Args:
+        dates (list of str): the dates of the bars.
+
+    Returns:
+        np.ndarray: the timestamps (float64).
+    """
+    if len(dates) == 0:
+        return np.empty(0, dtype=np.float64)
+
+    first = dates[0]
+    if len(first) != date_length and first.isdigit():
+        return np.array(dates, dtype=np.int64).astype(np.float64)
+
+    dates = np.asarray(dates, dtype=np.str_)
+    return local_to_timestamps(naive_seconds(dates))
+
+
+def barsize_to_seconds(barsize):
+    """
+    returns the length of a bar in seconds.
+
+    Args:
+        barsize (str): the barsize (i.e "5 mins", "1 hour", "1 day").
+    """
+    nb, unit = barsize.split()
+    return int(nb) * barsize_units[unit]
+
+
+def duration_to_seconds(duration):
+    """
+    returns the length of a duration in seconds (months are 30 days and
+    years 365 days).
+
+    Args:
+        duration (str): the duration (i.e "2 D", "1 W", "6 M", "2 Y").
+    """
+    nb, unit = duration.split()
+    return int(nb) * duration_units[unit]
+
+
+def seconds_to_duration(seconds):
+    """
+    returns the shortest duration string covering a number of seconds.
+    """
+    seconds = max(int(np.ceil(seconds)), 1)
+    if seconds <= 86400:
+        return f"{seconds} S"
+    days = int(np.ceil(seconds / 86400))
+    if days <= 365:
+        return f"{days} D"
+    return f"{int(np.ceil(days / 365))} Y"
+
+
+def to_end_datetime(timestamp):
+    """
+    formats a timestamp as the endDateTime of a historical data request
+    (UTC).
+    """
+    return time.strftime(r"%Y%m%d-%H:%M:%S", time.gmtime(timestamp))
+
+
+# internal use :
+def naive_seconds(dates):
+    """
+    returns the number of seconds between 1970-01-01 00:00:00 and the dates
+    as if they were UTC dates.
+
+    Args:
+        dates (np.ndarray): "yyyyMMdd" or "yyyyMMdd  HH:mm:ss" dates.
+    """
+    width = dates.dtype.itemsize // 4
+    codes = np.ascontiguousarray(dates).view(np.uint32).reshape(-1, width)
+    digits = codes.astype(np.int64) - ord("0")
+
+    def number(first, nb_of_digits):
+        value = np.zeros(codes.shape[0], dtype=np.int64)
+        for i in range(nb_of_digits):
+            value = value * 10 + digits[:, first + i]
+        return value
+
+    years = number(0, 4)
+    months = number(4, 2)
+    days = number(6, 2)
+    day_nb = ((years - 1970).astype("M8[Y]").astype("M8[M]")
+              + (months - 1).astype("m8[M]")).astype("M8[D]") \
+        + (days - 1).astype("m8[D]")
+    seconds = day_nb.astype(np.int64) * 86400
+
+    if width > date_length:
+        # the time comes after one or several spaces
+        rows = np.arange(codes.shape[0])
+        start = np.full(codes.shape[0], date_length, dtype=np.int64)
+        while True:
+            is_space = codes[rows, np.minimum(start, width - 1)] == ord(" ")
+            if not is_space.any():
+                break
+            start += is_space
+
+        def clock(offset):
+            cols = start + offset
+            return digits[rows, cols] * 10 + digits[rows, cols + 1]
+
+        seconds += clock(0) * 3600 + clock(3) * 60 + clock(6)
+    return seconds
+
+
+def local_to_timestamps(seconds):
+    """
+    converts naive local times (in seconds, see naive_seconds) to timestamps.
+    The utc offset is computed once per distinct hour instead of once per
+    date.
+    """
+    hours, inverse = np.unique(seconds // 3600, return_inverse=True)
+    offsets = np.empty(hours.shape[0], dtype=np.int64)
+    for i, hour in enumerate(hours):
+        naive = int(hour) * 3600
+        local = time.mktime(time.gmtime(naive)[:8] + (-1,))
+        offsets[i] = naive - int(local)
+    return (seconds - offsets[inverse.reshape(-1)]).astype(np.float64)
+
+
+# program :
+if __name__ == "__main__":
+    # benchmark : one conversion per bar (the way historicalData used to do
+    # it) vs one numpy conversion for the whole request
+    nb_of_bars = 200_000
+    start_ts = 1_600_000_000
+    timestamps = start_ts + 60 * np.arange(nb_of_bars)
+    formats = {
+        "yyyyMMdd  HH:mm:ss": [
+            datetime.fromtimestamp(ts).strftime(r"%Y%m%d  %H:%M:%S")
+            for ts in timestamps.tolist()],
+        "epoch": [str(ts) for ts in timestamps.tolist()],
+        "yyyyMMdd": [
+            datetime.fromtimestamp(ts).strftime(r"%Y%m%d")
+            for ts in (start_ts + 86400 * np.arange(nb_of_bars // 100)).tolist()],
+    }
+    for name, dates in formats.items():
+        t0 = time.perf_counter()
+        expected = np.array([to_timestamp(d) for d in dates])
+        t1 = time.perf_counter()
+        result = to_timestamps(dates)
+        t2 = time.perf_counter()
+        assert np.array_equal(expected, result), name
+        print(f"{name:<20} per bar : {len(dates) / (t1 - t0):12,.0f} bars/s"
+              f"   bulk : {len(dates) / (t2 - t1):12,.0f} bars/s")
@@ -0,0 +1,301 @@
+import numpy as np
+
+from resample import Resampler, default_session
+
+"""
+This module will handle the storage of market data bars. Every
+(symbol, barsize) gets its own preallocated float64 array that grows
+geometrically, so adding a bar is amortized O(1) and reading the bars back
+doesn't copy anything.
+"""
+
+# variables :
+columns = ("timestamp", "open", "high", "low", "close")
+initial_capacity = 256
+growth_factor = 2
+
+
+class BarSeries:
+    """
+    A growable array of bars for one (symbol, barsize), always sorted by
+    timestamp and without duplicated timestamps.
+
+    ...
+
+    Attributes
+    ----------
+    size : int
+        The number of bars stored. Only the first {{size}} rows of the
+        underlying buffer are valid.
+    version : int
+        Incremented every time bars other than the last one are changed or
+        removed. Adding bars at the end or revising the last bar doesn't
+        change it, so a result computed on the first bars stays valid for
+        them while the version is the same.
+
+    Methods (external)
+    -------
+    append, extend, merge, upsert, view, last_timestamp, clear
+    """
+
+    def __init__(self, capacity=initial_capacity):
+        self._arr = np.empty((max(int(capacity), 1), len(columns)),
+                             dtype=np.float64)
+        self.size = 0
+        self.version = 0
+
+    def __len__(self):
+        return self.size
+
+    # external use
+    def append(self, timestamp, open_, high, low, close):
+        """
+        Adds a bar at the end of the series. The caller must make sure the
+        timestamp is greater than the last one stored.
+        """
+        if self.size == self._arr.shape[0]:
+            self._grow(self.size + 1)
+        row = self._arr[self.size]
+        row[0] = timestamp
+        row[1] = open_
+        row[2] = high
+        row[3] = low
+        row[4] = close
+        self.size += 1
+
+    def extend(self, bars):
+        """
+        Adds several bars at the end of the series.
+
+        Args:
+            bars (np.ndarray): array of shape (n, 5) sorted by timestamp.
+        """
+        bars = np.asarray(bars, dtype=np.float64).reshape(-1, len(columns))
+        n = bars.shape[0]
+        if self.size + n > self._arr.shape[0]:
+            self._grow(self.size + n)
+        self._arr[self.size:self.size + n] = bars
+        self.size += n
+
+    def merge(self, bars):
+        """
+        Adds several bars to the series. Bars with a timestamp already in
+        the series replace the stored ones.
+
+        Args:
+            bars (np.ndarray): array of shape (n, 5), in any order.
+        """
+        bars = np.asarray(bars, dtype=np.float64).reshape(-1, len(columns))
+        if bars.shape[0] == 0:
+            return
+
+        timestamps = bars[:, 0]
+        is_sorted = np.all(timestamps[1:] > timestamps[:-1])
+        last = self.last_timestamp()
+        if is_sorted and (last == None or timestamps[0] > last):
+            self.extend(bars)
+            return
+
+        merged = np.concatenate((self._arr[:self.size], bars))
+        merged = merged[np.argsort(merged[:, 0], kind="stable")]
+        # keeps the last bar received for every timestamp
+        keep = np.append(merged[1:, 0] != merged[:-1, 0], True)
+        merged = merged[keep]
+        self.size = 0
+        self.version += 1
+        self.extend(merged)
+
+    def upsert(self, timestamp, open_, high, low, close):
+        """
+        Replaces the bar with the same timestamp or inserts the bar at its
+        sorted position if there is none. Revising the last bar or adding a
+        new one is O(1), older bars are found with a binary search.
+        """
+        last = self.size - 1
+        if last < 0 or timestamp > self._arr[last, 0]:
+            self.append(timestamp, open_, high, low, close)
+            return
+
+        if timestamp == self._arr[last, 0]:
+            i = last
+        else:
+            i = int(np.searchsorted(self._arr[:self.size, 0], timestamp))
+            if self._arr[i, 0] != timestamp:
+                self._insert(i)
+            self.version += 1
+
+        row = self._arr[i]
+        row[0] = timestamp
+        row[1] = open_
+        row[2] = high
+        row[3] = low
+        row[4] = close
+
+    def view(self, nb_of_data_points=0):
+        """
+        Returns a read-only view on the last bars, no data is copied. A
+        revision of the last bar (see upsert) is visible through views
+        returned before it.
+
+        Args:
+            nb_of_data_points (int, optional): The number of bars to return.
+            Defaults to 0 which means all the bars.
+
+        Returns:
+            np.ndarray: array([[timestamp, open, high, low, close], ...])
+        """
+        start = 0
+        if 0 < nb_of_data_points < self.size:
+            start = self.size - nb_of_data_points
+        bars = self._arr[start:self.size]
+        bars.flags.writeable = False
+        return bars
+
+    def last_timestamp(self):
+        if self.size == 0:
+            return None
+        return self._arr[self.size - 1, 0]
+
+    def clear(self):
+        self.size = 0
+        self.version += 1
+
+    # internal use
+    def _insert(self, i):
+        """makes room for a new bar at index i"""
+        if self.size == self._arr.shape[0]:
+            self._grow(self.size + 1)
+        self._arr[i + 1:self.size + 1] = self._arr[i:self.size]
+        self.size += 1
+
+    def _grow(self, min_capacity):
+        capacity = self._arr.shape[0]
+        while capacity < min_capacity:
+            capacity *= growth_factor
+        arr = np.empty((capacity, len(columns)), dtype=np.float64)
+        arr[:self.size] = self._arr[:self.size]
+        self._arr = arr
+
+
+class BarStore:
+    """
+    Stores a BarSeries for every (symbol, barsize). The series of a derived
+    barsize (see derive) is resampled from its base series when it's asked.
+
+    ...
+
+    Methods (external)
+    -------
+    get, reset, derive, is_derived, remove, clear, keys
+    """
+
+    def __init__(self):
+        self._series = {}
+        self._derived = {}  # (symbol, barsize) -> Resampler
+
+    def __contains__(self, key):
+        return key in self._series
+
+    def __iter__(self):
+        return iter(self._series)
+
+    def __len__(self):
+        return len(self._series)
+
+    # external use
+    def get(self, symbol, barsize):
+        """
+        Returns the BarSeries of a symbol and barsize, or None if there is
+        no data for it.
+        """
+        resampler = self._derived.get((symbol, barsize))
+        if resampler != None:
+            return resampler.update()
+        return self._series.get((symbol, barsize))
+
+    def reset(self, symbol, barsize, capacity=initial_capacity):
+        """
+        Creates an empty BarSeries for the symbol and barsize (replacing the
+        old one if there was one) and returns it. The derived barsizes
+        of the symbol follow the new series.
+        """
+        old_series = self._series.get((symbol, barsize))
+        series = BarSeries(capacity)
+        self._series[(symbol, barsize)] = series
+        for (derived_symbol, derived_barsize), resampler in \
+                self._derived.items():
+            if derived_symbol != symbol:
+                continue
+            if derived_barsize == barsize:
+                resampler.series = series
+                resampler.reset()
+            elif old_series != None and resampler.base is old_series:
+                resampler.base = series
+                resampler.reset()
+        return series
+
+    def derive(self, symbol, barsize, base_barsize, session=default_session):
+        """
+        Makes the bars of a barsize resampled from the bars of a lower one
+        (see the resample module), i.e "1 hour" from "1 min". The bars of
+        the barsize already stored (i.e a longer history) are kept before the
+        first base bar.
+
+        Raises:
+            ValueError: if barsize isn't a multiple of base_barsize dividing a
+            day, or a day.
+        """
+        if (symbol, base_barsize) not in self._series:
+            self.reset(symbol, base_barsize)
+        if (symbol, barsize) not in self._series:
+            self.reset(symbol, barsize)
+        self._derived[(symbol, barsize)] = Resampler(
+            self._series[(symbol, base_barsize)],
+            self._series[(symbol, barsize)], barsize, base_barsize, session)
+
+    def is_derived(self, symbol, barsize):
+        return (symbol, barsize) in self._derived
+
+    def remove(self, symbol, barsize):
+        self._series.pop((symbol, barsize), None)
+        self._derived.pop((symbol, barsize), None)
+
+    def clear(self):
+        self._series = {}
+        self._derived = {}
+
+    def keys(self):
+        return list(self._series)
+
+
+# program :
+if __name__ == "__main__":
+    # micro-benchmark of the keepUpToDate path: the cost of an update must
+    # not depend on the length of the history.
+    import time
+
+    nb_updates = 100_000
+    for history in (1_000, 100_000, 1_000_000):
+        series = BarSeries()
+        series.extend(np.column_stack(
+            (np.arange(history, dtype=np.float64) * 60,
+             np.ones((history, 4)))))
+        start = time.perf_counter()
+        last = series.last_timestamp()
+        for i in range(nb_updates):
+            # 5 revisions of the last bar, then a new bar
+            ts = last + 60 * (i // 6)
+            series.upsert(ts, 1.0, 1.1, 0.9, 1.0 + i * 1e-6)
+        elapsed = time.perf_counter() - start
+        print(f"history {history:>9} bars : "
+              f"{elapsed / nb_updates * 1e9:8.0f} ns per update")
+
+    series = BarSeries()
+    series.extend(np.column_stack(
+        (np.arange(1_000_000, dtype=np.float64) * 60, np.ones((1_000_000, 4)))))
+    start = time.perf_counter()
+    for i in range(1_000):
+        series.upsert(60 * (i * 997 % 1_000_000) + 30, 1.0, 1.0, 1.0, 1.0)
+    elapsed = time.perf_counter() - start
+    print(f"out of order insert in 1e6 bars : "
+          f"{elapsed / 1_000 * 1e6:8.1f} us per insert")
@@ -0,0 +1,384 @@
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from finta import TA
+
+import indicators
+from data import market_data as test_data
+
+"""
+Benchmark and regression suite of the indicators module. Every indicator is
+timed on synthetic bars (1e3 to 1e7 bars) and on the test data of data.py,
+next to a pandas version with the same definition and the finta version.
+Run this module to print the results :
+    python benchmark_indicators.py [--max-bars 1e6] [--save-baseline]
+
+It exits with 1 when :
+    - an indicator doesn't give the same values as its pandas version,
+    - an indicator doesn't give the same values as its finta version, for
+        the indicators having the same definition in finta (finta's rsi
+        and adx use wilder's smoothing and its bbands the sample std of
+        the current window, they are only timed),
+    - the throughput of an indicator dropped more than max_slowdown below
+        the baseline (a json file written by --save-baseline).
+Everything runs offline, on generated data. The baseline is machine
+specific, it is ignored by git (see --baseline to keep it elsewhere).
+"""
+
+# variables :
+sizes = [10**3, 10**4, 10**5, 10**6, 10**7]
+max_slowdown = 0.3  # a drop of throughput over 30% is a regression
+rtol = 1e-7
+atol = 1e-9
+# pandas' rolling std updates its sums bar after bar, its rounding errors
+# reach ~5e-9 after 1e7 bars
+atols = {"std": 2e-8, "bbands": 4e-8}
+min_duration = 0.2  # each timing repeats the call for at least this long
+finta_max_bars = {"adx": 10**5}  # finta's adx is a row by row loop
+baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "benchmark_baseline.json")
+
+
+# external use :
+def run_suite(max_bars=sizes[-1], baseline=None):
+    """
+    runs the benchmarks and the comparisons.
+
+    Args:
+        max_bars (int, optional): the size of the largest synthetic series.
+        baseline (dict, optional): the throughputs of a previous run (see
+        to_baseline). Defaults to None which means no regression check.
+
+    Returns:
+        tuple: (list of result dicts, list of failure messages)
+    """
+    results = []
+    failures = []
+    datasets = [("data.py", test_data)] + [
+        (f"{size:.0e}", synthetic_data(size))
+        for size in sizes if size <= max_bars]
+
+    for dataset, data in datasets:
+        frame = to_frame(data)
+        for name, (params, reference, finta_function, same_in_finta) in \
+                cases.items():
+            ours = bench(getattr(indicators, name), data, *params)
+            pandas_ = bench(reference, frame, *params)
+            result = {"dataset": dataset, "indicator": name,
+                      "nb_of_bars": data.shape[0], "ours": ours[:2],
+                      "pandas": pandas_[:2], "finta": None}
+            tolerance = atols.get(name, atol)
+            if not same_values(ours[2], pandas_[2], tolerance):
+                difference = max_difference(ours[2], pandas_[2])
+                failures.append(f"{name} on {dataset} : different from "
+                                f"pandas ({difference:.3e})")
+
+            if data.shape[0] <= finta_max_bars.get(name, sizes[-1]):
+                finta = bench(finta_function, frame, *params)
+                result["finta"] = finta[:2]
+                if same_in_finta and \
+                        not same_values(ours[2], finta[2], tolerance):
+                    difference = max_difference(ours[2], finta[2])
+                    failures.append(f"{name} on {dataset} : different from "
+                                    f"finta ({difference:.3e})")
+
+            expected = None if baseline == None else \
+                baseline.get(name, {}).get(dataset)
+            if expected != None and dataset != "data.py":
+                throughput = data.shape[0] / ours[0]
+                if throughput < expected * (1 - max_slowdown):
+                    failures.append(f"{name} on {dataset} : {throughput:.3g} "
+                                    f"bars/s, baseline {expected:.3g} bars/s")
+            results.append(result)
+            print_result(result)
+    return results, failures
+
+
+def to_baseline(results):
+    """returns {indicator: {dataset: bars/s}} of our indicators."""
+    baseline = {}
+    for result in results:
+        seconds = result["ours"][0]
+        baseline.setdefault(result["indicator"], {})[result["dataset"]] = \
+            result["nb_of_bars"] / seconds
+    return baseline
+
+
+def bench_std(nb_of_bars=1_000_000, period=20):
+    """
+    compares indicators.std to the window matrix version it replaced.
+
+    Returns:
+        dict: the time (s), peak memory (bytes) of both versions and the
+        max difference between their results.
+    """
+    data = synthetic_data(nb_of_bars)
+    results = {}
+    for name, function in (("window matrix", std_windows),
+                           ("cumulative sums", indicators.std)):
+        elapsed, peak, out = measure(function, data, period)
+        results[name] = (elapsed, peak, out)
+    a, b = results["window matrix"][2], results["cumulative sums"][2]
+    results["max difference"] = np.nanmax(np.abs(a[:, 1] - b[:, 1]))
+    return results
+
+
+def bench_grid(nb_of_symbols=50, nb_of_bars=5000, windows=range(5, 105, 5)):
+    """
+    compares indicators.ema_grid to one indicators.ema call per symbol and
+    window.
+
+    Returns:
+        dict: the time (s) of both ways and the max difference between
+        their results.
+    """
+    datas = [synthetic_data(nb_of_bars, seed) for seed in range(nb_of_symbols)]
+    closes = indicators.stack_closes(datas)
+    windows = list(windows)
+
+    start = time.perf_counter()
+    expected = np.array([[indicators.ema(data, window)[:, 1]
+                          for data in datas] for window in windows])
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    grid = indicators.ema_grid(closes, windows)
+    grid_time = time.perf_counter() - start
+    return {"one call per series": loop_time, "grid": grid_time,
+            "max difference": np.max(np.abs(grid - expected))}
+
+
+# internal use :
+def synthetic_data(nb_of_bars, seed=0):
+    """returns a random walk in the format of market_data.get_data."""
+    rng = np.random.default_rng(seed)
+    close = 1.2 + np.cumsum(rng.normal(0, 1e-4, nb_of_bars))
+    open_ = np.concatenate(([close[0]], close[:-1]))
+    high = np.maximum(open_, close) + rng.random(nb_of_bars) * 1e-4
+    low = np.minimum(open_, close) - rng.random(nb_of_bars) * 1e-4
+    timestamps = 1.6e9 + 60 * np.arange(nb_of_bars, dtype=np.float64)
+    return np.column_stack((timestamps, open_, high, low, close))
+
+
+def to_frame(data):
+    return pd.DataFrame(data[:, 1:], columns=["open", "high", "low", "close"])
+
+
+def measure(function, *args):
+    """returns (seconds, peak memory in bytes, result) of a call."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    out = function(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, out
+
+
+def bench(function, *args):
+    """
+    returns (seconds, peak memory in bytes, values) of a function. The time
+    is the best of several calls made without tracemalloc (which slows
+    pandas down) and the values are the indicator values without the
+    timestamps, as a 2D array.
+    """
+    _, peak, out = measure(function, *args)
+    best = np.inf
+    spent = 0
+    while spent < min_duration:
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        spent += elapsed
+    if isinstance(out, (pd.Series, pd.DataFrame)):
+        values = out.to_numpy(dtype=np.float64)
+    else:
+        values = out[:, 1:]
+    return best, peak, values.reshape(values.shape[0], -1)
+
+
+def same_values(a, b, tolerance=atol):
+    return a.shape == b.shape and np.array_equal(np.isnan(a), np.isnan(b)) \
+        and np.allclose(a, b, rtol=rtol, atol=tolerance, equal_nan=True)
+
+
+def max_difference(a, b):
+    if a.shape != b.shape:
+        return np.inf
+    with np.errstate(invalid="ignore"):
+        difference = np.abs(a - b)
+    difference[np.isnan(a) != np.isnan(b)] = np.inf
+    return np.nanmax(difference) if difference.size else 0.0
+
+
+def print_result(result):
+    line = f"{result['dataset']:>8} {result['indicator']:<7}"
+    for name in ("ours", "pandas", "finta"):
+        if result[name] == None:
+            line += f" | {name:<6} {'-':>10} {'':>17}"
+            continue
+        seconds, peak = result[name]
+        line += f" | {name:<6} {result['nb_of_bars'] / seconds:10.3g} " \
+            f"bars/s {peak / 2**20:6.1f} MiB"
+    print(line)
+
+
+def std_windows(data, period):
+    """the former indicators.std, building a (n - period) x period matrix"""
+    closing_prices = data[:, 4]
+    windows = np.zeros((data.shape[0] - period, period), np.float64)
+    for i in range(period):
+        windows[:, i] = closing_prices[i:windows.shape[0]+i]
+    std = np.std(windows, axis=1)
+    extra_values = np.zeros(period)
+    extra_values[:] = np.nan
+    std = np.concatenate((extra_values, std))
+    return np.stack((data[:, 0], std), axis=1)
+
+
+# pandas versions of the indicators, with the same definitions
+def pandas_sma(frame, window):
+    return frame["close"].rolling(window).mean()
+
+
+def pandas_ema(frame, window):
+    return frame["close"].ewm(span=window, adjust=False).mean()
+
+
+def pandas_rsi(frame, period=14):
+    delta = frame["close"].diff()
+    gain = delta.clip(lower=0).rolling(period).mean()
+    loss = (-delta).clip(lower=0).rolling(period).mean()
+    return 100 - 100 / (1 + gain / loss)
+
+
+def pandas_macd(frame, fast=12, slow=26, signal=9):
+    close = frame["close"]
+    line = close.ewm(span=fast, adjust=False).mean() - \
+        close.ewm(span=slow, adjust=False).mean()
+    signal_line = line.ewm(span=signal, adjust=False).mean()
+    return pd.concat((line, signal_line, line - signal_line), axis=1)
+
+
+def pandas_bbands(frame, period=20, std_multiplier=2):
+    close = frame["close"]
+    middle = close.rolling(period).mean()
+    sigma = close.shift(1).rolling(period).std(ddof=0)
+    return pd.concat((middle, middle + std_multiplier * sigma,
+                      middle - std_multiplier * sigma), axis=1)
+
+
+def pandas_adx(frame, period=14):
+    up = frame["high"].diff()
+    down = -frame["low"].diff()
+    dmp = up.where((up > 0) & (up > down), 0.0)
+    dmn = down.where((down > 0) & (down > dmp), 0.0)
+    previous_close = frame["close"].shift()
+    true_range = pd.concat((frame["high"] - frame["low"],
+                            (frame["high"] - previous_close).abs(),
+                            (previous_close - frame["low"]).abs()), axis=1)
+    atr = true_range.max(axis=1, skipna=False).rolling(period).mean()
+    diplus = 100 * (dmp / atr).ewm(alpha=1 / period, adjust=False).mean()
+    diminus = 100 * (dmn / atr).ewm(alpha=1 / period, adjust=False).mean()
+    total = diplus + diminus
+    ratio = ((diplus - diminus).abs() / total).where(total != 0, 0.0)
+    ratio[total.isna()] = np.nan
+    adx = 100 * ratio.ewm(alpha=1 / period, adjust=False).mean()
+    return pd.concat((adx, diplus, diminus), axis=1)
+
+
+def pandas_std(frame, period):
+    return frame["close"].shift(1).rolling(period).std(ddof=0)
+
+
+# finta versions, with the columns in the order of the indicators module
+def finta_sma(frame, window):
+    return TA.SMA(frame, window)
+
+
+def finta_ema(frame, window):
+    return TA.EMA(frame, window, adjust=False)
+
+
+def finta_rsi(frame, period=14):
+    return TA.RSI(frame, period)
+
+
+def finta_macd(frame, fast=12, slow=26, signal=9):
+    macd = TA.MACD(frame, fast, slow, signal, adjust=False)
+    return pd.concat((macd["MACD"], macd["SIGNAL"],
+                      macd["MACD"] - macd["SIGNAL"]), axis=1)
+
+
+def finta_bbands(frame, period=20, std_multiplier=2):
+    bands = TA.BBANDS(frame, period, std_multiplier=std_multiplier)
+    return bands[["BB_MIDDLE", "BB_UPPER", "BB_LOWER"]]
+
+
+def finta_adx(frame, period=14):
+    # DMI adds columns to the frame
+    frame = frame.copy()
+    return pd.concat((TA.ADX(frame, period), TA.DMI(frame, period)), axis=1)
+
+
+def finta_std(frame, period):
+    return frame["close"].rolling(period).std()
+
+
+# name : (params, pandas version, finta version, same definition in finta)
+cases = {
+    "sma": ((20,), pandas_sma, finta_sma, True),
+    "ema": ((20,), pandas_ema, finta_ema, True),
+    "rsi": ((14,), pandas_rsi, finta_rsi, False),
+    "macd": ((12, 26, 9), pandas_macd, finta_macd, True),
+    "bbands": ((20, 2), pandas_bbands, finta_bbands, False),
+    "adx": ((14,), pandas_adx, finta_adx, False),
+    "std": ((20,), pandas_std, finta_std, False),
+}
+
+
+# program :
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="indicators benchmarks")
+    parser.add_argument("--max-bars", type=float, default=sizes[-1],
+                        help="size of the largest synthetic series")
+    parser.add_argument("--baseline", default=baseline_path,
+                        help="the baseline file, next to this module by "
+                        "default")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="saves the throughputs of this run as baseline")
+    args = parser.parse_args()
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    else:
+        print(f"no baseline at {args.baseline}, throughput not checked")
+
+    results, failures = run_suite(int(args.max_bars), baseline)
+
+    results_std = bench_std(min(int(args.max_bars), 1_000_000))
+    for name in ("window matrix", "cumulative sums"):
+        elapsed, peak, _ = results_std[name]
+        print(f"std, window matrix vs cumulative sums, {name:<16}: "
+              f"{elapsed * 1000:8.1f} ms, peak memory {peak / 2**20:7.1f} MiB")
+    results_grid = bench_grid()
+    for name in ("one call per series", "grid"):
+        print(f"ema, 50 symbols x 20 windows x 5000 bars, {name:<20}: "
+              f"{results_grid[name] * 1000:8.1f} ms")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(to_baseline(results), file, indent=4)
+        print(f"baseline saved to {args.baseline}")
+
+    for failure in failures:
+        print("FAILED :", failure)
+    sys.exit(1 if failures else 0)
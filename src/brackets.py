@@ -0,0 +1,304 @@
+import numpy as np
+
+"""
+This module will handle the simulation of bracket orders (see
+orders.bracket_order) on market data : a market parent order, a limit take
+profit and a stop loss child. Each trade is entered on the open of its entry
+bar and exits on the first bar where the high/low reaches its stop or its
+limit.
+
+The first touch of thousands of trades is found at once : the running min of
+the lows and max of the highs are stored for every power of 2 window (sparse
+table), then every trade jumps over the windows that don't reach its levels,
+from the largest to the smallest. It costs O(nb_of_bars * log(nb_of_bars))
+once per data, and O(log(nb_of_bars)) per trade.
+
+The two tables take up to 2 * 4 * nb_of_bars * log2(nb_of_bars) bytes,
+about 75 MB for a year of 1 min bars (525600 bars, twice as much in
+float64), for every BracketSimulator (i.e one per process of a sweep). They
+are stored in float32, rounded away from the levels so no window reaching a
+level is skipped, and the bar found is checked against the float64 data.
+"""
+
+# variables :
+tie_rules = ("stop", "limit", "nearest")
+reasons = np.array(["limit", "stop", "end"])
+LIMIT, STOP, END = range(3)
+
+
+class BracketSimulator:
+    """
+    Resolves bracket trades against market data.
+
+    ...
+
+    Attributes
+    ----------
+    data : np.ndarray
+        The market data (format of market_data.get_data).
+    tie_rule : str
+        Which exit is taken when a bar reaches both the stop and the limit
+        and its open didn't gap over one of them :
+        "stop" (pessimistic), "limit" (optimistic) or "nearest" (the level
+        nearest to the open is assumed to be reached first).
+
+    Methods (external)
+    -------
+    resolve
+    """
+
+    def __init__(self, data, tie_rule="stop"):
+        if tie_rule not in tie_rules:
+            raise ValueError(f"unknown tie rule {tie_rule!r}, "
+                             f"expected one of {tie_rules}")
+        self.data = data
+        self.tie_rule = tie_rule
+        self._min_lows = sparse_table(data[:, 3], np.minimum)
+        self._max_highs = sparse_table(data[:, 2], np.maximum)
+        self._lows = np.ascontiguousarray(data[:, 3], dtype=np.float64)
+        self._highs = np.ascontiguousarray(data[:, 2], dtype=np.float64)
+
+    # external use
+    def resolve(self, entry_indexes, actions, stp_prices, lmt_prices):
+        """
+        finds the exit of every trade.
+
+        Args:
+            entry_indexes (array of int): the bar on the open of which each
+            trade is entered.
+            actions (array): "BUY" or "SELL" (or 1 / -1) for each trade, like
+            the action of orders.bracket_order.
+            stp_prices (array of float): the stop loss of each trade.
+            lmt_prices (array of float): the take profit of each trade.
+
+        Returns:
+            dict of np.ndarray: "entry_index", "entry_price", "exit_index",
+            "exit_price" and "reason" ("limit", "stop" or "end" for the trades
+            still open on the last bar, valued at its close) of every trade.
+        """
+        data = self.data
+        nb_of_bars = data.shape[0]
+        entries = np.asarray(entry_indexes, dtype=np.int64)
+        stops = np.asarray(stp_prices, dtype=np.float64)
+        limits = np.asarray(lmt_prices, dtype=np.float64)
+        long = get_sides(actions) > 0
+        if entries.size and (entries.min() < 0 or
+                             entries.max() >= nb_of_bars):
+            raise IndexError("entry index out of the market data")
+
+        # a long trade exits when the low reaches its stop or the high its
+        # limit, the opposite for a short one
+        below = first_touch(self._min_lows, entries,
+                            np.where(long, stops, limits), below=True,
+                            values=self._lows)
+        above = first_touch(self._max_highs, entries,
+                            np.where(long, limits, stops), below=False,
+                            values=self._highs)
+        stop_indexes = np.where(long, below, above)
+        limit_indexes = np.where(long, above, below)
+
+        exit_indexes = np.minimum(stop_indexes, limit_indexes)
+        reason = np.where(stop_indexes < limit_indexes, STOP, LIMIT)
+        ended = exit_indexes == nb_of_bars
+        exit_indexes[ended] = nb_of_bars - 1
+        reason[ended] = END
+
+        # the fill is at the level, or at the open if it gapped over it
+        opens = data[exit_indexes, 1]
+        stop_prices = np.where(long, np.minimum(stops, opens),
+                               np.maximum(stops, opens))
+        limit_prices = np.where(long, np.maximum(limits, opens),
+                                np.minimum(limits, opens))
+
+        ties = (stop_indexes == limit_indexes) & ~ended
+        if ties.any():
+            reason[ties] = self._break_ties(long[ties], opens[ties],
+                                            stops[ties], limits[ties])
+
+        exit_prices = np.where(reason == STOP, stop_prices, limit_prices)
+        exit_prices[ended] = data[-1, 4]
+        return {"entry_index": entries, "entry_price": data[entries, 1],
+                "exit_index": exit_indexes, "exit_price": exit_prices,
+                "reason": reasons[reason]}
+
+    # internal use
+    def _break_ties(self, long, opens, stops, limits):
+        """chooses the exit of the trades reaching both levels on a bar."""
+        stop_gap = np.where(long, opens <= stops, opens >= stops)
+        limit_gap = np.where(long, opens >= limits, opens <= limits)
+        if self.tie_rule == "stop":
+            reason = np.full(opens.shape[0], STOP)
+        elif self.tie_rule == "limit":
+            reason = np.full(opens.shape[0], LIMIT)
+        else:
+            reason = np.where(np.abs(opens - stops) <= np.abs(limits - opens),
+                              STOP, LIMIT)
+        reason[stop_gap] = STOP
+        reason[limit_gap] = LIMIT
+        return reason
+
+
+# external use :
+def resolve(data, entry_indexes, actions, stp_prices, lmt_prices,
+            tie_rule="stop"):
+    """
+    finds the exit of bracket trades (see BracketSimulator.resolve). Use a
+    BracketSimulator to resolve several batches of trades on the same data.
+    """
+    simulator = BracketSimulator(data, tie_rule)
+    return simulator.resolve(entry_indexes, actions, stp_prices, lmt_prices)
+
+
+# internal use :
+def get_sides(actions):
+    actions = np.asarray(actions)
+    if actions.dtype.kind in "US":
+        return np.where(actions == "BUY", 1, -1)
+    return np.sign(actions).astype(np.int64)
+
+
+def sparse_table(values, function, dtype=np.float32):
+    """
+    returns [values, f over windows of 2, f over windows of 4, ...], the
+    window starting at each index (f is np.minimum or np.maximum). The
+    values are rounded to dtype down for np.minimum and up for np.maximum,
+    so the table bounds the exact values.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    rounded = values.astype(dtype)
+    if function is np.minimum:
+        outside = rounded > values
+        rounded[outside] = np.nextafter(rounded[outside], dtype(-np.inf))
+    else:
+        outside = rounded < values
+        rounded[outside] = np.nextafter(rounded[outside], dtype(np.inf))
+    table = [rounded]
+    width = 1
+    while 2 * width <= values.shape[0]:
+        previous = table[-1]
+        table.append(function(previous[:-width], previous[width:]))
+        width *= 2
+    return table
+
+
+def first_touch(table, starts, levels, below, values=None):
+    """
+    returns the first index >= start where the values reach the level
+    (<= level if below, else >=), the number of values if there's none.
+
+    Args:
+        table (list of np.ndarray): the sparse table of the values.
+        starts (np.ndarray): the first index of every search.
+        levels (np.ndarray): the level of every search.
+        below (bool): whether the values reach a level from above.
+        values (np.ndarray, optional): the exact values, when the table is
+        rounded (see sparse_table) : an index where only the rounded value
+        reaches the level is skipped. Defaults to None which means table[0].
+    """
+    positions = search_table(table, starts, levels, below)
+    if values is None:
+        return positions
+    while True:
+        found = positions < values.shape[0]
+        exact = values[np.where(found, positions, 0)]
+        wrong = np.flatnonzero(found & (exact > levels if below
+                                        else exact < levels))
+        if wrong.shape[0] == 0:
+            return positions
+        positions[wrong] = search_table(table, positions[wrong] + 1,
+                                        levels[wrong], below)
+
+
+def search_table(table, starts, levels, below):
+    """first_touch on the values of the table."""
+    nb_of_values = table[0].shape[0]
+    positions = starts.copy()
+    # no value of [start, position) reaches the level, positions jump
+    # over the windows that don't either, from the largest to the smallest
+    for k in range(len(table) - 1, -1, -1):
+        width = 1 << k
+        room = positions + width <= nb_of_values
+        values = table[k][np.where(room, positions, 0)]
+        missed = values > levels if below else values < levels
+        positions += width * (room & missed)
+    return positions
+
+
+# program :
+if __name__ == "__main__":
+    import time
+
+    def resolve_loop(data, entries, actions, stops, limits, tie_rule):
+        """one trade and one bar at a time, to check resolve."""
+        out = []
+        for entry, action, stop, limit in zip(entries, actions, stops,
+                                              limits):
+            long = action == "BUY"
+            for i in range(entry, data.shape[0]):
+                _, open_, high, low, _ = data[i]
+                stop_hit = low <= stop if long else high >= stop
+                limit_hit = high >= limit if long else low <= limit
+                if not (stop_hit or limit_hit):
+                    continue
+                stop_price = min(stop, open_) if long else max(stop, open_)
+                limit_price = max(limit, open_) if long else min(limit, open_)
+                if stop_hit and limit_hit:
+                    if (open_ <= stop) if long else (open_ >= stop):
+                        stop_hit = True
+                    elif (open_ >= limit) if long else (open_ <= limit):
+                        stop_hit = False
+                    elif tie_rule == "nearest":
+                        stop_hit = abs(open_ - stop) <= abs(limit - open_)
+                    else:
+                        stop_hit = tie_rule == "stop"
+                out.append((i, stop_price, "stop") if stop_hit else
+                           (i, limit_price, "limit"))
+                break
+            else:
+                out.append((data.shape[0] - 1, data[-1, 4], "end"))
+        return out
+
+    rng = np.random.default_rng(0)
+    nb_of_bars = 365 * 24 * 60
+    close = 1.2 + np.cumsum(rng.normal(0, 1e-4, nb_of_bars))
+    open_ = np.concatenate(([close[0]], close[:-1])) + \
+        rng.normal(0, 2e-5, nb_of_bars)
+    data = np.column_stack((1.6e9 + 60 * np.arange(nb_of_bars), open_,
+                            np.maximum(open_, close) + 5e-5,
+                            np.minimum(open_, close) - 5e-5, close))
+
+    nb_of_trades = 10000
+    entries = rng.integers(0, nb_of_bars, nb_of_trades)
+    actions = np.where(rng.random(nb_of_trades) < 0.5, "BUY", "SELL")
+    sides = np.where(actions == "BUY", 1, -1)
+    # tight levels for bars reaching both, wide ones for open trades
+    distances = rng.choice([3e-5, 1e-3, 0.5], (2, nb_of_trades),
+                           p=[0.3, 0.6, 0.1]) * \
+        rng.uniform(0.5, 1.5, (2, nb_of_trades))
+    stops = open_[entries] - sides * distances[0]
+    limits = open_[entries] + sides * distances[1]
+
+    start = time.perf_counter()
+    simulator = BracketSimulator(data)
+    built = time.perf_counter()
+    trades = simulator.resolve(entries, actions, stops, limits)
+    end = time.perf_counter()
+    print(f"{nb_of_trades} trades on {nb_of_bars} bars : sparse table "
+          f"{(built - start) * 1000:.0f} ms, resolve "
+          f"{(end - built) * 1000:.1f} ms")
+
+    for tie_rule in tie_rules:
+        simulator.tie_rule = tie_rule
+        trades = simulator.resolve(entries[:500], actions[:500], stops[:500],
+                                   limits[:500])
+        expected = resolve_loop(data, entries[:500], actions[:500],
+                                stops[:500], limits[:500], tie_rule)
+        same = all(i == exit_index and price == exit_price and
+                   reason == exit_reason for (i, price, reason), exit_index,
+                   exit_price, exit_reason in zip(
+                       expected, trades["exit_index"], trades["exit_price"],
+                       trades["reason"]))
+        assert same
+        print(f"tie rule {tie_rule:<8} same as a loop : {same}",
+              {str(reason): int((trades["reason"] == reason).sum())
+               for reason in reasons})
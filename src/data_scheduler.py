@@ -0,0 +1,353 @@
+from collections import deque
+import math
+import time
+
+import contract
+import log
+import request_registry
+
+"""
+This module will handle the scheduling of historical data requests so they
+respect the pacing limits of interactive brokers :
+https://interactivebrokers.github.io/tws-api/historical_limitations.html
+    - max 50 requests open at the same time,
+    - max 60 requests in any 10 minutes period,
+    - max 5 requests for the same contract in 2 seconds (the 6th is a
+        violation),
+    - no identical request within 15 seconds.
+When TWS still answers with a pacing violation (error 162), the request is
+sent again later and the scheduler backs off.
+"""
+
+# variables :
+max_in_flight = 50
+max_per_window = 60
+window = 10 * 60
+max_per_contract = 5
+contract_window = 2
+identical_request_delay = 15
+pacing_error_codes = (162, 420)
+backoff_start = 15
+backoff_max = 10 * 60
+max_attempts = 5
+
+
+class ScheduledRequest:
+    """
+    A historical data request waiting to be sent by the scheduler.
+
+    ...
+
+    Attributes
+    ----------
+    symbol, barsize, duration, end_datetime : str
+        The parameters of the request (see IBApi.reqHistoricalData).
+    keep_up_to_date : bool
+    reqId : int
+        The request Id of the last attempt, None before the first one.
+    attempts : int
+        The number of times the request has been sent.
+    not_before : float
+        The request can't be sent before this time (time.monotonic()).
+    """
+    __slots__ = ("symbol", "barsize", "duration", "end_datetime",
+                 "keep_up_to_date", "reqId", "attempts", "not_before")
+
+    def __init__(self, symbol, barsize, duration, end_datetime="",
+                 keep_up_to_date=False):
+        self.symbol = symbol
+        self.barsize = barsize
+        self.duration = duration
+        self.end_datetime = end_datetime
+        self.keep_up_to_date = keep_up_to_date
+        self.reqId = None
+        self.attempts = 0
+        self.not_before = 0
+
+    def __repr__(self):
+        return (f"ScheduledRequest({self.symbol!r}, {self.barsize!r}, "
+                f"{self.duration!r})")
+
+    @property
+    def key(self):
+        return (self.symbol, self.barsize, self.duration, self.end_datetime)
+
+
+class HistoricalDataScheduler:
+    """
+    Sends a batch of historical data requests while keeping as many requests
+    in flight as the pacing limits allow.
+
+    ...
+
+    Attributes
+    ----------
+    ib : IBApi
+    what_to_show : str
+        The type of data asked (i.e "BID", see the data_type setting).
+    request_timeout : float
+        Requests pending for longer than this are cancelled.
+    on_progress : function
+        Called as on_progress(done, total, eta) every time a request ends.
+    done : list of ScheduledRequest
+        The requests that ended (received, failed or cancelled).
+
+    Methods (external)
+    -------
+    run, progress
+    """
+
+    def __init__(self, ib, what_to_show="BID", request_timeout=60,
+                 on_progress=None):
+        self.ib = ib
+        self.what_to_show = what_to_show
+        self.request_timeout = request_timeout
+        self.on_progress = on_progress
+        self.done = []
+        self.total = 0
+        self.start_time = None
+        self.paused_until = 0
+        self.nb_of_pacing_errors = 0
+        self._sent_times = deque()
+        self._sent_times_by_symbol = {}
+        self._last_sent_by_key = {}
+
+    # external use
+    def run(self, requests, priority=None, timeout=None):
+        """
+        sends the requests and waits until all of them ended.
+
+        Args:
+            requests (list): ScheduledRequest objects or
+            (symbol, barsize, duration) tuples.
+            priority (list of str, optional): barsizes in the order they are
+            needed. Requests for the first barsize are sent first. Defaults
+            to None which means the requests are sent in order.
+            timeout (float, optional): max number of seconds for the whole
+            batch. The requests still pending after it are cancelled.
+
+        Returns:
+            list of ScheduledRequest: the requests, in the order they ended.
+        """
+        queue = [r if isinstance(r, ScheduledRequest) else ScheduledRequest(*r)
+                 for r in requests]
+        if priority:
+            def rank(r):
+                return priority.index(r.barsize) if r.barsize in priority \
+                    else len(priority)
+            queue.sort(key=rank)
+        queue = deque(queue)
+
+        self.done = []
+        self.total = len(queue)
+        self.start_time = time.monotonic()
+        deadline = None if timeout == None else self.start_time + timeout
+        registry = self.ib.data_requests
+        in_flight = {}
+        seen = registry.changes()
+
+        while queue or in_flight:
+            now = time.monotonic()
+            self._collect(in_flight, queue, now)
+            wake_up = self._send(queue, in_flight, now)
+
+            if deadline != None and now >= deadline:
+                log.log("historical data batch timed out, cancelling " +
+                        f"{len(in_flight)} requests")
+                for job in list(in_flight.values()):
+                    self.ib.cancelHistoricalData(job.reqId)
+                self._collect(in_flight, queue, now)
+                self.done.extend(queue)
+                break
+
+            if not queue and not in_flight:
+                break
+            if self.request_timeout != None and in_flight:
+                wake_up = min(wake_up, self.request_timeout)
+            if deadline != None:
+                wake_up = min(wake_up, deadline - now)
+            seen = registry.wait_for_change(seen, max(wake_up, 0.001))
+
+        return self.done
+
+    def progress(self):
+        """
+        returns (done, total, eta), eta being the estimated number of seconds
+        before all the requests end (None before the first one ends).
+        """
+        nb_done = len(self.done)
+        remaining = self.total - nb_done
+        if nb_done == 0 or self.start_time == None:
+            return (nb_done, self.total, None)
+
+        elapsed = time.monotonic() - self.start_time
+        eta = elapsed / nb_done * remaining
+        # the pacing limits put a floor on the time left
+        free_slots = max_per_window - len(self._sent_times)
+        if remaining > free_slots:
+            eta = max(eta, math.ceil(
+                (remaining - free_slots) / max_per_window) * window)
+        return (nb_done, self.total, eta)
+
+    # internal use
+    def _collect(self, in_flight, queue, now):
+        """removes the requests that ended from in_flight."""
+        registry = self.ib.data_requests
+        for reqId, job in list(in_flight.items()):
+            request = registry.get(reqId)
+            if request != None and request.state == request_registry.PENDING:
+                if self.request_timeout != None and \
+                        now - request.start_time > self.request_timeout:
+                    log.log(f"no data after {self.request_timeout} secs for " +
+                            f"{job.symbol} {job.barsize}, cancelling")
+                    self.ib.cancelHistoricalData(reqId)
+                else:
+                    continue
+
+            del in_flight[reqId]
+            if request != None and is_pacing_error(request.error) and \
+                    job.attempts < max_attempts:
+                self.nb_of_pacing_errors += 1
+                backoff = min(backoff_start * 2 ** (job.attempts - 1),
+                              backoff_max)
+                log.log(f"pacing violation for {job.symbol} {job.barsize}, " +
+                        f"retrying in {backoff} secs")
+                job.not_before = now + backoff
+                self.paused_until = max(self.paused_until, now + backoff)
+                queue.appendleft(job)
+                continue
+
+            self.done.append(job)
+            if self.on_progress != None:
+                self.on_progress(*self.progress())
+
+    def _send(self, queue, in_flight, now):
+        """
+        sends the queued requests allowed by the pacing limits.
+
+        Returns:
+            float: the number of seconds before the next request can be sent.
+        """
+        wake_up = math.inf
+        while queue and len(in_flight) < max_in_flight:
+            delay = self._global_delay(now)
+            if delay > 0:
+                return min(wake_up, delay)
+
+            job = None
+            for candidate in queue:
+                delay = self._delay(candidate, now)
+                if delay <= 0:
+                    job = candidate
+                    break
+                wake_up = min(wake_up, delay)
+            if job == None:
+                return wake_up
+
+            queue.remove(job)
+            self._submit(job, now)
+            in_flight[job.reqId] = job
+        return wake_up
+
+    def _global_delay(self, now):
+        while self._sent_times and self._sent_times[0] <= now - window:
+            self._sent_times.popleft()
+        delay = self.paused_until - now
+        if len(self._sent_times) >= max_per_window:
+            delay = max(delay, self._sent_times[0] + window - now)
+        return delay
+
+    def _delay(self, job, now):
+        delay = job.not_before - now
+        sent_times = self._sent_times_by_symbol.get(job.symbol)
+        if sent_times:
+            while sent_times and sent_times[0] <= now - contract_window:
+                sent_times.popleft()
+            if len(sent_times) >= max_per_contract:
+                delay = max(delay, sent_times[0] + contract_window - now)
+        last_sent = self._last_sent_by_key.get(job.key)
+        if last_sent != None:
+            delay = max(delay, last_sent + identical_request_delay - now)
+        return delay
+
+    def _submit(self, job, now):
+        reqId = self.ib.nextReqId
+        self.ib.nextReqId += 1
+        job.reqId = reqId
+        job.attempts += 1
+        self._sent_times.append(now)
+        self._sent_times_by_symbol.setdefault(job.symbol, deque()).append(now)
+        self._last_sent_by_key[job.key] = now
+
+        self.ib.data_requests.add(reqId, job.symbol, job.barsize)
+        self.ib.reqHistoricalData(reqId, contract.get_contract(job.symbol),
+                                  job.end_datetime, job.duration, job.barsize,
+                                  self.what_to_show, 0, 2,
+                                  job.keep_up_to_date, [])
+
+
+# internal use :
+def is_pacing_error(error):
+    if error == None:
+        return False
+    errorCode, errorMsg = error
+    return errorCode in pacing_error_codes and "pacing" in errorMsg.lower()
+
+
+# program :
+if __name__ == "__main__":
+    # runs the scheduler against a fake client answering every request
+    # after a random delay, with some pacing violations.
+    import random
+    import threading
+
+    from request_registry import RequestRegistry
+
+    class FakeClient:
+        def __init__(self):
+            self.nextReqId = 0
+            self.data_requests = RequestRegistry()
+            self.max_in_flight = 0
+            self.sent = []
+
+        def reqHistoricalData(self, reqId, contract, endDateTime,
+                              durationStr, barSizeSetting, whatToShow, useRTH,
+                              formatDate, keepUpToDate, chartOptions):
+            self.data_requests.start(reqId, keepUpToDate)
+            self.sent.append(self.data_requests.get_info(reqId))
+            self.max_in_flight = max(self.max_in_flight,
+                                     len(self.data_requests.pending()))
+            delay = random.uniform(0.01, 0.2)
+            if random.random() < 0.1:
+                timer = threading.Timer(delay, self.data_requests.fail, (
+                    reqId, 162, "Historical Market Data Service error " +
+                    "message:API historical data query cancelled: pacing "
+                    "violation"))
+            else:
+                timer = threading.Timer(delay, self.data_requests.end,
+                                        (reqId,))
+            timer.start()
+
+        def cancelHistoricalData(self, reqId):
+            self.data_requests.cancel(reqId)
+
+    # scaled down limits so the demo runs in a few seconds
+    window, max_per_window, backoff_start = 2, 30, 0.2
+    identical_request_delay = 0.5
+    pairs = ["EUR/USD", "GBP/AUD", "GBP/USD", "GBP/JPY", "GBP/CAD", "USD/JPY"]
+    tfs = [("1 min", "1 W"), ("5 mins", "2 M"), ("15 mins", "2 M"),
+           ("1 hour", "2 M"), ("4 hours", "6 M"), ("1 day", "2 Y")]
+    batch = [(p, bs, d) for p in pairs for bs, d in tfs]
+
+    def print_progress(done, total, eta):
+        eta = "?" if eta == None else f"{eta:.1f}s"
+        print(f"{done}/{total} requests, eta {eta}")
+
+    client = FakeClient()
+    scheduler = HistoricalDataScheduler(client, on_progress=print_progress)
+    start = time.monotonic()
+    done = scheduler.run(batch, priority=["1 hour", "4 hours"])
+    print(f"{len(done)} requests in {time.monotonic() - start:.1f}s, "
+          f"{len(client.sent)} sent, {scheduler.nb_of_pacing_errors} "
+          f"pacing errors, max {client.max_in_flight} in flight")
+    print("first requests sent :", client.sent[:3])
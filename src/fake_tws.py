@@ -0,0 +1,582 @@
+import calendar
+import heapq
+import itertools
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+from ibapi.message import IN, OUT
+from ibapi.server_versions import MAX_CLIENT_VER
+
+from bar_dates import barsize_to_seconds, duration_to_seconds
+
+"""
+This module will handle a local stand-in for TWS / IB Gateway, to test
+IBApi, session.start_session and market_data.ask_data without a broker or a
+network : it speaks the part of the IB wire protocol the bot uses.
+    - the handshake, nextValidId and managedAccounts,
+    - historical data requests, answered with the bars of an array (i.e
+        data.market_data) or generated ones, after a configurable latency,
+        with pacing violations (error 162) at a random rate and/or over a
+        number of requests per window, and bar updates for keepUpToDate
+        requests,
+    - orders, acknowledged with orderStatus. Market orders are filled at
+        the last close served for the symbol (execDetails and
+        commissionReport), limit and stop orders stay working until they are
+        cancelled. Orders sent with transmit=False are held until an order
+        of the same bracket is transmitted (see orders.bracket_order).
+    - account updates with a few account values.
+The messages are encoded for the server version MAX_CLIENT_VER of the
+installed ibapi, the clients must support it.
+
+Usage :
+    with FakeTWS(latency=(0.01, 0.05), pacing_error_rate=0.05) as tws:
+        ib.connect("127.0.0.1", tws.port, 0)
+"""
+
+# variables :
+server_version = MAX_CLIENT_VER
+pacing_error = (162, "Historical Market Data Service error message:API "
+                "historical data query cancelled: pacing violation")
+max_bars = 100_000  # max number of generated bars per request
+account_values = [("TotalCashBalance", "10000", "USD"),
+                  ("CashBalance", "10000", "USD"),
+                  ("RealizedPnL", "0", "USD"), ("UnrealizedPnL", "0", "USD")]
+
+
+class FakeTWS:
+    """
+    A local server answering the IB API clients like TWS.
+
+    ...
+
+    Attributes
+    ----------
+    host, port : str, int
+        The address the clients connect to. port=0 picks a free port.
+    bars : np.ndarray or function
+        The bars served for every historical data request (format of
+        market_data.get_data, only the bars of the requested duration are
+        sent), or a function (symbol, barsize, duration, end_timestamp) ->
+        bars. Defaults to None which means generated bars (see
+        generate_bars).
+    latency : float or tuple
+        The delay in seconds before every answer, or (min, max) for a
+        random delay.
+    pacing_error_rate : float
+        The probability of answering a historical data request with a
+        pacing violation.
+    max_per_window : int
+        Historical data requests over this number in {{window}} seconds are
+        answered with a pacing violation. None for no limit.
+    window : float
+    update_interval : float
+        The seconds between 2 bar updates of the keepUpToDate requests. None
+        for no updates.
+    next_valid_id : int
+        The first order Id given to the clients.
+    account : str
+
+    Methods (external)
+    -------
+    start, stop, stats
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, bars=None, latency=0.0,
+                 pacing_error_rate=0.0, max_per_window=None, window=600,
+                 update_interval=None, next_valid_id=1, account="DU1234567",
+                 seed=None):
+        self.host = host
+        self.port = port
+        self.bars = bars
+        self.latency = latency
+        self.pacing_error_rate = pacing_error_rate
+        self.max_per_window = max_per_window
+        self.window = window
+        self.update_interval = update_interval
+        self.next_valid_id = next_valid_id
+        self.account = account
+        self.random = random.Random(seed)
+        self.nb_of_connections = 0
+        self.nb_of_data_requests = 0
+        self.nb_of_pacing_errors = 0
+        self.nb_of_orders = 0
+        self.nb_of_fills = 0
+        self.prices = {}  # the last close served for every symbol
+        self._request_times = []
+        self._events = []
+        self._event_ids = itertools.count()
+        self._events_changed = threading.Condition()
+        self._lock = threading.Lock()
+        self._server = None
+        self._running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # external use
+    def start(self):
+        self._server = ThreadingServer((self.host, self.port), ClientHandler)
+        self._server.tws = self
+        self.port = self._server.server_address[1]
+        self._running = True
+        threading.Thread(target=self._server.serve_forever, daemon=True,
+                         name="fake tws").start()
+        threading.Thread(target=self._run_events, daemon=True,
+                         name="fake tws events").start()
+
+    def stop(self):
+        if self._server == None:
+            return
+        self._running = False
+        with self._events_changed:
+            self._events_changed.notify_all()
+        self._server.shutdown()
+        self._server.close_all()
+        self._server.server_close()
+        self._server = None
+
+    def stats(self):
+        """returns the counters of the server in a dict."""
+        return {"connections": self.nb_of_connections,
+                "data_requests": self.nb_of_data_requests,
+                "pacing_errors": self.nb_of_pacing_errors,
+                "orders": self.nb_of_orders, "fills": self.nb_of_fills}
+
+    # internal use
+    def schedule(self, delay, function, *args):
+        """calls function(*args) after delay seconds, in the events thread."""
+        with self._events_changed:
+            heapq.heappush(self._events, (time.monotonic() + delay,
+                                          next(self._event_ids), function,
+                                          args))
+            self._events_changed.notify()
+
+    def get_delay(self):
+        if isinstance(self.latency, tuple):
+            return self.random.uniform(*self.latency)
+        return self.latency
+
+    def is_paced(self):
+        """counts a historical data request, True if it must be refused."""
+        with self._lock:
+            self.nb_of_data_requests += 1
+            now = time.monotonic()
+            if self.max_per_window != None:
+                self._request_times = [t for t in self._request_times
+                                       if now - t < self.window]
+                if len(self._request_times) >= self.max_per_window:
+                    self.nb_of_pacing_errors += 1
+                    return True
+                self._request_times.append(now)
+            if self.random.random() < self.pacing_error_rate:
+                self.nb_of_pacing_errors += 1
+                return True
+            return False
+
+    def get_bars(self, symbol, barsize, duration, end):
+        if callable(self.bars):
+            return self.bars(symbol, barsize, duration, end)
+        if not isinstance(self.bars, np.ndarray):
+            return generate_bars(symbol, barsize, duration, end)
+        bars = self.bars
+        if end == None:
+            end = bars[-1, 0]
+        start = end - duration_to_seconds(duration)
+        return bars[(bars[:, 0] > start) & (bars[:, 0] <= end)]
+
+    def _run_events(self):
+        while self._running:
+            with self._events_changed:
+                while self._running and (
+                        not self._events or
+                        self._events[0][0] > time.monotonic()):
+                    timeout = None if not self._events else \
+                        self._events[0][0] - time.monotonic()
+                    self._events_changed.wait(timeout)
+                if not self._running:
+                    return
+                _, _, function, args = heapq.heappop(self._events)
+            try:
+                function(*args)
+            except OSError:
+                pass  # the client disconnected
+
+
+class ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.clients = set()
+
+    def close_all(self):
+        for client in list(self.clients):
+            client.close()
+
+
+class ClientHandler(socketserver.BaseRequestHandler):
+    """
+    One client connection : decodes its messages and answers them.
+    """
+
+    def setup(self):
+        self.tws = self.server.tws
+        self.server.clients.add(self)
+        self.tws.nb_of_connections += 1
+        self.send_lock = threading.Lock()
+        self.clientId = None
+        self.orders = {}
+        self.held_orders = {}  # parentId -> orders sent with transmit=False
+        self.updated_requests = set()
+        self.handlers = {
+            OUT.START_API: self.start_api,
+            OUT.REQ_IDS: self.req_ids,
+            OUT.REQ_HISTORICAL_DATA: self.req_historical_data,
+            OUT.CANCEL_HISTORICAL_DATA: self.cancel_historical_data,
+            OUT.PLACE_ORDER: self.place_order,
+            OUT.CANCEL_ORDER: self.cancel_order,
+            OUT.REQ_ACCT_DATA: self.req_account_updates,
+        }
+
+    def handle(self):
+        buffer = b""
+        handshake_done = False
+        while True:
+            try:
+                chunk = self.request.recv(65536)
+            except OSError:
+                return
+            if not chunk:
+                return
+            buffer += chunk
+            if not handshake_done:
+                if not buffer.startswith(b"API\0"):
+                    if len(buffer) >= 4:
+                        return
+                    continue
+                message, buffer = read_message(buffer[4:])
+                if message == None:
+                    buffer = b"API\0" + buffer
+                    continue
+                if not self.handshake(message):
+                    return
+                handshake_done = True
+            while True:
+                message, buffer = read_message(buffer)
+                if message == None:
+                    break
+                fields = [f.decode("ascii", "replace")
+                          for f in message.split(b"\0")[:-1]]
+                if fields:
+                    handler = self.handlers.get(int(fields[0]))
+                    if handler != None:
+                        handler(fields)
+
+    def finish(self):
+        self.server.clients.discard(self)
+        self.updated_requests.clear()
+
+    def close(self):
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def send(self, *fields):
+        text = "".join(f"{field}\0" for field in fields).encode("ascii")
+        with self.send_lock:
+            self.request.sendall(struct.pack("!I", len(text)) + text)
+
+    def send_later(self, *fields):
+        self.tws.schedule(self.tws.get_delay(), self.send, *fields)
+
+    def send_error(self, reqId, errorCode, errorMsg):
+        self.send(IN.ERR_MSG, 2, reqId, errorCode, errorMsg)
+
+    # connection
+    def handshake(self, message):
+        """answers the "v100..157" versions of the client."""
+        versions = message.decode("ascii").split()[0][1:]
+        low, high = (int(v) for v in versions.split(".."))
+        if not low <= server_version <= high:
+            return False
+        self.send(server_version, time.strftime("%Y%m%d %H:%M:%S %Z"))
+        return True
+
+    def start_api(self, fields):
+        self.clientId = int(fields[2])
+        self.send(IN.NEXT_VALID_ID, 1, self.get_order_ids(1))
+        self.send(IN.MANAGED_ACCTS, 1, self.tws.account)
+
+    def req_ids(self, fields):
+        self.send_later(IN.NEXT_VALID_ID, 1, self.get_order_ids(1))
+
+    def get_order_ids(self, nb_of_ids):
+        with self.tws._lock:
+            orderId = self.tws.next_valid_id
+            self.tws.next_valid_id += nb_of_ids
+            return orderId
+
+    def req_account_updates(self, fields):
+        if fields[2] != "1":
+            return
+        for key, value, currency in account_values:
+            self.send_later(IN.ACCT_VALUE, 2, key, value, currency,
+                            self.tws.account)
+        self.send_later(IN.ACCT_DOWNLOAD_END, 1, self.tws.account)
+
+    # historical data
+    def req_historical_data(self, fields):
+        reqId = int(fields[1])
+        symbol = f"{fields[3]}/{fields[11]}"
+        end_datetime, barsize, duration = fields[15:18]
+        formatDate, keep_up_to_date = fields[20], fields[21] == "1"
+        delay = self.tws.get_delay()
+        if self.tws.is_paced():
+            self.tws.schedule(delay, self.send_error, reqId, *pacing_error)
+            return
+
+        end = None
+        if end_datetime:
+            end = calendar.timegm(time.strptime(end_datetime,
+                                                "%Y%m%d-%H:%M:%S"))
+        bars = self.tws.get_bars(symbol, barsize, duration, end)
+        if bars.shape[0]:
+            self.tws.prices[symbol] = bars[-1, 4]
+        daily = barsize_to_seconds(barsize) >= 86400
+        dates = format_dates(bars[:, 0], formatDate, daily)
+        message = [IN.HISTORICAL_DATA, reqId,
+                   format_dates([bars[0, 0] if bars.shape[0] else 0], 1)[0],
+                   format_dates([bars[-1, 0] if bars.shape[0] else 0], 1)[0],
+                   bars.shape[0]]
+        for date, bar in zip(dates, bars[:, 1:].tolist()):
+            message += [date, *bar, -1, -1, -1]
+        self.tws.schedule(delay, self.send, *message)
+
+        if keep_up_to_date and self.tws.update_interval != None and \
+                bars.shape[0]:
+            self.updated_requests.add(reqId)
+            self.tws.schedule(delay + self.tws.update_interval,
+                              self.send_update, reqId, symbol, bars[-1],
+                              formatDate, daily)
+
+    def send_update(self, reqId, symbol, bar, formatDate, daily):
+        """revises the last bar with a new close, then schedules the next."""
+        if reqId not in self.updated_requests:
+            return
+        close = bar[4] * (1 + self.tws.random.gauss(0, 1e-4))
+        bar = np.array([bar[0], bar[1], max(bar[2], close),
+                        min(bar[3], close), close])
+        self.tws.prices[symbol] = close
+        date = format_dates([bar[0]], formatDate, daily)[0]
+        self.send(IN.HISTORICAL_DATA_UPDATE, reqId, -1, date, bar[1], bar[4],
+                  bar[2], bar[3], -1, -1)
+        self.tws.schedule(self.tws.update_interval, self.send_update, reqId,
+                          symbol, bar, formatDate, daily)
+
+    def cancel_historical_data(self, fields):
+        self.updated_requests.discard(int(fields[2]))
+
+    # orders
+    def place_order(self, fields):
+        """
+        reads the fields of the order up to its parentId and its cashQty
+        (the 9th field from the end at server version 157).
+        """
+        order = {"orderId": int(fields[1]), "symbol": fields[3],
+                 "secType": fields[4], "exchange": fields[9],
+                 "currency": fields[11], "action": fields[16],
+                 "totalQuantity": float(fields[17] or 0),
+                 "orderType": fields[18], "lmtPrice": fields[19],
+                 "auxPrice": fields[20], "transmit": fields[27] == "1",
+                 "parentId": int(fields[28] or 0),
+                 "cashQty": float(fields[-9] or 0) if len(fields) > 40 else 0,
+                 "status": None, "filled": 0.0}
+        self.tws.nb_of_orders += 1
+        group = order["parentId"] or order["orderId"]
+        if not order["transmit"]:
+            self.held_orders.setdefault(group, []).append(order)
+            return
+        for held_order in self.held_orders.pop(group, []):
+            self.submit(held_order)
+        self.submit(order)
+
+    def submit(self, order):
+        self.orders[order["orderId"]] = order
+        parent = self.orders.get(order["parentId"])
+        if order["orderType"] == "MKT":
+            self.tws.schedule(self.tws.get_delay(), self.fill, order)
+        elif parent != None and parent["status"] != "Filled":
+            self.set_status(order, "PreSubmitted")
+        else:
+            self.set_status(order, "Submitted")
+
+    def fill(self, order):
+        if order["status"] == "Cancelled":
+            return
+        symbol = f"{order['symbol']}/{order['currency']}"
+        price = float(self.tws.prices.get(symbol, 1.0))
+        quantity = order["totalQuantity"] or order["cashQty"] / price
+        order["filled"] = quantity
+        self.tws.nb_of_fills += 1
+        execId = f"0000{order['orderId']:08x}.{time.time():.6f}"
+        side = "BOT" if order["action"] == "BUY" else "SLD"
+        self.send(IN.EXECUTION_DATA, -1, order["orderId"], 0,
+                  order["symbol"], order["secType"], "", 0.0, "", "",
+                  order["exchange"], order["currency"], "", "", execId,
+                  time.strftime("%Y%m%d  %H:%M:%S"), self.tws.account,
+                  order["exchange"], side, quantity, price,
+                  order["orderId"], self.clientId, 0, quantity, price, "",
+                  "", "", "", 0)
+        self.set_status(order, "Filled", price)
+        self.send(IN.COMMISSION_REPORT, 1, execId, 2.0, "USD", 0.0, 0.0, 0)
+        for child in self.orders.values():
+            if child["parentId"] == order["orderId"] and \
+                    child["status"] == "PreSubmitted":
+                self.set_status(child, "Submitted")
+
+    def set_status(self, order, status, price=0.0):
+        order["status"] = status
+        quantity = order["totalQuantity"] or order["cashQty"]
+        remaining = 0.0 if status in ("Filled", "Cancelled") else quantity
+        self.send(IN.ORDER_STATUS, order["orderId"], status, order["filled"],
+                  remaining, price, order["orderId"], order["parentId"],
+                  price, self.clientId, "", 0.0)
+
+    def cancel_order(self, fields):
+        order = self.orders.get(int(fields[2]))
+        if order == None or order["status"] in ("Filled", "Cancelled"):
+            self.send_later(IN.ERR_MSG, 2, int(fields[2]), 135,
+                            "Can't find order with id =" + fields[2])
+            return
+        self.tws.schedule(self.tws.get_delay(), self.set_status, order,
+                          "Cancelled")
+
+
+# external use :
+def generate_bars(symbol, barsize, duration, end=None):
+    """
+    returns a random walk of bars, always the same for a symbol, barsize
+    and end.
+
+    Args:
+        symbol (str): The security's symbol (i.e "EUR/USD").
+        barsize (str): The barsize (i.e "1 hour").
+        duration (str): The duration of the request (i.e "2 D").
+        end (float, optional): the timestamp of the end. Defaults to None
+        which means now.
+    """
+    bar_seconds = barsize_to_seconds(barsize)
+    end = time.time() if end == None else end
+    nb_of_bars = int(min(duration_to_seconds(duration) // bar_seconds,
+                         max_bars))
+    last = end // bar_seconds * bar_seconds
+    timestamps = last - bar_seconds * np.arange(nb_of_bars - 1, -1, -1)
+    rng = np.random.default_rng(
+        [zlib.crc32(f"{symbol} {barsize}".encode()), int(last)])
+    sigma = 1e-4 * np.sqrt(bar_seconds / 60)
+    close = np.exp(np.cumsum(rng.normal(0, sigma, nb_of_bars)))
+    open_ = np.concatenate(([1.0], close[:-1]))
+    spread = np.abs(rng.normal(0, sigma / 2, (2, nb_of_bars)))
+    return np.column_stack((timestamps, open_,
+                            np.maximum(open_, close) * (1 + spread[0]),
+                            np.minimum(open_, close) * (1 - spread[1]),
+                            close))
+
+
+# internal use :
+def read_message(buffer):
+    """returns (the first length prefixed message or None, the rest)."""
+    if len(buffer) < 4:
+        return None, buffer
+    size = struct.unpack("!I", buffer[:4])[0]
+    if len(buffer) < 4 + size:
+        return None, buffer
+    return buffer[4:4 + size], buffer[4 + size:]
+
+
+def format_dates(timestamps, formatDate, daily=False):
+    """formats timestamps like the BarData.date sent by TWS."""
+    if str(formatDate) == "2" and not daily:
+        return [str(int(t)) for t in timestamps]
+    date_format = "%Y%m%d" if daily else "%Y%m%d  %H:%M:%S"
+    return [time.strftime(date_format, time.localtime(t)) for t in timestamps]
+
+
+# program :
+if __name__ == "__main__":
+    # load test : an IBApi client asks the data of hundreds of requests
+    # through market_data.ask_data, then places a bracket order.
+    import data_scheduler
+    import ib_interface
+    import log
+    import market_data
+    from ibapi.order import Order
+
+    import contract
+
+    log.log = lambda *k, **kw: None
+    data_scheduler.backoff_start = 0.05
+    data_scheduler.identical_request_delay = 0
+    data_scheduler.window, data_scheduler.max_per_window = 2, 300
+
+    with FakeTWS(latency=(0.005, 0.05), pacing_error_rate=0.05,
+                 update_interval=0.2, seed=0) as tws:
+        ib = ib_interface.IBApi()
+        ib.connect("127.0.0.1", tws.port, 0)
+        threading.Thread(target=ib.run, daemon=True).start()
+        start = time.monotonic()
+        while ib.nextOrderId == 0 and time.monotonic() - start < 5:
+            time.sleep(0.01)
+        print(f"connected in {(time.monotonic() - start) * 1000:.0f} ms, "
+              f"next order id {ib.nextOrderId}")
+
+        symbols = [f"{a}/{b}" for a in ("EUR", "GBP", "AUD", "NZD", "CAD",
+                                         "CHF", "JPY", "NOK")
+                   for b in ("USD", "SEK", "DKK", "SGD", "HKD", "MXN")]
+        timeframes = [("1 min", "2 D"), ("5 mins", "1 W"), ("1 hour", "1 M"),
+                      ("1 day", "1 Y")]
+        start = time.monotonic()
+        market_data.ask_data(ib, symbols, timeframes, timeout=20,
+                             use_cache=False)
+        elapsed = time.monotonic() - start
+        received = sum(ib.market.get(s, bs) != None and
+                       ib.market.get(s, bs).size > 0
+                       for s in symbols for bs, _ in timeframes)
+        print(f"{len(symbols) * len(timeframes)} requests in {elapsed:.2f} s, "
+              f"{received} series received, "
+              f"{tws.nb_of_pacing_errors} pacing errors retried")
+
+        orders = []
+        for orderType, transmit in (("MKT", True), ("LMT", False),
+                                    ("STP", True)):
+            order = Order()
+            order.orderId = ib.nextOrderId
+            ib.nextOrderId += 1
+            order.action = "BUY" if orderType == "MKT" else "SELL"
+            order.orderType = orderType
+            order.totalQuantity = 20000
+            order.lmtPrice = 2.0 if orderType == "LMT" else order.lmtPrice
+            order.auxPrice = 0.5 if orderType == "STP" else order.auxPrice
+            order.parentId = orders[0].orderId if orders else 0
+            order.transmit = transmit
+            orders.append(order)
+            ib.placeOrder(order.orderId, contract.get_contract("EUR/USD"),
+                          order)
+        time.sleep(0.3)
+        print("order status :", {o.orderId: ib.orders[o.orderId].status
+                                 for o in orders},
+              "fill price :", ib.orders[orders[0].orderId].avgFillPrice)
+        print(tws.stats())
+        ib.disconnect()
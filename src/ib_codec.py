@@ -0,0 +1,37 @@
+from ibapi.commission_report import CommissionReport
+from ibapi.contract import Contract
+from ibapi.execution import Execution
+from ibapi.order import Order
+
+"""
+This module will handle the encoding of the ibapi objects stored in the
+journals (see order_journal and recorder) : an object is stored as its class
+name and its attributes that differ from a new object, which is smaller and
+faster to pickle than the whole object.
+"""
+
+# variables :
+ib_classes = {"Contract": Contract, "Order": Order, "Execution": Execution,
+              "CommissionReport": CommissionReport}
+defaults = {name: vars(cls()) for name, cls in ib_classes.items()}
+
+
+# external use :
+def encode_object(obj):
+    """returns (class name, attributes that differ from a new object)."""
+    if obj == None:
+        return None
+    name = type(obj).__name__
+    default = defaults[name]
+    return name, {key: value for key, value in vars(obj).items()
+                  if key not in default or default[key] != value}
+
+
+def decode_object(encoded):
+    """rebuilds an object encoded by encode_object."""
+    if encoded == None:
+        return None
+    name, attributes = encoded
+    obj = ib_classes[name]()
+    obj.__dict__.update(attributes)
+    return obj
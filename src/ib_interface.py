@@ -1,4 +1,3 @@
-from datetime import datetime
 import threading
 import time
 
@@ -8,12 +7,21 @@ from ibapi.wrapper import EWrapper
 from ibapi.client import EClient
 
 import log
+from bar_store import BarStore
+from indicator_cache import IndicatorCache
+from order_store import OrderStore
+from bar_dates import to_timestamp, to_timestamps
+from request_registry import RequestRegistry
 
 """
 This module will handle the IBAccount class ; the interface between the
 application and the broker (interactive broker)
 """
 
+# variables :
+# the errors that only concern historical data requests
+data_error_codes = (162, 165, 166, 321, 322, 366, 386)
+
 
 class IBApi(EWrapper, EClient):
     """
@@ -33,21 +41,38 @@ class IBApi(EWrapper, EClient):
         Used to store a valid requestId. Needs to be incremented after each
         use.
 
-    active_data_reqs : int
-        Keeps track of the number of active market data requests. If it's
-        value = 0, there is no market data being send by interactive brokers.
+    active_data_reqs : int (read only)
+        The number of market data requests still waiting for their
+        historical data. If it's value = 0, there is no market data being
+        send by interactive brokers.
+
+    data_requests : RequestRegistry
+        Stores the symbol, the barsize, the state and some counters of every
+        market data request Id (see the request_registry module).
+
+    market : BarStore
+        Stores the bars received for every (symbol, barsize) in preallocated
+        numpy arrays (see the bar_store module).
+
+    bulk_ingestion : bool
+        If True, the bars of a historical data request are buffered and
+        converted all at once when the request ends (historicalDataEnd)
+        instead of one by one.
 
-    reqId_info : dict
-        Stores the symbol and the barsize of a market data request Id.
+    recorder : Recorder
+        Records the callbacks to a journal when set (see recorder and
+        session.start_session), None otherwise.
 
-    orders : dict
-        Large dictionnary that stores data about every order (the data returned
-        by the openOrder, orderStatus, execDetails and commissionReport
-        callbacks).
+    orders : OrderStore
+        Stores the data about every order (the data returned by the
+        openOrder, orderStatus, execDetails and commissionReport callbacks)
+        in an OrderRecord per order, indexed by orderId, permId, execId,
+        parentId and status (see the order_store module).
 
-        It's a large dictionnary with a key for every order (the key = the
-        orderId of the order). Every key has as value another dictionnary
-        with data about the order.
+    order_journal : OrderJournal
+        Journals the order events to disk when set, so the orders survive a
+        restart (see order_journal and session.start_session), None
+        otherwise.
 
     account : dict
         Another large dictionnary that stores data about the account (Data send
@@ -63,10 +88,14 @@ class IBApi(EWrapper, EClient):
         EClient.__init__(self, self)
         self.nextOrderId = 0
         self.nextReqId = 0
-        self.active_data_reqs = 0
-        self.reqId_info = {}
-        self.market = {}
-        self.orders = {}
+        self.data_requests = RequestRegistry()
+        self.market = BarStore()
+        self.indicators = IndicatorCache(self.market)
+        self.bulk_ingestion = True
+        self.bar_buffers = {}
+        self.recorder = None
+        self.orders = OrderStore()
+        self.order_journal = None
         self.account = {
             "AccountCode": np.nan,
             "AccountOrGroup": np.nan,
@@ -185,52 +214,70 @@ class IBApi(EWrapper, EClient):
             "TotalCashBalanceEvol": [], }
         self.portfolio = {}
 
+    @property
+    def active_data_reqs(self):
+        return len(self.data_requests.pending())
+
     # external use
 
     # internal use
-    def init_order(self, orderId):
+    def init_order(self, orderId, contract=None, order=None):
         """
-        creates a key in the order attribute for the order nb {{orderId}} so
-        the program can add data for this orderId.
+        registers the order nb {{orderId}} in the orders attribute so the
+        program can add data for this orderId.
 
         Args:
             orderId (int): the orderId of the order.
+            contract (Contract, optional): the contract of the order.
+            order (Order, optional): the order.
+
+        Returns:
+            OrderRecord: the record of the order.
         """
-        self.orders[orderId] = {
-            "contract": None,
-            "order": None,
-            "orderStatus": None,
-            "orderId": None,
-            "status": None,
-            "filled": None,
-            "remaining": None,
-            "avgFillPrice": None,
-            "permId": None,
-            "parentId": None,
-            "lastFillPrice": None,
-            "clientId": None,
-            "whyHeld": None,
-            "mktCapPrice": None,
-            "execution": None,
-            "commissionReport": None,
-        }
+        return self.orders.add(orderId, contract, order)
 
     def placeOrder(self, orderId, contract, order):
         """
         Places an order. official documentation :
         https://interactivebrokers.github.io/tws-api/order_submission.html#submission
         """
+        self.init_order(orderId, contract, order)
+        if self.order_journal != None:
+            self.order_journal.write_placement(orderId, contract, order)
         super().placeOrder(orderId, contract, order)
-        self.init_order(orderId)
 
     def reqHistoricalData(self, reqId, contract, endDateTime, durationStr,
                           barSizeSetting, whatToShow, useRTH, formatDate,
                           keepUpToDate, chartOptions):
+        # ready before sending, the answer can come before the call returns
+        self.data_requests.start(reqId, keepUpToDate)
+        info = self.data_requests.get_info(reqId)
+        if info not in self.market:
+            self.market.reset(*info)
+        self.bar_buffers.pop(reqId, None)
         super().reqHistoricalData(reqId, contract, endDateTime, durationStr,
                                   barSizeSetting, whatToShow, useRTH,
                                   formatDate, keepUpToDate, chartOptions)
-        self.market[reqId] = []
-        self.active_data_reqs += 1
+
+    def cancelHistoricalData(self, reqId):
+        super().cancelHistoricalData(reqId)
+        self.data_requests.cancel(reqId)
+        self.bar_buffers.pop(reqId, None)
+
+    def flush_bar_buffer(self, reqId):
+        """
+        converts the bars buffered for a request (see bulk_ingestion) and
+        adds them to the market data.
+        """
+        if reqId not in self.bar_buffers:
+            return
+        dates, prices = self.bar_buffers.pop(reqId)
+        bars = np.empty((len(dates), 5), dtype=np.float64)
+        bars[:, 0] = to_timestamps(dates)
+        bars[:, 1:] = prices
+        request = self.data_requests.get(reqId)
+        request.bars_received += len(dates)
+        self.market.get(*request.info).merge(bars)
 
     # EWrapper callbacks documentation: https://interactivebrokers.github.io/tws-api
     def nextValidId(self, orderId):
@@ -241,9 +288,7 @@ class IBApi(EWrapper, EClient):
     def openOrder(self, orderId, contract, order, orderState):
         super().openOrder(orderId, contract, order, orderState)
         log.log(f"received openOrder of order {orderId}")
-        self.orders[orderId]["contract"] = contract
-        self.orders[orderId]["order"] = order
-        self.orders[orderId]["orderState"] = orderState
+        self.orders.update_open_order(orderId, contract, order, orderState)
 
     def orderStatus(self, orderId, status, filled, remaining, avgFillPrice,
                     permId, parentId, lastFillPrice, clientId, whyHeld,
@@ -252,32 +297,33 @@ class IBApi(EWrapper, EClient):
                             permId, parentId, lastFillPrice, clientId, whyHeld,
                             mktCapPrice)
         log.log(f"received orderStatus of order {orderId}")
-        self.orders[orderId]["status"] = status
-        self.orders[orderId]["filled"] = filled
-        self.orders[orderId]["remaining"] = remaining
-        self.orders[orderId]["avgFillPrice"] = avgFillPrice
-        self.orders[orderId]["permId"] = permId
-        self.orders[orderId]["parentId"] = parentId
-        self.orders[orderId]["lastFillPrice"] = lastFillPrice
-        self.orders[orderId]["clientId"] = clientId
-        self.orders[orderId]["whyHeld"] = whyHeld
-        self.orders[orderId]["mktCapPrice"] = mktCapPrice
+        self.orders.update_status(orderId, status, filled, remaining,
+                                  avgFillPrice, permId, parentId,
+                                  lastFillPrice, clientId, whyHeld,
+                                  mktCapPrice)
+        if self.order_journal != None:
+            self.order_journal.write_status(orderId, status, filled,
+                                            remaining, avgFillPrice, permId,
+                                            parentId, lastFillPrice,
+                                            clientId, whyHeld, mktCapPrice)
 
     def execDetails(self, reqId, contract, execution):
         super().execDetails(reqId, contract, execution)
         log.log(f"received execDetails of order {execution.orderId}")
-        self.orders[execution.orderId]["execution"] = execution
+        self.orders.add_execution(execution, contract)
+        if self.order_journal != None:
+            self.order_journal.write_execution(execution, contract)
 
     def commissionReport(self, commissionReport):
         super().commissionReport(commissionReport)
-        found = False
-        for orderId in self.orders:
-            if self.orders[orderId]["execution"].execId == commissionReport.execId:
-                self.orders[orderId]["commissionReport"] = commissionReport
-                log.log(f"received commission report for order {orderId}")
-                found = True
-        if not found:
-            log.log("received commission report but couldn't find for which order")
+        record = self.orders.add_commission(commissionReport)
+        if self.order_journal != None:
+            self.order_journal.write_commission(commissionReport)
+        if record != None:
+            log.log(f"received commission report for order {record.orderId}")
+        else:
+            log.log("received commission report before its execution, or "
+                    "after its order was archived")
 
     def updateAccountValue(self, key, val, currency, accountName):
         super().updateAccountValue(key, val, currency, accountName)
@@ -312,33 +358,35 @@ class IBApi(EWrapper, EClient):
     def error(self, id, errorCode, errorMsg):
         super().error(id, errorCode, errorMsg)
         log.log(f"{errorCode} {errorMsg}", level="ERROR")
+        # codes >= 2100 are warnings, the request goes on. Order ids and
+        # request ids overlap : the error of a known order (i.e 201, order
+        # rejected) is only for a request if it's a historical data error
+        if id in self.data_requests and errorCode < 2100 and (
+                id not in self.orders or errorCode in data_error_codes):
+            self.bar_buffers.pop(id, None)
+            self.data_requests.fail(id, errorCode, errorMsg)
 
     def historicalData(self, reqId, bar):
-        if len(bar.date) == 8:
-            dt = datetime.strptime(bar.date, r"%Y%m%d")
-
-        else:
-            dt = datetime.strptime(bar.date, r"%Y%m%d %H:%M:%S")
-
-        timestamp = dt.timestamp()
-        new_data = [timestamp, bar.open, bar.high, bar.low, bar.close]
-        self.market[reqId].append(new_data)
+        if self.bulk_ingestion:
+            dates, prices = self.bar_buffers.setdefault(reqId, ([], []))
+            dates.append(bar.date)
+            prices.append((bar.open, bar.high, bar.low, bar.close))
+            return
+
+        timestamp = to_timestamp(bar.date)
+        request = self.data_requests.get(reqId)
+        request.bars_received += 1
+        series = self.market.get(*request.info)
+        series.upsert(timestamp, bar.open, bar.high, bar.low, bar.close)
 
     def historicalDataEnd(self, reqId, start, end):
         super().historicalDataEnd(reqId, start, end)
-        self.active_data_reqs -= 1
+        self.flush_bar_buffer(reqId)
+        self.data_requests.end(reqId)
 
     def historicalDataUpdate(self, reqId, bar):
-        if len(bar.date) == 8:
-            dt = datetime.strptime(bar.date, r"%Y%m%d")
-
-        else:
-            dt = datetime.strptime(bar.date, r"%Y%m%d %H:%M:%S")
-
-        timestamp = dt.timestamp()
-        new_data = [timestamp, bar.open, bar.high, bar.low, bar.close]
-        i_replace = [i for i, r in enumerate(
-            self.market[reqId]) if r[0] == timestamp]
-        for i in i_replace:
-            del self.market[reqId][i]
-        self.market[reqId].append(new_data)
+        timestamp = to_timestamp(bar.date)
+        request = self.data_requests.get(reqId)
+        request.updates_received += 1
+        series = self.market.get(*request.info)
+        series.upsert(timestamp, bar.open, bar.high, bar.low, bar.close)
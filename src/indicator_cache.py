@@ -0,0 +1,279 @@
+from collections import OrderedDict
+import threading
+
+import numpy as np
+
+import indicators
+from streaming_indicators import streaming_classes
+
+"""
+This module will handle the caching of the technical indicators computed on
+the market data, so the UI, the plots and the strategies asking for the same
+indicator don't compute it again.
+
+An entry is stored for every (symbol, barsize, indicator, params) with the
+size and version of the BarSeries it was computed on (see
+BarSeries.version). When the series only got new bars at the end or a
+revision of its last bar, the entry is extended with the streaming version
+of the indicator (see streaming_indicators) instead of being computed again
+from scratch. Any other change of the series invalidates it.
+The entries are evicted in least recently used order when their total size
+goes over max_bytes.
+"""
+
+# variables :
+default_max_bytes = 64 * 2**20
+
+
+class CacheEntry:
+    """
+    A cached indicator.
+
+    ...
+
+    Attributes
+    ----------
+    series : BarSeries
+        The series the indicator was computed on.
+    version : int
+        The version of the series at that time.
+    size : int
+        The number of bars of the series covered by the result.
+    result : np.ndarray
+        The output of the indicator. Only the first {{size}} rows are valid,
+        the other ones are room for the next bars.
+    streaming : StreamingIndicator
+        The state of the indicator after the {{size}} bars, None if the
+        indicator has no streaming version.
+    """
+    __slots__ = ("series", "version", "size", "result", "streaming")
+
+    def __init__(self, series, version, size, result, streaming):
+        self.series = series
+        self.version = version
+        self.size = size
+        self.result = result
+        self.streaming = streaming
+
+    @property
+    def nbytes(self):
+        return self.result.nbytes
+
+    def view(self):
+        """
+        returns a read-only view on the valid rows, no data is copied. Like
+        BarSeries.view, the last row of a view returned before an extension
+        changes when the last bar is revised, the other rows don't.
+        """
+        values = self.result[:self.size]
+        values.flags.writeable = False
+        return values
+
+
+class IndicatorCache:
+    """
+    Memoizes the functions of the indicators module for the market data of
+    a BarStore.
+
+    ...
+
+    Attributes
+    ----------
+    store : BarStore
+        The market data (IBApi.market).
+    max_bytes : int
+        The max total size of the cached results.
+    hits : int
+        The number of calls answered from the cache as is.
+    extensions : int
+        The number of calls answered by extending a cached result with the
+        new bars.
+    misses : int
+        The number of calls that computed the indicator from scratch.
+    evictions : int
+        The number of entries evicted to stay under max_bytes.
+
+    Methods (external)
+    -------
+    get, invalidate, clear, stats
+    """
+
+    def __init__(self, store, max_bytes=default_max_bytes):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.extensions = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # external use
+    def get(self, symbol, barsize, name, *params):
+        """
+        returns an indicator computed on all the bars of a symbol and
+        barsize.
+
+        Args:
+            symbol (str): The security's symbol (i.e "EUR/USD").
+            barsize (str): The barsize (i.e "1 hour").
+            name (str): the name of the function of the indicators module
+            (i.e "rsi", "bbands").
+            *params: the parameters of the function after data.
+
+        Returns:
+            np.ndarray: read-only array, the same as
+            indicators.{{name}}(data, *params). It's a view on the cached
+            result : its last row follows the revisions of the last bar
+            (see CacheEntry.view), copy it to keep the values.
+        """
+        series = self.store.get(symbol, barsize)
+        if series == None:
+            return getattr(indicators, name)(
+                np.empty((0, 5), dtype=np.float64), *params)
+
+        key = (symbol, barsize, name, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry != None and entry.series is series and \
+                    entry.version == series.version and \
+                    0 < entry.size <= series.size:
+                self._entries.move_to_end(key)
+                if self._extend(entry, series):
+                    self.extensions += 1
+                    self._evict()
+                    return entry.view()
+                if entry.size == series.size:
+                    self.hits += 1
+                    return entry.view()
+
+            self.misses += 1
+            entry = self._compute(series, name, params)
+            self._put(key, entry)
+            return entry.view()
+
+    def invalidate(self, symbol=None, barsize=None):
+        """
+        removes the entries of a symbol and/or barsize, or all of them.
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if (symbol == None or key[0] == symbol) and \
+                        (barsize == None or key[1] == barsize):
+                    self.nbytes -= self._entries.pop(key).nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self.nbytes = 0
+
+    def stats(self):
+        """returns the counters and the size of the cache in a dict."""
+        return {"entries": len(self._entries), "nbytes": self.nbytes,
+                "hits": self.hits, "extensions": self.extensions,
+                "misses": self.misses, "evictions": self.evictions}
+
+    # internal use
+    def _compute(self, series, name, params):
+        data = series.view()
+        result = getattr(indicators, name)(data, *params)
+        streaming = None
+        if name in streaming_classes and data.shape[0] > 0:
+            streaming = streaming_classes[name](*params)
+            streaming.warm_start(data, result)
+            # room for the next bars
+            grown = np.empty((max(result.shape[0] * 5 // 4, 16),
+                              result.shape[1]), dtype=np.float64)
+            grown[:result.shape[0]] = result
+            result = grown
+        return CacheEntry(series, series.version, data.shape[0], result,
+                          streaming)
+
+    def _extend(self, entry, series):
+        """
+        updates an entry with the new bars and the revision of the last bar.
+
+        Returns:
+            bool: False if there was nothing to update or the indicator has
+            no streaming version.
+        """
+        if entry.streaming == None:
+            return False
+        start = entry.size - 1
+        bars = series.view()[start:]
+        if bars.shape[0] == 1 and \
+                np.array_equal(bars[0], entry.streaming.pending):
+            return False
+
+        if series.size > entry.result.shape[0]:
+            grown = np.empty((series.size * 2, entry.result.shape[1]),
+                             dtype=np.float64)
+            grown[:entry.size] = entry.result[:entry.size]
+            self.nbytes += grown.nbytes - entry.result.nbytes
+            entry.result = grown
+        for i, bar in enumerate(bars):
+            entry.result[start + i] = entry.streaming.update(bar)
+        entry.size = series.size
+        return True
+
+    def _put(self, key, entry):
+        old_entry = self._entries.pop(key, None)
+        if old_entry != None:
+            self.nbytes -= old_entry.nbytes
+        self._entries[key] = entry
+        self.nbytes += entry.nbytes
+        self._evict()
+
+    def _evict(self):
+        """removes the least recently used entries over max_bytes."""
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            self.nbytes -= entry.nbytes
+            self.evictions += 1
+
+
+# program :
+if __name__ == "__main__":
+    # compares the cached indicators with the batch functions while the
+    # bars of the test data arrive one by one, with revisions of the last
+    # bar.
+    import time
+
+    from bar_store import BarStore
+    from data import market_data as test_data
+
+    cases = [("sma", (20,)), ("ema", (20,)), ("rsi", (14,)),
+             ("macd", (12, 26, 9)), ("bbands", (20, 2)), ("adx", (14,))]
+    store = BarStore()
+    series = store.reset("EUR/USD", "1 hour")
+    half = test_data.shape[0] // 2
+    series.extend(test_data[:half])
+    cache = IndicatorCache(store)
+    rng = np.random.default_rng(0)
+    same = {name: True for name, _ in cases}
+    times = {"cache": 0, "batch": 0}
+
+    for i in range(half, test_data.shape[0]):
+        revision = test_data[i].copy()
+        revision[4] += rng.normal(0, 1e-3)
+        series.upsert(*revision)
+        series.upsert(*test_data[i])
+        for name, params in cases:
+            start = time.perf_counter()
+            values = cache.get("EUR/USD", "1 hour", name, *params)
+            times["cache"] += time.perf_counter() - start
+            start = time.perf_counter()
+            expected = getattr(indicators, name)(series.view(), *params)
+            times["batch"] += time.perf_counter() - start
+            same[name] &= np.allclose(values, expected, rtol=1e-7,
+                                      atol=1e-9, equal_nan=True)
+        cache.get("EUR/USD", "1 hour", "rsi", 14)
+
+    print(same)
+    print(cache.stats())
+    print(f"cache : {times['cache'] * 1000:.1f} ms, "
+          f"batch : {times['batch'] * 1000:.1f} ms")
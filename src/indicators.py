@@ -7,6 +7,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 
 from vectorized_ema import ewma_vectorized_safe as ewma
+from vectorized_ema import ewma_vectorized_2d_safe as ewma_2d
 from data import market_data as test_data
 import plot
 import ib_interface
@@ -32,6 +33,11 @@ Rules for the function :
         np.ndarray([[timestamp, value1,...],
                     ...,
                     [timestamp, value1,...],])
+
+The grid functions (ema_grid, macd_grid) compute an indicator for many
+symbols and parameters at once. They take a matrix of closing prices (one
+row per symbol, see stack_closes) and return the values without the
+timestamps, in a cube indexed by [parameter set, symbol, bar].
 """
 
 
@@ -124,7 +130,11 @@ def adx(data, period=14):
     diminus = dmn[period-1:] / atr
     diminus = 100 * ewma(diminus, alpha)
 
-    ADX = np.abs(diplus - diminus) / (diplus + diminus)
+    # without any directional movement the index is 0, not 0 / 0 (a NaN
+    # would make every following value NaN)
+    total = diplus + diminus
+    ADX = np.divide(np.abs(diplus - diminus), total,
+                    out=np.zeros_like(total), where=total != 0)
     ADX = 100 * ewma(ADX, alpha)
 
     out = np.full((data.shape[0], 4), np.nan, dtype=np.float64)
@@ -136,23 +146,183 @@ def adx(data, period=14):
     return out
 
 
-# internal :
-def moving_average(a, n):
-    ret = np.cumsum(a)
-    ret[n:] = ret[n:] - ret[:-n]
-    return ret[n - 1:] / n
+def stack_closes(datas):
+    """
+    stacks the closing prices of several symbols in a matrix for the grid
+    functions. The series are aligned on their last bar and cut to the
+    length of the shortest one.
+
+    Args:
+        datas (list of np.ndarray): market data of every symbol (format of
+        market_data.get_data).
+
+    Returns:
+        np.ndarray: the closes, shape (nb of symbols, nb of bars).
+    """
+    nb_of_bars = min(data.shape[0] for data in datas)
+    closes = np.empty((len(datas), nb_of_bars), dtype=np.float64)
+    for i, data in enumerate(datas):
+        closes[i] = data[data.shape[0] - nb_of_bars:, 4]
+    return closes
+
+
+def ema_grid(closes, windows):
+    """
+    ema of every symbol for every window, in one vectorized pass.
+
+    Args:
+        closes (np.ndarray): closing prices, shape (nb of symbols, nb of
+        bars) (see stack_closes).
+        windows (list of int): the windows of the ema.
+
+    Returns:
+        np.ndarray: shape (nb of windows, nb of symbols, nb of bars) ;
+        out[i, j] is the same as ema(data of symbol j, windows[i])[:, 1].
+    """
+    closes = np.atleast_2d(np.asarray(closes, dtype=np.float64))
+    nb_of_symbols, nb_of_bars = closes.shape
+    alphas = 2 / (np.asarray(windows, dtype=np.float64) + 1)
+    nb_of_rows = alphas.shape[0] * nb_of_symbols
+    rows = np.broadcast_to(closes, (alphas.shape[0],) + closes.shape)
+    out = ewma_2d(rows.reshape(nb_of_rows, nb_of_bars),
+                  np.repeat(alphas, nb_of_symbols))
+    return out.reshape(alphas.shape[0], nb_of_symbols, nb_of_bars)
+
+
+def macd_grid(closes, params):
+    """
+    macd of every symbol for every parameter set. Each distinct ema window
+    is only computed once, whatever the number of parameter sets using it.
+
+    Args:
+        closes (np.ndarray): closing prices, shape (nb of symbols, nb of
+        bars) (see stack_closes).
+        params (list of tuple): (fast, slow, signal) parameter sets.
+
+    Returns:
+        np.ndarray: shape (nb of parameter sets, nb of symbols, nb of bars,
+        3) ; out[i, j] is the same as macd(data of symbol j,
+        *params[i])[:, 1:] (macd line, signal line, histogram).
+    """
+    closes = np.atleast_2d(np.asarray(closes, dtype=np.float64))
+    nb_of_symbols, nb_of_bars = closes.shape
+    params = np.asarray(params, dtype=np.int64).reshape(-1, 3)
+    windows, index = np.unique(params[:, :2], return_inverse=True)
+    index = index.reshape(-1, 2)
+    emas = ema_grid(closes, windows)
+
+    out = np.empty((params.shape[0], nb_of_symbols, nb_of_bars, 3),
+                   np.float64)
+    lines = emas[index[:, 0]] - emas[index[:, 1]]
+    signal_alphas = 2 / (params[:, 2] + 1)
+    signals = ewma_2d(
+        lines.reshape(params.shape[0] * nb_of_symbols, nb_of_bars),
+        np.repeat(signal_alphas, nb_of_symbols))
+    out[..., 0] = lines
+    out[..., 1] = signals.reshape(lines.shape)
+    out[..., 2] = out[..., 0] - out[..., 1]
+    return out
 
 
-def std(data, period):
+# internal :
+def moving_average(a, n):
+    return window_sums(a, n) / n
+
+
+def window_sums(a, n, block_size=1024):
+    """
+    returns the sum of every window of n values of a (len(a) - n + 1
+    values). The cumulative sums are restarted every block of values so
+    their rounding errors don't build up along long series.
+    """
+    if a.shape[0] < n:
+        return np.empty(0, dtype=np.float64)
+    rows = blocks(a, n, block_size)
+    block_size = rows.shape[1] - n + 1
+    sums = np.zeros((rows.shape[0], rows.shape[1] + 1), dtype=np.float64)
+    np.cumsum(rows, axis=1, out=sums[:, 1:])
+    sums = sums[:, n:] - sums[:, :block_size]
+    return sums.reshape(-1)[:a.shape[0] - n + 1]
+
+
+def rolling_std(a, n, ddof=0, block_size=1024):
+    """
+    returns the standard deviation of every window of n values of a
+    (len(a) - n + 1 values, a must have at least n values). The cumulative
+    sums are restarted every block of values (shifted by the mean of the
+    block) to keep their rounding errors small.
+    """
+    nb_of_windows = a.shape[0] - n + 1
+    rows = blocks(a, n, block_size)
+    block_size = rows.shape[1] - n + 1
+    rows = rows - rows.mean(axis=1, keepdims=True)
+
+    sums = np.zeros((rows.shape[0], block_size + n), dtype=np.float64)
+    sq_sums = np.zeros_like(sums)
+    np.cumsum(rows, axis=1, out=sums[:, 1:])
+    np.cumsum(rows * rows, axis=1, out=sq_sums[:, 1:])
+    s = sums[:, n:] - sums[:, :block_size]
+    variance = sq_sums[:, n:] - sq_sums[:, :block_size]
+    variance -= s * s / n
+    # the windows where the rounding errors of the sums aren't negligible
+    # (nearly flat prices) are computed again directly
+    inaccurate = variance < 1e8 * np.finfo(np.float64).eps * sq_sums[:, n:]
+    variance = variance.reshape(-1)[:nb_of_windows]
+    starts = np.flatnonzero(inaccurate.reshape(-1)[:nb_of_windows])
+    chunk_size = max(2**20 // n, 1)
+    for i in range(0, starts.shape[0], chunk_size):
+        chunk = starts[i:i + chunk_size]
+        windows = a[chunk[:, None] + np.arange(n)]
+        windows -= windows.mean(axis=1, keepdims=True)
+        variance[chunk] = np.einsum("ij,ij->i", windows, windows)
+    variance /= n - ddof
+    return np.sqrt(variance)
+
+
+def blocks(a, n, block_size):
+    """
+    splits a in overlapping rows : row i holds the values of the windows of
+    n values starting in the i-th block of {{block_size}} values (at least
+    4 * n). The end is padded with the last value. a must have at least n
+    values.
+
+    Returns:
+        np.ndarray: the rows, shape (nb of blocks, block_size + n - 1).
+    """
+    nb_of_windows = a.shape[0] - n + 1
+    block_size = max(block_size, 4 * n)
+    if nb_of_windows <= block_size:
+        return a[np.newaxis, :]
+    nb_of_blocks = -(-nb_of_windows // block_size)
+    padded = np.empty(nb_of_blocks * block_size + n - 1, dtype=np.float64)
+    padded[:a.shape[0]] = a
+    padded[a.shape[0]:] = a[-1]
+    return np.lib.stride_tricks.sliding_window_view(
+        padded, block_size + n - 1)[::block_size]
+
+
+def std(data, period, ddof=0):
+    """
+    rolling standard deviation of the closing prices. The value of a row is
+    the standard deviation of the {{period}} closes before it. It uses
+    cumulative sums so it is O(n) in time and memory whatever the period.
+
+    Args:
+        data (np.ndarray): market data (format of market_data.get_data).
+        period (int): the number of closes in a window.
+        ddof (int, optional): delta degrees of freedom, 0 for the population
+        standard deviation, 1 for the sample one. Defaults to 0.
+
+    Returns:
+        np.ndarray: array([[timestamp, std], ...])
+    """
     closing_prices = data[:, 4]
-    windows = np.zeros((data.shape[0] - period, period), np.float64)
-    for i in range(period):
-        windows[:, i] = closing_prices[i:windows.shape[0]+i]
-    std = np.std(windows, axis=1)
-    extra_values = np.zeros(period)
-    extra_values[:] = np.nan
-    std = np.concatenate((extra_values, std))
-    return np.stack((data[:, 0], std), axis=1)
+    n = closing_prices.shape[0]
+    out = np.full(n, np.nan, dtype=np.float64)
+    nb_of_windows = n - period
+    if nb_of_windows > 0 and period > ddof:
+        out[period:] = rolling_std(closing_prices[:-1], period, ddof)
+    return np.stack((data[:, 0], out), axis=1)
 
 
 # program
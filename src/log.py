@@ -1,14 +1,33 @@
+from collections import deque, namedtuple
 from datetime import datetime
+import atexit
+import itertools
+import queue
+import threading
 import time
 import os
 import os.path
 
 import settings
 
-"""This module will handle everything log related """
+"""
+This module will handle everything log related. The messages are put in a
+queue and written to the log file by a background thread, so logging never
+blocks the caller (i.e the IB reader thread). The last records are also
+kept in memory so the status bar doesn't have to read the log file.
+"""
 
 # variables
 log_file_path, print_log = settings.get_settings("log_file_path", "print_logs")
+flush_size = 200  # max number of records waiting before a write
+flush_interval = 0.5  # max number of seconds a record waits before a write
+ring_size = 1000  # number of records kept in memory
+log_queue = queue.SimpleQueue()
+recent_records = deque(maxlen=ring_size)
+written_size = None  # size of the log file after our last write
+writer_thread = None
+stop_signal = object()
+LogRecord = namedtuple("LogRecord", ["time", "level", "msg"])
 
 
 # external
@@ -16,7 +35,8 @@ log_file_path, print_log = settings.get_settings("log_file_path", "print_logs")
 
 def log(msg, print_l=None, level="INFO", tws_error=False):
     """
-    logs a msg to the log file
+    logs a msg to the log file. The message is written asynchronously by
+    the writer thread.
 
     Args:
         msg (str): the message to log
@@ -27,20 +47,71 @@ def log(msg, print_l=None, level="INFO", tws_error=False):
     if print_l == None:
         print_l = print_log
 
-    log_msg = f"{datetime.now()} : {level} : {msg}"
-    with open(log_file_path, "a") as f:
-        f.write(f"{log_msg}\n")
+    now = datetime.now()
+    recent_records.append(LogRecord(now, level, msg))
+    log_queue.put((now, level, msg, print_l))
+
+
+def flush(timeout=None):
+    """
+    waits until every message logged before the call has been written to
+    the log file.
+
+    Returns:
+        bool: False if the timeout expired before.
+    """
+    if writer_thread == None or not writer_thread.is_alive():
+        return True
+    done = threading.Event()
+    log_queue.put(done)
+    return done.wait(timeout)
 
-    if print_l:
-        print(log_msg)
 
-    time.sleep(0.5)
+def shutdown(timeout=5):
+    """writes the remaining messages and stops the writer thread."""
+    global writer_thread
+    if writer_thread == None:
+        return
+    log_queue.put(stop_signal)
+    writer_thread.join(timeout)
+    writer_thread = None
 
 
 def get_last_log():
-    with open(log_file_path) as f:
-        last_log = f.readlines()[-1]
-    return last_log
+    """returns the last log as it is written in the log file."""
+    record = get_last_record()
+    if record == None:
+        return ""
+    return format_record(record)
+
+
+def get_last_record():
+    """
+    returns the last log record (time, level, msg), or None if there is no
+    log.
+    """
+    records = get_last_records(1)
+    return records[0] if records else None
+
+
+def get_last_records(n):
+    """
+    returns the last n log records, the most recent one last. They are taken
+    from memory, unless the log file has been written by another process,
+    in which case the end of the file is read.
+
+    Args:
+        n (int): the number of records.
+
+    Returns:
+        list of LogRecord: the records (time, level, msg).
+    """
+    if recent_records and n <= len(recent_records) and \
+            not written_by_other_process():
+        records = list(itertools.islice(reversed(recent_records), n))
+        records.reverse()
+        return records
+    return [parse_line(line) for line in tail(log_file_path, n)]
 
 
 # internal
@@ -54,5 +125,132 @@ def init_log_file():
             f.write(f"{datetime.now()} : creating log file\n")
 
 
+def start_writer():
+    """starts the thread writing the queued messages to the log file."""
+    global writer_thread
+    if writer_thread != None and writer_thread.is_alive():
+        return
+    writer_thread = threading.Thread(target=writer_loop, name="log writer",
+                                     daemon=True)
+    writer_thread.start()
+
+
+def writer_loop():
+    """
+    takes the messages out of the queue and writes them by batches, when
+    {{flush_size}} messages are waiting or when the oldest one has waited
+    {{flush_interval}} seconds.
+    """
+    batch = []
+    deadline = None
+    while True:
+        timeout = None if deadline == None else max(
+            deadline - time.monotonic(), 0)
+        try:
+            item = log_queue.get(timeout=timeout)
+        except queue.Empty:
+            item = None
+
+        if item is stop_signal:
+            write_batch(batch)
+            return
+
+        if isinstance(item, threading.Event):
+            write_batch(batch)
+            batch, deadline = [], None
+            item.set()
+            continue
+
+        if item != None:
+            batch.append(item)
+            if deadline == None:
+                deadline = time.monotonic() + flush_interval
+
+        if batch and (len(batch) >= flush_size or item == None):
+            write_batch(batch)
+            batch, deadline = [], None
+
+
+def write_batch(batch):
+    global written_size
+    if not batch:
+        return
+    lines = [format_record(record[:3]) for record in batch]
+    with open(log_file_path, "a") as f:
+        f.write("\n".join(lines) + "\n")
+        written_size = f.tell()
+
+    for line, record in zip(lines, batch):
+        if record[3]:
+            print(line)
+
+
+def format_record(record):
+    time_, level, msg = record
+    return f"{time_} : {level} : {msg}"
+
+
+def parse_line(line):
+    """converts a line of the log file to a LogRecord."""
+    parts = line.rstrip("\n").split(" : ", 2)
+    if len(parts) == 2:
+        parts.insert(1, "INFO")
+    try:
+        time_ = datetime.fromisoformat(parts[0])
+    except ValueError:
+        time_ = None
+    if len(parts) < 3:
+        return LogRecord(time_, "INFO", line.rstrip("\n"))
+    return LogRecord(time_, parts[1], parts[2])
+
+
+def written_by_other_process():
+    """
+    whether the log file has been written by someone else since our last
+    write.
+    """
+    if written_size == None:
+        return False
+    try:
+        return os.path.getsize(log_file_path) > written_size
+    except OSError:
+        return False
+
+
+def tail(path, n, block_size=4096):
+    """
+    returns the last n lines of a file. The file is read backward by blocks
+    from its end, so the cost doesn't depend on the size of the file.
+    """
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return []
+    with f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        data = b""
+        while end > 0 and data.count(b"\n") <= n:
+            start = max(end - block_size, 0)
+            f.seek(start)
+            data = f.read(end - start) + data
+            end = start
+    lines = data.decode(errors="replace").splitlines()
+    return [line for line in lines if line][-n:]
+
+
+def on_settings_change(key, value):
+    """keeps the module variables in sync with the settings."""
+    global log_file_path, print_log
+    if key == "log_file_path":
+        log_file_path = value
+        init_log_file()
+    elif key == "print_logs":
+        print_log = value
+
+
 # program
 init_log_file()
+settings.subscribe(on_settings_change, "log_file_path", "print_logs")
+start_writer()
+atexit.register(shutdown)
@@ -9,6 +9,11 @@ import contract
 import log
 import ib_interface
 import session
+import request_registry
+import data_scheduler
+import bar_cache
+import resample
+from bar_dates import barsize_to_seconds, duration_to_seconds
 
 # variables:
 data_type = settings.get_settings("data_type")
@@ -17,44 +22,135 @@ data_type = settings.get_settings("data_type")
 # external use :
 def clear_data(ib):
     log.log("purging outdated market data")
-    reqs = [i for i in ib.market]
-    ib.market = {}
-    ib.reqId_info = {}
-    for i in reqs:
-        ib.cancelHistoricalData(i)
+    for request in ib.data_requests.active():
+        ib.cancelHistoricalData(request.reqId)
+    ib.market.clear()
+    ib.indicators.clear()
+    ib.bar_buffers = {}
+    ib.data_requests.clear()
 
 
-def ask_data(ib, symbols, timeframes):
+def ask_data(ib, symbols, timeframes, timeout=60, priority=None,
+             use_cache=True, derive=True, keep_up_to_date=False):
+    """
+    asks the historical data of the symbols for every timeframe and waits
+    until it has been received. The requests are sent by a
+    HistoricalDataScheduler which respects the pacing limits of interactive
+    brokers.
+
+    Args:
+        ib (IBApi obj): The IBApi object storing the data.
+        symbols (list of str): The symbols (i.e ["EUR/USD", "GBP/USD"]).
+        timeframes (list of tuple): (barsize, duration) of the data to ask.
+        timeout (float, optional): The max number of seconds to wait for the
+        data of one request, it is cancelled after. Defaults to 60.
+        priority (list of str, optional): The barsizes to ask first. Defaults
+        to None which means the order of timeframes.
+        use_cache (bool, optional): Whether to start from the bars saved
+        locally by the last session (see the bar_cache module) and only ask
+        the missing ones. Defaults to True.
+        derive (bool, optional): Whether to resample the barsizes that are
+        multiples of the lowest one from its bars (see BarStore.derive)
+        instead of asking them. They are still asked when their duration is
+        longer than the one of the lowest barsize, for the older bars.
+        Defaults to True.
+        keep_up_to_date (bool, optional): Whether TWS keeps sending the new
+        bars of the lowest barsize, and of the barsizes not derived from
+        it. Defaults to False.
+    """
     clear_data(ib)
+    if priority == None:
+        priority = [barsize for barsize, _ in timeframes]
+    base_barsize, base_duration = min(
+        timeframes, key=lambda timeframe: barsize_to_seconds(timeframe[0]))
+    session = tuple(settings.get_settings("session_start"))
+    requests = []
     for symbol in symbols:
-        reqIds = []
-        symbol_contract = contract.get_contract(symbol)
-        log.log(f"asking data for {symbol}")
-        start_time = time.time()
-        for i in timeframes:
-            barsize, duration = i
-            reqId = ib.nextReqId
-            add_reqId_info(ib, reqId, symbol, barsize)
-            ib.nextReqId += 1
-            reqIds.append(reqId)
-            ib.reqHistoricalData(reqId, symbol_contract, "", duration,
-                                 barsize, data_type, 0, 1, 0, [])
-        log.log(f"waiting for {symbol} data")
-        while True:
-            if ib.active_data_reqs == 0:
-                log.log(f"all data for {symbol} has been retrieved")
-                break
+        derived = []
+        for barsize, duration in timeframes:
+            is_derived = derive and \
+                resample.is_derivable(barsize, base_barsize)
+            if is_derived:
+                derived.append(barsize)
+                if duration_to_seconds(duration) <= \
+                        duration_to_seconds(base_duration):
+                    continue
+            keep = keep_up_to_date and not is_derived
+            if not use_cache:
+                requests.append(data_scheduler.ScheduledRequest(
+                    symbol, barsize, duration, "", keep))
+                continue
+            cached = bar_cache.trim(bar_cache.load(symbol, barsize), duration)
+            series = ib.market.reset(symbol, barsize,
+                                     capacity=2 * cached.shape[0])
+            series.extend(cached)
+            for end, missing in bar_cache.missing_ranges(cached, barsize,
+                                                         duration):
+                requests.append(data_scheduler.ScheduledRequest(
+                    symbol, barsize, missing, end, keep and end == ""))
+        for barsize in derived:
+            ib.market.derive(symbol, barsize, base_barsize, session)
+
+    def log_progress(done, total, eta):
+        eta = "unknown" if eta == None else f"{round(eta)} secs"
+        log.log(f"received {done}/{total} data requests, time left : {eta}")
+
+    log.log(f"asking data for {', '.join(symbols)}")
+    scheduler = data_scheduler.HistoricalDataScheduler(
+        ib, what_to_show=data_type, request_timeout=timeout,
+        on_progress=log_progress)
+    scheduler.run(requests, priority=priority)
+
+    received = (request_registry.DONE, request_registry.STREAMING)
+    failed = []
+    for job in scheduler.done:
+        request = ib.data_requests.get(job.reqId)
+        if request == None or request.state not in received:
+            failed.append(f"{job.symbol} {job.barsize}")
+    if failed:
+        log.log(f"couldn't retrieve data for {', '.join(failed)}",
+                level="ERROR")
+    else:
+        log.log("all data has been retrieved")
+    if use_cache:
+        bar_cache.save_all(ib.market)
 
-            if (start_time - time.time()) > 60:
-                log.log("No data after 60 secs, cancelling requests." +
-                        " Program might have requested too much data.")
-                for reqId in reqIds:
-                    ib.cancelHistoricalData(reqId)
-                break
+
+def wait_for_data(ib, reqIds=None, symbol=None, timeout=None):
+    """
+    waits until the historical data of some requests has been received (or
+    the requests failed or were cancelled). Nothing is done while waiting.
+
+    Args:
+        ib (IBApi obj): The IBApi object storing the data.
+        reqIds (int or list of int, optional): The requests to wait for.
+        symbol (str, optional): wait for every request of this symbol
+        instead. If neither reqIds nor symbol is given, waits for every
+        request.
+        timeout (float, optional): The max number of seconds to wait.
+        Defaults to None which means no limit.
+
+    Returns:
+        bool: False if the timeout expired before.
+    """
+    if reqIds != None:
+        return ib.data_requests.wait(reqIds, timeout)
+    if symbol != None:
+        return ib.data_requests.wait_symbol(symbol, timeout)
+    return ib.data_requests.wait_all(timeout)
+
+
+def cancel_data(ib, reqId):
+    """cancels a request if it's still pending or streaming."""
+    request = ib.data_requests.get(reqId)
+    if request != None and request.state in request_registry.active_states:
+        ib.cancelHistoricalData(reqId)
 
 
 def get_data(ib, symbol, barsize=None, nb_of_data_points=0, data_format="numpy"):
-    """Returns market data of a specific symbol and barsize.
+    """Returns market data of a specific symbol and barsize. The arrays are
+    read-only views on the bars stored by the IBApi object, no data is
+    copied.
 
     Args:
         ib (IBApi obj): The IBApi object storing the data. 
@@ -74,38 +170,46 @@ def get_data(ib, symbol, barsize=None, nb_of_data_points=0, data_format="numpy")
     """
     if type(barsize) in (type(()), type([])):
         data = []
-        barsizes = barsize.copy()
-        del barsize
-        for barsize in barsizes:
-            reqId = get_reqId_from_info(ib, symbol, barsize)
-            if reqId == None:
-                log.log(f"couldn't find data for {symbol} {barsize}")
+        for bs in barsize:
+            series = ib.market.get(symbol, bs)
+            if series == None:
+                log.log(f"couldn't find data for {symbol} {bs}")
                 break
-            bs_data = ib.market[reqId][-nb_of_data_points:]
-            bs_data = np.array(bs_data, dtype=np.float64)
-            bs_data = filter_arr(bs_data)
-            data.append(bs_data)
+            data.append(series.view(nb_of_data_points))
     else:
-        reqId = get_reqId_from_info(ib, symbol, barsize)
-        if reqId == None:
+        series = ib.market.get(symbol, barsize)
+        if series == None:
             log.log(f"couldn't find data for {symbol} {barsize}")
-        data = ib.market[reqId][-nb_of_data_points:]
-        data = np.array(data, dtype=np.float64)
-        data = filter_arr(data)
+            return np.empty((0, 5), dtype=np.float64)
+        data = series.view(nb_of_data_points)
     return data
 
 
+def get_indicator(ib, symbol, barsize, name, *params):
+    """Returns a technical indicator computed on the market data of a
+    symbol and barsize. The result is cached and only extended with the new
+    bars by the next calls (see indicator_cache).
+
+    Args:
+        ib (IBApi obj): The IBApi object storing the data.
+        symbol (str): The security's symbol (i.e "EUR/USD")
+        barsize (str): The barsize (i.e "5 mins", "4 hours", "1 hour").
+        name (str): The indicator, name of a function of the indicators
+        module (i.e "rsi", "macd").
+        *params: The parameters of the indicator (i.e 14 for rsi).
+
+    Returns:
+        numpy array: read-only, the output of the indicator function.
+    """
+    return ib.indicators.get(symbol, barsize, name, *params)
+
+
 def get_info_from_reqId(ib, reqId):
-    return ib.reqId_info[reqId]
+    return ib.data_requests.get_info(reqId)
 
 
 def get_reqId_from_info(ib, symbol, barsize):
-    info = (symbol, barsize)
-    for key in ib.reqId_info:
-        if ib.reqId_info[key] == info:
-            return key
-
-    return None
+    return ib.data_requests.get_reqId(symbol, barsize)
 
 
 def np_array_to_pd_df(arr):
@@ -118,7 +222,7 @@ def np_array_to_pd_df(arr):
 
 # internal use :
 def add_reqId_info(ib, reqId, symbol, barsize):
-    ib.reqId_info[reqId] = (symbol, barsize)
+    ib.data_requests.add(reqId, symbol, barsize)
 
 
 def filter_arr(arr):
@@ -129,7 +233,14 @@ def filter_arr(arr):
     return arr
 
 
+def on_settings_change(key, value):
+    global data_type
+    data_type = value
+
+
 # program :
+settings.subscribe(on_settings_change, "data_type")
+
 if __name__ == "__main__":
     ib = ib_interface.IBApi()
     session.start_session(ib)
@@ -0,0 +1,591 @@
+import glob
+import os
+import pickle
+import struct
+import threading
+import time
+
+import numpy as np
+from ibapi.commission_report import CommissionReport
+from ibapi.execution import Execution
+from ibapi.order import Order
+
+from ib_codec import decode_object, encode_object
+from order_store import OrderStore, PLACED, terminal_states
+
+"""
+This module will handle the persistence of the orders : every order event
+(placement, orderStatus, execDetails and commissionReport) is appended to a
+journal on disk, so the orders can be rebuilt after a restart without asking
+TWS again.
+
+The finished orders (filled, cancelled or inactive, with the executions and
+the commissions of their fills) are compacted regularly into columnar
+archives (numpy .npz files, one per compaction) and removed from memory.
+The journal is then rewritten with the snapshot of the orders left, so its
+size and the time to reload it depend on the number of working orders, not
+on the history.
+
+The ids of the archived orders are kept in the store (and read back from
+the archives when the journal is loaded) : the events still arriving for
+them are written to the "late" table of the next archive instead of
+creating a new order, and load_archive merges them with their order.
+
+Journal format : the header (magic, number of archives when the journal was
+written), then one record per event :
+    - time of the event (time.time(), float64), event code (uint8), size of
+        the payload (uint32),
+    - the payload : the pickled arguments of the event. The ibapi objects
+        are stored as their attributes that differ from a new object (see
+        ib_codec).
+The archives are written before the journal that doesn't have their orders
+anymore : after a crash between the two, the orders of the archives the
+journal doesn't know about are dropped when it's loaded.
+
+Journaling is opt-in : the orders are journaled to the directory of the
+"order_journal_dir" setting when it's set (see session.start_session), or :
+    journal = OrderJournal(".order_journal", ib.orders)
+    journal.load()
+    ib.order_journal = journal
+"""
+
+# variables :
+magic = b"IBO1"
+header = struct.Struct("<4sI")
+record_header = struct.Struct("<dBI")
+events = ["place", "status", "execution", "commission"]
+event_codes = {name: code for code, name in enumerate(events)}
+journal_name = "orders.journal"
+archive_name = "archive-{:06d}.npz"
+unset_double = 1.7976931348623157e308  # ibapi.common.UNSET_DOUBLE
+
+
+class OrderJournal:
+    """
+    Journals the order events of an OrderStore to a directory.
+
+    ...
+
+    Attributes
+    ----------
+    directory : str
+        The directory of the journal and of the archives.
+    store : OrderStore
+        The orders journaled (IBApi.orders).
+    compact_every : int
+        The number of events appended before the journal is compacted, 0
+        to compact only when it's loaded and closed.
+    grace : float
+        The number of seconds a finished order waits for the commissions of
+        its fills before it can be archived without them.
+    nb_of_events : int
+        The number of events appended since the last compaction.
+    nb_of_archives : int
+
+    Methods (external)
+    -------
+    load, compact, close, write_placement, write_status, write_execution,
+    write_commission
+    """
+
+    def __init__(self, directory, store=None, compact_every=10000,
+                 grace=300):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.store = store if store != None else OrderStore()
+        self.compact_every = compact_every
+        self.grace = grace
+        self.nb_of_events = 0
+        self.nb_of_archives = len(get_archive_paths(directory))
+        self.path = os.path.join(directory, journal_name)
+        self._file = None
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # external use
+    def load(self):
+        """
+        rebuilds the orders of the journal in the store, then compacts it.
+
+        Returns:
+            OrderStore: the store.
+        """
+        with self._lock:
+            paths = get_archive_paths(self.directory)
+            archived, records = len(paths), []
+            if os.path.exists(self.path):
+                archived, records, _ = read_journal(self.path)
+            for path in paths[:archived]:
+                self.store.mark_archived(*read_archived_ids(path))
+            for seconds, name, args in records:
+                apply_event(self.store, seconds, name, args)
+            # archives written after the journal (see the module doc)
+            for path in paths[archived:]:
+                orderIds, permIds, execIds = read_archived_ids(path)
+                for orderId in orderIds:
+                    self.store.remove(orderId)
+                self.store.mark_archived(orderIds, permIds, execIds)
+            self.compact()
+        return self.store
+
+    def compact(self):
+        """
+        archives the finished orders, removes them from the store and
+        rewrites the journal with the orders left.
+
+        Returns:
+            int: the number of orders archived.
+        """
+        with self._lock:
+            now = time.time()
+            archived, kept = [], []
+            for record in map(self.store.get, self.store):
+                if record == None:
+                    continue
+                if not record.is_working and (
+                        is_complete(record)
+                        or now - record.update_time > self.grace):
+                    archived.append(record)
+                else:
+                    kept.append(record)
+            # the commissions waiting longer than grace for their execution
+            # are archived as late events, their order may never come
+            late_events = self.store.pop_late_events() + [
+                ("commission", report) for report in
+                self.store.pop_waiting_commissions(now - self.grace)]
+            if archived or late_events:
+                path = os.path.join(self.directory,
+                                    archive_name.format(self.nb_of_archives))
+                write_archive(path, archived, late_events)
+                self.nb_of_archives += 1
+
+            temporary_path = self.path + ".tmp"
+            with open(temporary_path, "wb") as file:
+                file.write(header.pack(magic, self.nb_of_archives))
+                for record in kept:
+                    for seconds, code, args in snapshot(record):
+                        file.write(encode(seconds, code, args))
+                for seconds, report in self.store.get_waiting_commissions():
+                    file.write(encode(seconds, event_codes["commission"],
+                                      (encode_object(report),)))
+                file.flush()
+                os.fsync(file.fileno())
+            if self._file != None:
+                self._file.close()
+            os.replace(temporary_path, self.path)
+            self._file = open(self.path, "ab")
+            self.nb_of_events = 0
+            for record in archived:
+                self.store.remove(record.orderId, archived=True)
+            return len(archived)
+
+    def close(self):
+        """compacts the journal and closes it."""
+        with self._lock:
+            if self._file == None:
+                return
+            self.compact()
+            self._file.close()
+            self._file = None
+
+    def write_placement(self, orderId, contract, order):
+        self.write(event_codes["place"], (orderId, encode_object(contract),
+                                          encode_object(order)))
+
+    def write_status(self, orderId, status, filled, remaining, avgFillPrice,
+                     permId, parentId, lastFillPrice, clientId, whyHeld,
+                     mktCapPrice):
+        self.write(event_codes["status"], (
+            orderId, status, filled, remaining, avgFillPrice, permId,
+            parentId, lastFillPrice, clientId, whyHeld, mktCapPrice))
+
+    def write_execution(self, execution, contract):
+        self.write(event_codes["execution"], (encode_object(execution),
+                                              encode_object(contract)))
+
+    def write_commission(self, commissionReport):
+        self.write(event_codes["commission"],
+                   (encode_object(commissionReport),))
+
+    # internal use
+    def write(self, code, args):
+        data = encode(time.time(), code, args)
+        with self._lock:
+            if self._file == None:
+                return
+            self._file.write(data)
+            self._file.flush()
+            self.nb_of_events += 1
+            if self.compact_every and self.nb_of_events >= self.compact_every:
+                self.compact()
+
+
+# external use :
+def read_journal(path):
+    """
+    reads the events of a journal. A record cut by a crash is removed from
+    the file.
+
+    Returns:
+        tuple: (number of archives when the journal was written, list of
+        (time, event name, arguments), size of the valid part of the file).
+    """
+    with open(path, "rb") as file:
+        buffer = file.read()
+    if buffer[:4] != magic:
+        raise ValueError(f"{path} isn't an order journal")
+    _, nb_of_archives = header.unpack_from(buffer)
+    offset = header.size
+    records = []
+    while offset + record_header.size <= len(buffer):
+        seconds, code, size = record_header.unpack_from(buffer, offset)
+        start = offset + record_header.size
+        if start + size > len(buffer):
+            break
+        try:
+            args = pickle.loads(buffer[start:start + size])
+        except Exception:
+            break
+        records.append((seconds, events[code], args))
+        offset = start + size
+    if offset < len(buffer):
+        with open(path, "r+b") as file:
+            file.truncate(offset)
+    return nb_of_archives, records, offset
+
+
+def load_archive(directory):
+    """
+    returns the finished orders archived in a directory, oldest first.
+
+    Returns:
+        tuple: (orders, fills), dictionnaries of columns (np.ndarray) :
+            - orders : orderId, permId, parentId, symbol, action, orderType,
+                totalQuantity, lmtPrice, auxPrice, status, filled,
+                avgFillPrice, commission, nb_of_fills, placed_time,
+                update_time.
+            - fills : orderId, execId, time, side, shares, price,
+                commission.
+        A price or a time that isn't known is NaN.
+    """
+    orders, fills, late = {}, {}, {}
+    for path in get_archive_paths(directory):
+        with np.load(path) as archive:
+            for key in archive.files:
+                table, column = key.split("/")
+                columns = {"orders": orders, "fills": fills,
+                           "late": late}[table]
+                columns.setdefault(column, []).append(archive[key])
+    orders = {k: np.concatenate(v) for k, v in orders.items()}
+    fills = {k: np.concatenate(v) for k, v in fills.items()}
+    if late and fills:
+        late = {k: np.concatenate(v) for k, v in late.items()}
+        fills = merge_late_events(orders, fills, late)
+    return orders, fills
+
+
+# internal use :
+def get_archive_paths(directory):
+    return sorted(glob.glob(os.path.join(directory, "archive-*.npz")))
+
+
+def read_archived_ids(path):
+    """
+    returns the orderIds, permIds and execIds of the orders of an archive
+    (see OrderStore.mark_archived).
+    """
+    with np.load(path) as archive:
+        kinds = archive["late/kind"]
+        late_execIds = archive["late/execId"][kinds == "execution"]
+        return (archive["orders/orderId"].tolist(),
+                archive["orders/permId"].tolist(),
+                archive["fills/execId"].tolist() + late_execIds.tolist())
+
+
+def merge_late_events(orders, fills, late):
+    """
+    merges the events received after their order was archived with the
+    archived orders : the executions missing from the fills are added, the
+    missing commissions are filled and a status only moves the fill of its
+    order forward (like OrderStore.update_status). An event can be in
+    several archives after a crash, merging it again changes nothing.
+
+    Returns:
+        dict: the fills, with the late executions.
+    """
+    kinds = late["kind"]
+    positions = {orderId: i for i, orderId in
+                 enumerate(orders["orderId"].tolist())}
+    known = set(fills["execId"].tolist())
+    executions = []
+    for i in np.flatnonzero(kinds == "execution"):
+        if late["execId"][i] not in known:
+            known.add(late["execId"][i])
+            executions.append(i)
+    if executions:
+        fills = {column: np.concatenate((values, late[column][executions]))
+                 for column, values in fills.items()}
+        for orderId in late["orderId"][executions].tolist():
+            if orderId in positions:
+                orders["nb_of_fills"][positions[orderId]] += 1
+
+    is_commission = kinds == "commission"
+    commissions = dict(zip(late["execId"][is_commission].tolist(),
+                           late["commission"][is_commission].tolist()))
+    missing = np.flatnonzero(np.isnan(fills["commission"]))
+    for i in missing:
+        commission = commissions.get(fills["execId"][i], np.nan)
+        fills["commission"][i] = commission
+        orderId = int(fills["orderId"][i])
+        if not np.isnan(commission) and orderId in positions:
+            orders["commission"][positions[orderId]] += commission
+
+    statuses = np.flatnonzero(kinds == "status")
+    if statuses.shape[0]:
+        orders["status"] = orders["status"].astype(
+            np.result_type(orders["status"], late["status"]))
+    for i in statuses:
+        position = positions.get(int(late["orderId"][i]))
+        if position == None or late["filled"][i] <= orders["filled"][position]:
+            continue
+        orders["filled"][position] = late["filled"][i]
+        orders["avgFillPrice"][position] = late["avgFillPrice"][i]
+        if late["status"][i] in terminal_states:
+            orders["status"][position] = late["status"][i]
+    return fills
+
+
+def is_complete(record):
+    """
+    whether a finished order has received the executions of its filled
+    quantity (the status comes first) and their commissions.
+    """
+    executions = record.executions or {}
+    shares = sum(float(e.shares) for e in executions.values())
+    return shares >= float(record.filled) and \
+        len(record.commissions or ()) >= len(executions)
+
+
+def encode(seconds, code, args):
+    payload = pickle.dumps(args, protocol=pickle.HIGHEST_PROTOCOL)
+    return record_header.pack(seconds, code, len(payload)) + payload
+
+
+def apply_event(store, seconds, name, args):
+    """replays an event of the journal in an OrderStore."""
+    if name == "place":
+        orderId, contract, order = args
+        record = store.add(orderId, decode_object(contract),
+                           decode_object(order))
+        record.placed_time = seconds
+    elif name == "status":
+        record = store.update_status(*args)
+    elif name == "execution":
+        execution, contract = args
+        record = store.add_execution(decode_object(execution),
+                                     decode_object(contract))
+    else:
+        record = store.add_commission(decode_object(args[0]))
+    if record != None:
+        record.update_time = seconds
+
+
+def snapshot(record):
+    """returns the events rebuilding an OrderRecord."""
+    events = []
+    if record.placed_time != None or record.order != None:
+        events.append((record.placed_time or record.update_time,
+                       event_codes["place"],
+                       (record.orderId, encode_object(record.contract),
+                        encode_object(record.order))))
+    if record.status != PLACED:
+        events.append((record.update_time, event_codes["status"], (
+            record.orderId, record.status, record.filled, record.remaining,
+            record.avgFillPrice, record.permId, record.parentId,
+            record.lastFillPrice, record.clientId, record.whyHeld,
+            record.mktCapPrice)))
+    for execution in (record.executions or {}).values():
+        events.append((record.update_time, event_codes["execution"],
+                       (encode_object(execution), None)))
+    for report in (record.commissions or {}).values():
+        events.append((record.update_time, event_codes["commission"],
+                       (encode_object(report),)))
+    return events
+
+
+def write_archive(path, records, late_events):
+    """
+    writes finished orders, and the events received after their order was
+    archived (see OrderStore.pop_late_events), to a columnar archive.
+    """
+    def price(value):
+        return np.nan if value == None or value == unset_double else value
+
+    def get(obj, attribute, default):
+        return getattr(obj, attribute, default) if obj != None else default
+
+    fills = [(record.orderId, execution, (record.commissions or {}).get(
+        execId)) for record in records
+        for execId, execution in (record.executions or {}).items()]
+    columns = {
+        "orders/orderId": [r.orderId for r in records],
+        "orders/permId": [r.permId or 0 for r in records],
+        "orders/parentId": [r.parentId or 0 for r in records],
+        "orders/symbol": [f"{r.contract.symbol}/{r.contract.currency}"
+                          if r.contract != None else "" for r in records],
+        "orders/action": [get(r.order, "action", "") for r in records],
+        "orders/orderType": [get(r.order, "orderType", "") for r in records],
+        "orders/totalQuantity": [float(get(r.order, "totalQuantity", np.nan))
+                                 for r in records],
+        "orders/lmtPrice": [price(get(r.order, "lmtPrice", None))
+                            for r in records],
+        "orders/auxPrice": [price(get(r.order, "auxPrice", None))
+                            for r in records],
+        "orders/status": [r.status for r in records],
+        "orders/filled": [float(r.filled) for r in records],
+        "orders/avgFillPrice": [float(r.avgFillPrice) for r in records],
+        "orders/commission": [r.commission for r in records],
+        "orders/nb_of_fills": [len(r.executions or ()) for r in records],
+        "orders/placed_time": [price(r.placed_time) for r in records],
+        "orders/update_time": [r.update_time for r in records],
+        "fills/orderId": [orderId for orderId, _, _ in fills],
+        "fills/execId": [e.execId for _, e, _ in fills],
+        "fills/time": [e.time for _, e, _ in fills],
+        "fills/side": [e.side for _, e, _ in fills],
+        "fills/shares": [float(e.shares) for _, e, _ in fills],
+        "fills/price": [e.price for _, e, _ in fills],
+        "fills/commission": [c.commission if c != None else np.nan
+                             for _, _, c in fills],
+    }
+    late = {column: [] for column in (
+        "kind", "orderId", "execId", "status", "filled", "avgFillPrice",
+        "time", "side", "shares", "price", "commission")}
+    for name, args in late_events:
+        row = dict(kind=name, orderId=0, execId="", status="", filled=np.nan,
+                   avgFillPrice=np.nan, time="", side="", shares=np.nan,
+                   price=np.nan, commission=np.nan)
+        if name == "status":
+            row.update(orderId=args[0], status=args[1],
+                       filled=float(args[2]), avgFillPrice=args[4])
+        elif name == "execution":
+            row.update(orderId=args.orderId, execId=args.execId,
+                       time=args.time, side=args.side,
+                       shares=float(args.shares), price=args.price)
+        else:
+            row.update(execId=args.execId, commission=args.commission)
+        for column, value in row.items():
+            late[column].append(value)
+    columns.update({"late/" + column: values
+                    for column, values in late.items()})
+    dtypes = {"orderId": np.int64, "permId": np.int64, "parentId": np.int64,
+              "nb_of_fills": np.int64, "symbol": str, "action": str,
+              "orderType": str, "status": str, "execId": str, "time": str,
+              "side": str, "kind": str}
+    arrays = {key: np.array(values, dtype=dtypes.get(key.split("/")[1],
+                                                    np.float64))
+              for key, values in columns.items()}
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as file:
+        np.savez(file, **arrays)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, path)
+
+
+# program :
+if __name__ == "__main__":
+    import random
+    import tempfile
+
+    from order_store import FILLED, CANCELLED, SUBMITTED
+
+    import contract as contracts
+
+    random.seed(0)
+    nb_of_orders = 50000
+
+    def trade(journal, store, orderId):
+        """the events of an order : most are filled, some cancelled, a few
+        stay working."""
+        order = Order()
+        order.orderId, order.action, order.orderType = orderId, "BUY", "LMT"
+        order.totalQuantity, order.lmtPrice = 20000, 1.1
+        order.permId = 10**6 + orderId
+        symbol_contract = contracts.get_contract("EUR/USD")
+        store.add(orderId, symbol_contract, order)
+        journal.write_placement(orderId, symbol_contract, order)
+        status = (orderId, SUBMITTED, 0.0, 20000.0, 0.0, order.permId, 0,
+                  0.0, 0, "", 0.0)
+        store.update_status(*status)
+        journal.write_status(*status)
+        outcome = random.random()
+        if outcome < 0.02:
+            return
+        if outcome < 0.2:
+            status = (orderId, CANCELLED) + status[2:]
+            store.update_status(*status)
+            journal.write_status(*status)
+            return
+        execution = Execution()
+        execution.orderId, execution.permId = orderId, order.permId
+        execution.execId = f"0001f4e8.{orderId}.01.01"
+        execution.shares, execution.price, execution.side = 20000, 1.1, "BOT"
+        report = CommissionReport()
+        report.execId, report.commission = execution.execId, 2.0
+        status = (orderId, FILLED, 20000.0, 0.0, 1.1, order.permId, 0, 1.1,
+                  0, "", 0.0)
+        for function, args in (
+                (store.update_status, status), (journal.write_status, status),
+                (store.add_execution, (execution, symbol_contract)),
+                (journal.write_execution, (execution, symbol_contract)),
+                (store.add_commission, (report,)),
+                (journal.write_commission, (report,))):
+            function(*args)
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = OrderStore()
+        journal = OrderJournal(directory, store, compact_every=20000)
+        journal.load()
+        start = time.perf_counter()
+        for orderId in range(1, nb_of_orders + 1):
+            trade(journal, store, orderId)
+        elapsed = time.perf_counter() - start
+        print(f"{nb_of_orders} orders traded in {elapsed:.2f} s, "
+              f"{len(store)} left in memory after {journal.nb_of_archives} "
+              f"compactions")
+        working = {orderId: (store[orderId].status, store[orderId].filled)
+                   for orderId in store if store[orderId].is_working}
+
+        # a crash : the journal isn't compacted at the end, its last record
+        # is cut
+        journal._file.write(b"\x00" * 7)
+        journal._file.close()
+        journal._file = None
+        size = os.path.getsize(os.path.join(directory, journal_name))
+        start = time.perf_counter()
+        reloaded = OrderJournal(directory).load()
+        elapsed = time.perf_counter() - start
+        same = working == {orderId: (reloaded[orderId].status,
+                                     reloaded[orderId].filled)
+                           for orderId in reloaded}
+        assert same
+        print(f"reloaded {len(reloaded)} working orders from a "
+              f"{size / 2**20:.2f} MiB journal in {elapsed * 1000:.1f} ms, "
+              f"same working orders : {same}")
+
+        start = time.perf_counter()
+        orders, fills = load_archive(directory)
+        elapsed = time.perf_counter() - start
+        assert orders["orderId"].shape[0] + len(working) == nb_of_orders
+        assert orders["commission"].sum() == 2 * fills["execId"].shape[0]
+        print(f"archive : {orders['orderId'].shape[0]} orders, "
+              f"{fills['execId'].shape[0]} fills loaded in "
+              f"{elapsed * 1000:.1f} ms, every order kept once : "
+              f"{orders['orderId'].shape[0] + len(working) == nb_of_orders}, "
+              f"commissions : {orders['commission'].sum():.0f} "
+              f"(expected {2 * fills['execId'].shape[0]})")
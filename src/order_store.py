@@ -0,0 +1,551 @@
+import threading
+import time
+
+"""
+This module will handle the bookkeeping of the orders : the data sent by TWS
+about every order (openOrder, orderStatus, execDetails and
+commissionReport callbacks), in one record per order.
+
+The orders are indexed by orderId, permId, execId (of their executions),
+parentId (the children of a bracket) and status, so every callback and
+query is O(1) without scanning the orders. The callbacks can arrive in any
+order, and for orders that weren't placed in this session (i.e still
+working from a previous session) : a missing record is created, a
+commission report arriving before its execution waits for it, and a late
+status can't bring a finished order back to a working state.
+
+The orders archived by the order journal are removed from the store, their
+ids are kept : the callbacks still arriving for them (a repeated status, an
+execution or a commission received late) are kept apart as late events
+instead of creating a new record (see pop_late_events).
+"""
+
+# variables :
+# the statuses of TWS
+PENDING_SUBMIT = "PendingSubmit"
+PENDING_CANCEL = "PendingCancel"
+PRE_SUBMITTED = "PreSubmitted"
+SUBMITTED = "Submitted"
+API_PENDING = "ApiPending"
+API_CANCELLED = "ApiCancelled"
+CANCELLED = "Cancelled"
+FILLED = "Filled"
+INACTIVE = "Inactive"
+PLACED = "Placed"  # sent, no status received yet
+terminal_states = (API_CANCELLED, CANCELLED, FILLED, INACTIVE)
+
+
+class OrderRecord:
+    """
+    Stores the information about an order.
+
+    ...
+
+    Attributes
+    ----------
+    orderId : int
+    contract : Contract
+    order : Order
+    orderState : OrderState
+        The last values received with openOrder, None before.
+    status : str
+        The last status received (PLACED before the first one).
+    filled, remaining, avgFillPrice, permId, parentId, lastFillPrice,
+    clientId, whyHeld, mktCapPrice
+        The last values received with orderStatus (parentId and permId can
+        also come from the order).
+    executions : dict
+        execId -> Execution, the fills of the order. None before the first
+        one, most orders are never filled.
+    commissions : dict
+        execId -> CommissionReport, the commissions of the fills. None
+        before the first one.
+    placed_time, update_time : float
+        When the order was placed (None if it wasn't placed in this session)
+        and when its last callback was received (time.time()).
+    """
+    __slots__ = ("orderId", "contract", "order", "orderState", "status",
+                 "filled", "remaining", "avgFillPrice", "permId", "parentId",
+                 "lastFillPrice", "clientId", "whyHeld", "mktCapPrice",
+                 "executions", "commissions", "placed_time", "update_time")
+
+    def __init__(self, orderId, contract=None, order=None):
+        self.orderId = orderId
+        self.contract = contract
+        self.order = order
+        self.orderState = None
+        self.status = PLACED
+        self.filled = 0.0
+        self.remaining = None
+        self.avgFillPrice = 0.0
+        self.permId = None
+        self.parentId = None
+        self.lastFillPrice = 0.0
+        self.clientId = None
+        self.whyHeld = ""
+        self.mktCapPrice = 0.0
+        self.executions = None
+        self.commissions = None
+        self.placed_time = None
+        self.update_time = time.time()
+
+    def __repr__(self):
+        return f"OrderRecord({self.orderId}, {self.status}, {self.filled})"
+
+    @property
+    def is_working(self):
+        return self.status not in terminal_states
+
+    @property
+    def commission(self):
+        """the sum of the commissions received for the fills."""
+        if self.commissions == None:
+            return 0.0
+        return sum(report.commission for report in self.commissions.values())
+
+
+class OrderStore:
+    """
+    Stores the OrderRecord of every order, indexed by orderId, permId,
+    execId, parentId and status.
+
+    ...
+
+    Methods (external)
+    -------
+    add, get, get_by_permId, get_by_execId, children, with_status, working,
+    remove, mark_archived, clear, get_waiting_commissions,
+    pop_waiting_commissions, pop_late_events
+
+    Methods (callbacks)
+    -------
+    update_open_order, update_status, add_execution, add_commission
+    """
+
+    def __init__(self):
+        self._by_orderId = {}
+        self._by_permId = {}
+        self._by_execId = {}
+        self._by_parentId = {}
+        self._by_status = {}
+        # execId -> (time received, CommissionReport)
+        self._waiting_commissions = {}
+        self._archived_orderIds = set()
+        self._archived_permIds = set()
+        self._archived_execIds = set()
+        self._late_events = []  # [(event name, args), ...]
+        self._lock = threading.RLock()
+
+    def __contains__(self, orderId):
+        return orderId in self._by_orderId
+
+    def __iter__(self):
+        return iter(list(self._by_orderId))
+
+    def __len__(self):
+        return len(self._by_orderId)
+
+    def __getitem__(self, orderId):
+        return self._by_orderId[orderId]
+
+    # external use
+    def add(self, orderId, contract=None, order=None):
+        """
+        registers an order placed (or about to be placed). An order already
+        known is updated (i.e an order modified by placing it again).
+
+        Returns:
+            OrderRecord: the record of the order.
+        """
+        with self._lock:
+            # a new order placed with the id of an archived one
+            self._archived_orderIds.discard(orderId)
+            record = self._get_or_create(orderId)
+            record.placed_time = time.time()
+            if contract != None:
+                record.contract = contract
+            if order != None:
+                self._set_order(record, order)
+            return record
+
+    def get(self, orderId):
+        """returns the OrderRecord of an orderId, or None."""
+        return self._by_orderId.get(orderId)
+
+    def get_by_permId(self, permId):
+        return self._by_permId.get(permId)
+
+    def get_by_execId(self, execId):
+        """returns the OrderRecord of the order of an execution, or None."""
+        return self._by_execId.get(execId)
+
+    def children(self, parentId):
+        """returns the orders attached to a parent order (see brackets)."""
+        with self._lock:
+            return [self._by_orderId[i]
+                    for i in self._by_parentId.get(parentId, ())]
+
+    def with_status(self, *statuses):
+        """returns the orders whose status is one of statuses."""
+        with self._lock:
+            return [self._by_orderId[i] for status in statuses
+                    for i in self._by_status.get(status, ())]
+
+    def working(self):
+        """returns the orders that aren't filled, cancelled or inactive."""
+        with self._lock:
+            return [self._by_orderId[i]
+                    for status, orderIds in self._by_status.items()
+                    if status not in terminal_states for i in orderIds]
+
+    def remove(self, orderId, archived=False):
+        """
+        forgets an order.
+
+        Args:
+            orderId (int): the order.
+            archived (bool, optional): Whether the order was archived : its
+            orderId, permId and execIds are kept so its late callbacks are
+            late events (see pop_late_events). Defaults to False.
+        """
+        with self._lock:
+            record = self._by_orderId.pop(orderId, None)
+            if record == None:
+                return
+            if archived:
+                self.mark_archived([orderId], [record.permId],
+                                   record.executions or ())
+            self._by_status[record.status].discard(orderId)
+            self._unset_parentId(record)
+            if self._by_permId.get(record.permId) is record:
+                del self._by_permId[record.permId]
+            for execId in record.executions or ():
+                self._by_execId.pop(execId, None)
+
+    def mark_archived(self, orderIds, permIds, execIds):
+        """registers the ids of orders archived (see remove)."""
+        with self._lock:
+            self._archived_orderIds.update(orderIds)
+            self._archived_permIds.update(p for p in permIds if p)
+            self._archived_execIds.update(execIds)
+
+    def clear(self):
+        # in place, the lock is shared with the threads waiting on it
+        with self._lock:
+            self._by_orderId.clear()
+            self._by_permId.clear()
+            self._by_execId.clear()
+            self._by_parentId.clear()
+            self._by_status.clear()
+            self._waiting_commissions.clear()
+            self._archived_orderIds.clear()
+            self._archived_permIds.clear()
+            self._archived_execIds.clear()
+            self._late_events.clear()
+
+    def pop_waiting_commissions(self, received_before=None):
+        """
+        returns and forgets the commission reports still waiting for their
+        execution.
+
+        Args:
+            received_before (float, optional): only the reports received
+            before this time (time.time()), the others can still get their
+            execution. Defaults to None which means every report.
+
+        Returns:
+            list of CommissionReport: the reports, oldest first.
+        """
+        with self._lock:
+            execIds = [execId for execId, (received, _) in
+                       self._waiting_commissions.items()
+                       if received_before == None
+                       or received < received_before]
+            return [self._waiting_commissions.pop(execId)[1]
+                    for execId in execIds]
+
+    def get_waiting_commissions(self):
+        """returns the (time received, CommissionReport) still waiting."""
+        with self._lock:
+            return list(self._waiting_commissions.values())
+
+    def pop_late_events(self):
+        """
+        returns and forgets the callbacks received for archived orders, in
+        the order they were received : ("status", args of update_status),
+        ("execution", Execution) and ("commission", CommissionReport). An
+        openOrder of an archived order is ignored.
+        """
+        with self._lock:
+            late_events = list(self._late_events)
+            self._late_events.clear()
+            return late_events
+
+    # callbacks
+    def update_open_order(self, orderId, contract, order, orderState):
+        with self._lock:
+            if self._is_archived(orderId, order.permId):
+                return None
+            record = self._get_or_create(orderId)
+            record.contract = contract
+            record.orderState = orderState
+            self._set_order(record, order)
+            record.update_time = time.time()
+            return record
+
+    def update_status(self, orderId, status, filled, remaining, avgFillPrice,
+                      permId, parentId, lastFillPrice, clientId, whyHeld,
+                      mktCapPrice):
+        """
+        stores the values of an orderStatus callback. A status received
+        after a terminal one (TWS can send them twice, or late) only updates
+        the fill values that moved forward.
+
+        Returns:
+            OrderRecord: the record of the order, None if it was archived.
+        """
+        with self._lock:
+            if self._is_archived(orderId, permId):
+                self._late_events.append(("status", (
+                    orderId, status, filled, remaining, avgFillPrice, permId,
+                    parentId, lastFillPrice, clientId, whyHeld, mktCapPrice)))
+                return None
+            record = self._get_or_create(orderId)
+            record.update_time = time.time()
+            if record.status in terminal_states and filled <= record.filled:
+                return record
+            if record.status not in terminal_states or \
+                    status in terminal_states:
+                self._set_status(record, status)
+            record.filled = filled
+            record.remaining = remaining
+            record.avgFillPrice = avgFillPrice
+            record.lastFillPrice = lastFillPrice
+            record.clientId = clientId
+            record.whyHeld = whyHeld
+            record.mktCapPrice = mktCapPrice
+            self._set_permId(record, permId)
+            self._set_parentId(record, parentId)
+            return record
+
+    def add_execution(self, execution, contract=None):
+        """
+        stores an execution (execDetails callback) and the commission report
+        that arrived before it, if any.
+
+        Returns:
+            OrderRecord: the record of the order, None if it was archived.
+        """
+        with self._lock:
+            if execution.execId in self._archived_execIds or \
+                    self._is_archived(execution.orderId, execution.permId):
+                self._late_events.append(("execution", execution))
+                return None
+            record = self._get_or_create(execution.orderId)
+            if record.contract == None:
+                record.contract = contract
+            if record.executions == None:
+                record.executions = {}
+            record.executions[execution.execId] = execution
+            self._by_execId[execution.execId] = record
+            self._set_permId(record, execution.permId)
+            waiting = self._waiting_commissions.pop(execution.execId, None)
+            if waiting != None:
+                self._add_commission(record, waiting[1])
+            record.update_time = time.time()
+            return record
+
+    def add_commission(self, commissionReport):
+        """
+        stores a commission report with the order of its execution.
+
+        Returns:
+            OrderRecord: the record of the order, None if the execution
+            hasn't been received yet (the report is stored with it when it
+            arrives) or if its order was archived.
+        """
+        execId = commissionReport.execId
+        with self._lock:
+            if execId in self._archived_execIds:
+                self._late_events.append(("commission", commissionReport))
+                return None
+            record = self._by_execId.get(execId)
+            if record == None:
+                self._waiting_commissions[execId] = (time.time(),
+                                                     commissionReport)
+                return None
+            self._add_commission(record, commissionReport)
+            record.update_time = time.time()
+            return record
+
+    # internal use
+    def _is_archived(self, orderId, permId):
+        if permId and permId in self._archived_permIds:
+            return True
+        return orderId in self._archived_orderIds and \
+            orderId not in self._by_orderId
+
+    def _get_or_create(self, orderId):
+        record = self._by_orderId.get(orderId)
+        if record == None:
+            record = OrderRecord(orderId)
+            self._by_orderId[orderId] = record
+            self._by_status.setdefault(record.status, set()).add(orderId)
+        return record
+
+    def _add_commission(self, record, commissionReport):
+        if record.commissions == None:
+            record.commissions = {}
+        record.commissions[commissionReport.execId] = commissionReport
+
+    def _set_order(self, record, order):
+        record.order = order
+        self._set_permId(record, order.permId)
+        self._set_parentId(record, order.parentId)
+
+    def _set_status(self, record, status):
+        if status == record.status:
+            return
+        self._by_status[record.status].discard(record.orderId)
+        self._by_status.setdefault(status, set()).add(record.orderId)
+        record.status = status
+
+    def _set_permId(self, record, permId):
+        if permId and permId != record.permId:
+            if self._by_permId.get(record.permId) is record:
+                del self._by_permId[record.permId]
+            record.permId = permId
+            self._by_permId[permId] = record
+
+    def _set_parentId(self, record, parentId):
+        if parentId != None and parentId != record.parentId:
+            self._unset_parentId(record)
+            record.parentId = parentId
+            if parentId:
+                # lists, a parent has a few children
+                self._by_parentId.setdefault(parentId, []).append(
+                    record.orderId)
+
+    def _unset_parentId(self, record):
+        children = self._by_parentId.get(record.parentId)
+        if children != None and record.orderId in children:
+            children.remove(record.orderId)
+            if not children:
+                del self._by_parentId[record.parentId]
+
+
+# program :
+if __name__ == "__main__":
+    import random
+    import tracemalloc
+
+    from ibapi.commission_report import CommissionReport
+    from ibapi.execution import Execution
+    from ibapi.order import Order
+
+    nb_of_orders = 20000
+    random.seed(0)
+
+    def make_callbacks(orderId):
+        """the callbacks of a filled order, with the commission report
+        sometimes before its execution."""
+        order = Order()
+        order.orderId, order.permId = orderId, 10**6 + orderId
+        order.parentId = orderId - 1 if orderId % 3 else 0
+        execution = Execution()
+        execution.orderId, execution.permId = orderId, order.permId
+        execution.execId = f"0001f4e8.{orderId}.01.01"
+        report = CommissionReport()
+        report.execId, report.commission = execution.execId, 2.0
+        callbacks = [("status", (orderId, SUBMITTED, 0.0, 20000.0, 0.0,
+                                 order.permId, order.parentId, 0.0, 0, "",
+                                 0.0)),
+                     ("status", (orderId, FILLED, 20000.0, 0.0, 1.1,
+                                 order.permId, order.parentId, 1.1, 0, "",
+                                 0.0)),
+                     ("execution", (execution,)),
+                     ("commission", (report,))]
+        if orderId % 5 == 0:
+            callbacks[2], callbacks[3] = callbacks[3], callbacks[2]
+        if orderId % 7 == 0:  # a late status after the fill
+            callbacks.append(callbacks[0])
+        return order, callbacks
+
+    # the dictionnaries used before, with the scan of commissionReport
+    def dict_store(all_callbacks):
+        orders = {}
+        for order, callbacks in all_callbacks:
+            orders[order.orderId] = dict.fromkeys(
+                ["contract", "order", "orderStatus", "orderId", "status",
+                 "filled", "remaining", "avgFillPrice", "permId", "parentId",
+                 "lastFillPrice", "clientId", "whyHeld", "mktCapPrice",
+                 "execution", "commissionReport"])
+        for order, callbacks in all_callbacks:
+            for kind, args in callbacks:
+                if kind == "status":
+                    orders[args[0]]["status"] = args[1]
+                    for key, value in zip(["filled", "remaining",
+                                           "avgFillPrice", "permId",
+                                           "parentId", "lastFillPrice",
+                                           "clientId", "whyHeld",
+                                           "mktCapPrice"], args[2:]):
+                        orders[args[0]][key] = value
+                elif kind == "execution":
+                    orders[args[0].orderId]["execution"] = args[0]
+                else:
+                    for orderId in orders:
+                        execution = orders[orderId]["execution"]
+                        if execution != None and \
+                                execution.execId == args[0].execId:
+                            orders[orderId]["commissionReport"] = args[0]
+        return orders
+
+    def indexed_store(all_callbacks):
+        store = OrderStore()
+        for order, callbacks in all_callbacks:
+            store.add(order.orderId, None, order)
+        for order, callbacks in all_callbacks:
+            for kind, args in callbacks:
+                if kind == "status":
+                    store.update_status(*args)
+                elif kind == "execution":
+                    store.add_execution(*args)
+                else:
+                    store.add_commission(*args)
+        return store
+
+    all_callbacks = [make_callbacks(i) for i in range(1, nb_of_orders + 1)]
+    for name, function in (("dict of dicts", dict_store),
+                           ("OrderStore", indexed_store)):
+        start = time.perf_counter()
+        tracemalloc.start()
+        result = function(all_callbacks[:2000])
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        elapsed = time.perf_counter() - start
+        print(f"{name:<14} 2000 orders : {elapsed * 1000:8.1f} ms, "
+              f"{memory / 2000:5.0f} bytes per order")
+
+    # the orders still working have no executions nor commissions
+    working = [(order, callbacks[:1]) for order, callbacks in
+               all_callbacks[:2000]]
+    tracemalloc.start()
+    result = indexed_store(working)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"OrderStore     2000 working orders : {memory / 2000:5.0f} bytes "
+          "per order")
+
+    start = time.perf_counter()
+    store = indexed_store(all_callbacks)
+    elapsed = time.perf_counter() - start
+    print(f"OrderStore {nb_of_orders} orders : {elapsed * 1000:.1f} ms "
+          f"({elapsed / nb_of_orders / 4 * 1e6:.2f} us per callback)")
+    record = store.get(35)
+    print(record, "commission :", record.commission,
+          "children of 34 :", store.children(34),
+          "by permId :", store.get_by_permId(10**6 + 35) is record,
+          "working :", len(store.working()),
+          "filled :", len(store.with_status(FILLED)),
+          "all commissions :", all(r.commission == 2.0
+                                   for r in map(store.get, store)))
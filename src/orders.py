@@ -91,7 +91,14 @@ def usd_to_currency(usd_value, to_currency):
             f"asked currency rate for {to_currency}/USD but it doesn't exist")
 
 
+def on_settings_change(key, value):
+    global currency_rates_api_key
+    currency_rates_api_key = value
+
+
 # program :
+settings.subscribe(on_settings_change, "freecurrencyapi_key")
+
 if __name__ == "__main__":
     print(usd_to_currency(500, "EUR"))
     print(usd_to_currency(500, "GBP"))
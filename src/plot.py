@@ -19,8 +19,37 @@ def plot_mkt_data(data, title=""):
     fig.show()
 
 
-def plot_strategy_results(results):
-    pass
+def plot_strategy_results(results, title=""):
+    """
+    plots the close prices with the fills, the equity and the drawdown of
+    a backtest.
+
+    Args:
+        results (backtest.BacktestResults): the results of backtest.run.
+    """
+    dates = np.array([datetime.fromtimestamp(ts) for ts in
+                      results.timestamps.tolist()], dtype="object")
+    fig, (price_ax, equity_ax, drawdown_ax) = plt.subplots(
+        3, 1, sharex=True, figsize=(15, 10),
+        gridspec_kw={"height_ratios": [3, 2, 1]})
+    fig.suptitle(title)
+
+    price_ax.plot(dates, results.data[:, 4], linewidth=0.8)
+    buys = results.fills["index"][results.fills["quantity"] > 0]
+    sells = results.fills["index"][results.fills["quantity"] < 0]
+    price_ax.scatter(dates[buys], results.data[buys, 1], marker="^",
+                     color="green", s=20, label="buy")
+    price_ax.scatter(dates[sells], results.data[sells, 1], marker="v",
+                     color="red", s=20, label="sell")
+    price_ax.set_ylabel("Price")
+    price_ax.legend()
+
+    equity_ax.plot(dates, results.equity)
+    equity_ax.set_ylabel("Equity")
+    drawdown_ax.fill_between(dates, results.drawdown, 0, color="red",
+                             alpha=0.3)
+    drawdown_ax.set_ylabel("Drawdown")
+    plt.show()
 
 
 def plot_rsi(data):
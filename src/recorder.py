@@ -0,0 +1,313 @@
+import mmap
+import pickle
+import struct
+import threading
+import time
+
+from ib_codec import decode_object, encode_object
+
+"""
+This module will handle the recording of the callbacks of an IBApi object
+to a binary journal, and their replay into another IBApi object at real,
+scaled or maximum speed, to profile the whole callback pipeline offline.
+
+Journal format : the header (magic, wall clock time of the start), then one
+record per event :
+    - time since the start (monotonic clock, float64), event code (uint8),
+        size of the payload (uint32),
+    - the payload : the arguments of the callback. The bars of
+        historicalData and historicalDataUpdate are packed with struct, the
+        arguments of the other callbacks are pickled.
+Besides the callbacks, the journal records the requests and orders sent
+and the series derived ("request", "order" and "derive" events) so the
+replay has the state the callbacks need (see IBApi.data_requests,
+IBApi.init_order and BarStore.derive). The contract and the
+order of an "order" event are stored with ib_codec.
+
+Recording is opt-in with the "callback_journal_path" setting (see
+session.start_session), or :
+    recorder = Recorder("session.journal")
+    recorder.attach(ib)
+"""
+
+# variables :
+magic = b"IBJ2"
+header = struct.Struct("<4sd")
+record_header = struct.Struct("<dBI")
+bar_struct = struct.Struct("<i6di")  # the volume is a Decimal in ibapi
+callbacks = ["historicalData", "historicalDataEnd", "historicalDataUpdate",
+             "orderStatus", "openOrder", "execDetails", "commissionReport",
+             "updateAccountValue", "updatePortfolio", "updateAccountTime",
+             "accountDownloadEnd", "nextValidId", "error"]
+events = ["request", "order"] + callbacks + ["derive"]
+event_codes = {name: code for code, name in enumerate(events)}
+bar_events = (event_codes["historicalData"],
+              event_codes["historicalDataUpdate"])
+
+
+class BarData:
+    """the bars of the journal, the same attributes as ibapi's BarData."""
+    __slots__ = ("date", "open", "high", "low", "close", "volume", "average",
+                 "barCount")
+
+    def __init__(self, date, open, high, low, close, average, volume,
+                 barCount):
+        self.date = date
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.average = average
+        self.volume = volume
+        self.barCount = barCount
+
+
+class Recorder:
+    """
+    Records the callbacks of IBApi objects to a journal.
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        The path of the journal.
+    nb_of_events : int
+        The number of events recorded.
+
+    Methods (external)
+    -------
+    attach, detach, close
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.nb_of_events = 0
+        self._file = open(path, "wb")
+        self._file.write(header.pack(magic, time.time()))
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+        self._attached = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # external use
+    def attach(self, ib):
+        """
+        records the callbacks of an IBApi object from now on. The methods
+        are wrapped on the object, its class isn't modified.
+        """
+        for name in callbacks:
+            setattr(ib, name, self._wrap(name, getattr(ib, name)))
+
+        reqHistoricalData, placeOrder = ib.reqHistoricalData, ib.placeOrder
+
+        def record_request(reqId, *args):
+            symbol, barsize = ib.data_requests.get_info(reqId)
+            keep_up_to_date = args[-2]
+            self.write(event_codes["request"], (reqId, symbol, barsize,
+                                                keep_up_to_date))
+            reqHistoricalData(reqId, *args)
+
+        def record_order(orderId, contract, order):
+            self.write(event_codes["order"], (orderId, encode_object(contract),
+                                              encode_object(order)))
+            placeOrder(orderId, contract, order)
+
+        derive = ib.market.derive
+
+        def record_derive(symbol, barsize, base_barsize, *args):
+            self.write(event_codes["derive"], (symbol, barsize, base_barsize)
+                       + args)
+            derive(symbol, barsize, base_barsize, *args)
+
+        ib.reqHistoricalData = record_request
+        ib.placeOrder = record_order
+        ib.market.derive = record_derive
+        self._attached.append(ib)
+
+    def detach(self, ib):
+        for name in callbacks + ["reqHistoricalData", "placeOrder"]:
+            ib.__dict__.pop(name, None)
+        ib.market.__dict__.pop("derive", None)
+        if ib in self._attached:
+            self._attached.remove(ib)
+
+    def close(self):
+        for ib in list(self._attached):
+            self.detach(ib)
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    # internal use
+    def write(self, code, args):
+        if code in bar_events:
+            reqId, bar = args
+            date = bar.date.encode()
+            payload = bar_struct.pack(reqId, bar.open, bar.high, bar.low,
+                                      bar.close, bar.average,
+                                      float(bar.volume), bar.barCount) + date
+        else:
+            payload = pickle.dumps(args, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(record_header.pack(
+                time.monotonic() - self._start, code, len(payload)))
+            self._file.write(payload)
+            self.nb_of_events += 1
+
+    def _wrap(self, name, method):
+        code = event_codes[name]
+
+        def record(*args):
+            self.write(code, args)
+            return method(*args)
+        return record
+
+
+# external use :
+def read_journal(path):
+    """
+    yields the events of a journal.
+
+    Yields:
+        tuple: (seconds since the start of the recording, event name,
+        arguments).
+    """
+    with open(path, "rb") as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        if buffer[:4] != magic:
+            raise ValueError(f"{path} isn't a callback journal")
+        offset = header.size
+        end = len(buffer)
+        while offset + record_header.size <= end:
+            seconds, code, size = record_header.unpack_from(buffer, offset)
+            offset += record_header.size
+            if offset + size > end:
+                break  # record cut by the end of the recording
+            if code in bar_events:
+                reqId, *values = bar_struct.unpack_from(buffer, offset)
+                date = bytes(buffer[offset + bar_struct.size:offset + size])
+                args = (reqId, BarData(date.decode(), *values))
+            else:
+                args = pickle.loads(buffer[offset:offset + size])
+            offset += size
+            yield seconds, events[code], args
+
+
+def replay(path, ib, speed=None):
+    """
+    feeds the events of a journal to an IBApi object, which doesn't need to
+    be connected.
+
+    Args:
+        path (str): the path of the journal.
+        ib (IBApi obj): the IBApi object receiving the callbacks.
+        speed (float, optional): 1 for the recorded pace, 10 for 10 times
+        faster... Defaults to None which means as fast as possible.
+
+    Returns:
+        dict: "events", "seconds" (duration of the replay), "events_per_sec"
+        and "by_callback" : {name: [number of calls, seconds spent]}.
+    """
+    by_callback = {}
+    nb_of_events = 0
+    start = time.perf_counter()
+    for seconds, name, args in read_journal(path):
+        if speed != None:
+            delay = seconds / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        call_start = time.perf_counter()
+        if name == "request":
+            replay_request(ib, *args)
+        elif name == "derive":
+            ib.market.derive(*args)
+        elif name == "order":
+            orderId, contract, order = args
+            ib.init_order(orderId, decode_object(contract),
+                          decode_object(order))
+        else:
+            getattr(ib, name)(*args)
+        stats = by_callback.setdefault(name, [0, 0.0])
+        stats[0] += 1
+        stats[1] += time.perf_counter() - call_start
+        nb_of_events += 1
+    elapsed = time.perf_counter() - start
+    return {"events": nb_of_events, "seconds": elapsed,
+            "events_per_sec": nb_of_events / elapsed if elapsed else 0.0,
+            "by_callback": by_callback}
+
+
+# internal use :
+def replay_request(ib, reqId, symbol, barsize, keep_up_to_date):
+    """registers a recorded request like IBApi.reqHistoricalData, unsent."""
+    ib.data_requests.add(reqId, symbol, barsize)
+    ib.data_requests.start(reqId, keep_up_to_date)
+    if (symbol, barsize) not in ib.market:
+        ib.market.reset(symbol, barsize)
+    ib.bar_buffers.pop(reqId, None)
+
+
+# program :
+if __name__ == "__main__":
+    # records a session with the fake TWS, then replays it at the recorded
+    # pace and as fast as possible.
+    import os
+    import tempfile
+
+    import numpy as np
+
+    import contract
+    import fake_tws
+    import ib_interface
+    import log
+    import market_data
+
+    log.log = lambda *k, **kw: None
+    symbols = ["EUR/USD", "GBP/USD", "USD/JPY", "AUD/USD"]
+    timeframes = [("1 min", "1 W"), ("1 hour", "6 M")]
+
+    with tempfile.TemporaryDirectory() as directory, \
+            fake_tws.FakeTWS(latency=(0.01, 0.03), update_interval=0.01) \
+            as tws:
+        path = os.path.join(directory, "session.journal")
+        ib = ib_interface.IBApi()
+        recorder = Recorder(path)
+        recorder.attach(ib)
+        ib.connect("127.0.0.1", tws.port, 0)
+        threading.Thread(target=ib.run, daemon=True).start()
+        time.sleep(0.2)
+        market_data.ask_data(ib, symbols, timeframes, use_cache=False)
+        reqId = ib.nextReqId
+        ib.nextReqId += 1
+        ib.data_requests.add(reqId, "EUR/USD", "1 min", True)
+        ib.reqHistoricalData(reqId, contract.get_contract("EUR/USD"), "",
+                             "1 D", "1 min", "BID", 0, 2, True, [])
+        time.sleep(1)
+        ib.disconnect()
+        recorder.close()
+        size = os.path.getsize(path)
+        print(f"recorded {recorder.nb_of_events} events, {size / 2**20:.1f} "
+              f"MiB ({size / recorder.nb_of_events:.0f} bytes per event)")
+
+        for speed in (1, None):
+            replayed = ib_interface.IBApi()
+            result = replay(path, replayed, speed)
+            same = all(np.array_equal(
+                ib.market.get(s, bs).view(), replayed.market.get(s, bs).view())
+                for s, bs in ib.market.keys())
+            print(f"speed {speed} : {result['events']} events in "
+                  f"{result['seconds']:.2f} s, "
+                  f"{result['events_per_sec']:.0f} events/s, "
+                  f"same market data : {same}")
+        for name, (count, seconds) in sorted(result["by_callback"].items(),
+                                             key=lambda item: -item[1][1]):
+            print(f"    {name:<22} {count:>8} calls "
+                  f"{seconds / count * 1e6:8.2f} us/call")
@@ -0,0 +1,296 @@
+import threading
+import time
+
+"""
+This module will handle the bookkeeping of the market data requests : which
+(symbol, barsize) a request Id is for, in which state the request is and how
+much data it received.
+"""
+
+# variables :
+PENDING = "pending"  # asked, waiting for the data
+STREAMING = "streaming"  # data received, updates still coming (keepUpToDate)
+DONE = "done"  # all the data has been received
+CANCELLED = "cancelled"
+FAILED = "failed"  # TWS answered with an error
+active_states = (PENDING, STREAMING)
+
+
+class DataRequest:
+    """
+    Stores the information about a market data request.
+
+    ...
+
+    Attributes
+    ----------
+    reqId : int
+    symbol : str
+    barsize : str
+    state : str
+        One of PENDING, STREAMING, DONE, CANCELLED and FAILED.
+    keep_up_to_date : bool
+        Whether TWS keeps sending updates after the historical data.
+    bars_received : int
+        The number of historical bars received.
+    updates_received : int
+        The number of bar updates received (keepUpToDate requests).
+    start_time, end_time : float
+        When the request was sent and when its historical data ended
+        (time.monotonic()).
+    completed : threading.Event
+        Set when the request leaves the PENDING state (its historical data
+        ended, it was cancelled or it failed).
+    error : tuple
+        (errorCode, errorMsg) if the request failed, else None.
+    """
+    __slots__ = ("reqId", "symbol", "barsize", "state", "keep_up_to_date",
+                 "bars_received", "updates_received", "start_time",
+                 "end_time", "completed", "error")
+
+    def __init__(self, reqId, symbol, barsize, keep_up_to_date=False):
+        self.reqId = reqId
+        self.symbol = symbol
+        self.barsize = barsize
+        self.state = PENDING
+        self.keep_up_to_date = keep_up_to_date
+        self.bars_received = 0
+        self.updates_received = 0
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self.completed = threading.Event()
+        self.error = None
+
+    def __repr__(self):
+        return (f"DataRequest({self.reqId}, {self.symbol!r}, "
+                f"{self.barsize!r}, {self.state})")
+
+    @property
+    def info(self):
+        return (self.symbol, self.barsize)
+
+    @property
+    def time_to_completion(self):
+        """
+        seconds between the request and the end of its historical data, None
+        if it's not finished.
+        """
+        if self.end_time == None:
+            return None
+        return self.end_time - self.start_time
+
+    def wait(self, timeout=None):
+        """
+        waits until the request isn't pending anymore.
+
+        Returns:
+            bool: False if the timeout expired before.
+        """
+        return self.completed.wait(timeout)
+
+
+class RequestRegistry:
+    """
+    Maps request Ids to (symbol, barsize) and back in O(1).
+
+    ...
+
+    Methods (external)
+    -------
+    add, get, get_info, get_reqId, start, end, cancel, fail, remove, clear,
+    active, pending, wait, wait_symbol, wait_all, changes, wait_for_change
+    """
+
+    def __init__(self):
+        self._by_reqId = {}
+        self._by_info = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition()
+        self._nb_of_changes = 0
+
+    def __contains__(self, reqId):
+        return reqId in self._by_reqId
+
+    def __iter__(self):
+        return iter(list(self._by_reqId))
+
+    def __len__(self):
+        return len(self._by_reqId)
+
+    # external use
+    def add(self, reqId, symbol, barsize, keep_up_to_date=False):
+        """
+        registers a request. (symbol, barsize) is then mapped to this
+        request. A previous request for the same symbol and barsize is
+        forgotten, unless it's still active (i.e several requests filling
+        different periods).
+
+        Returns:
+            DataRequest: the new request.
+        """
+        request = DataRequest(reqId, symbol, barsize, keep_up_to_date)
+        with self._lock:
+            old_request = self._by_reqId.get(self._by_info.get(request.info))
+            if old_request != None and old_request.state not in active_states:
+                del self._by_reqId[old_request.reqId]
+            self._by_reqId[reqId] = request
+            self._by_info[request.info] = reqId
+        return request
+
+    def get(self, reqId):
+        """returns the DataRequest of a request Id, or None."""
+        return self._by_reqId.get(reqId)
+
+    def get_info(self, reqId):
+        """returns the (symbol, barsize) of a request Id."""
+        return self._by_reqId[reqId].info
+
+    def get_reqId(self, symbol, barsize):
+        """returns the request Id of a symbol and barsize, or None."""
+        return self._by_info.get((symbol, barsize))
+
+    def start(self, reqId, keep_up_to_date=False):
+        """marks a request as sent."""
+        request = self._by_reqId[reqId]
+        request.state = PENDING
+        request.keep_up_to_date = bool(keep_up_to_date)
+        request.start_time = time.monotonic()
+        request.end_time = None
+        request.error = None
+        request.completed.clear()
+
+    def end(self, reqId):
+        """marks the end of the historical data of a request."""
+        request = self._by_reqId.get(reqId)
+        if request == None or request.state != PENDING:
+            return
+        request.end_time = time.monotonic()
+        request.state = STREAMING if request.keep_up_to_date else DONE
+        request.completed.set()
+        self._notify_change()
+
+    def cancel(self, reqId):
+        request = self._by_reqId.get(reqId)
+        if request != None and request.state in active_states:
+            request.state = CANCELLED
+            request.completed.set()
+            self._notify_change()
+
+    def fail(self, reqId, errorCode, errorMsg):
+        """marks a request as failed because of a TWS error."""
+        request = self._by_reqId.get(reqId)
+        if request == None or request.state not in active_states:
+            return
+        request.state = FAILED
+        request.error = (errorCode, errorMsg)
+        request.end_time = time.monotonic()
+        request.completed.set()
+        self._notify_change()
+
+    def remove(self, reqId):
+        with self._lock:
+            request = self._by_reqId.pop(reqId, None)
+            if request == None:
+                return
+            if self._by_info.get(request.info) == reqId:
+                del self._by_info[request.info]
+        forget(request)
+        self._notify_change()
+
+    def clear(self):
+        with self._lock:
+            requests = list(self._by_reqId.values())
+            self._by_reqId = {}
+            self._by_info = {}
+        for request in requests:
+            forget(request)
+        self._notify_change()
+
+    def active(self, symbol=None):
+        """
+        returns the requests that are pending or streaming, for every symbol
+        or only for one.
+        """
+        return [r for r in list(self._by_reqId.values())
+                if r.state in active_states
+                and (symbol == None or r.symbol == symbol)]
+
+    def pending(self, symbol=None):
+        """returns the requests still waiting for their historical data."""
+        return [r for r in list(self._by_reqId.values())
+                if r.state == PENDING
+                and (symbol == None or r.symbol == symbol)]
+
+    def wait(self, reqIds, timeout=None):
+        """
+        waits until none of the requests is pending anymore, without
+        spinning.
+
+        Args:
+            reqIds (int or list of int): the request Ids.
+            timeout (float, optional): max number of seconds to wait.
+            Defaults to None which means no limit.
+
+        Returns:
+            bool: False if the timeout expired before.
+        """
+        if isinstance(reqIds, int):
+            reqIds = [reqIds]
+        requests = [self._by_reqId[i] for i in reqIds if i in self._by_reqId]
+        return wait_requests(requests, timeout)
+
+    def wait_symbol(self, symbol, timeout=None):
+        """waits for every pending request of a symbol (see wait)."""
+        return wait_requests(self.pending(symbol), timeout)
+
+    def wait_all(self, timeout=None):
+        """waits for every pending request (see wait)."""
+        return wait_requests(self.pending(), timeout)
+
+    def changes(self):
+        """
+        returns the number of times a request completed, failed, was
+        cancelled or removed so far (see wait_for_change).
+        """
+        return self._nb_of_changes
+
+    def wait_for_change(self, seen, timeout=None):
+        """
+        waits until a request completes, fails, is cancelled or removed.
+
+        Args:
+            seen (int): the value of changes() the caller already knows.
+            timeout (float, optional): max number of seconds to wait.
+
+        Returns:
+            int: the new value of changes().
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self._nb_of_changes != seen,
+                                   timeout)
+            return self._nb_of_changes
+
+    # internal use
+    def _notify_change(self):
+        with self._changed:
+            self._nb_of_changes += 1
+            self._changed.notify_all()
+
+
+# internal use :
+def forget(request):
+    """cancels a request removed from the registry and wakes its waiters."""
+    if request.state in active_states:
+        request.state = CANCELLED
+    request.completed.set()
+
+
+def wait_requests(requests, timeout=None):
+    deadline = None if timeout == None else time.monotonic() + timeout
+    for request in requests:
+        remaining = None
+        if deadline != None:
+            remaining = max(deadline - time.monotonic(), 0)
+        if not request.wait(remaining):
+            return False
+    return True
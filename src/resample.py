@@ -0,0 +1,251 @@
+from datetime import datetime, timedelta, time as day_time
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from bar_dates import barsize_to_seconds
+
+"""
+This module will handle the resampling of bars to a higher timeframe (i.e
+5 mins, 1 hour or 1 day bars from 1 min bars), so only the bars of the
+lowest timeframe need to be streamed from TWS.
+
+The bars are grouped by session : a session starts every day at the same
+local time (17:00 New York time for forex, including the daylight saving
+changes). Daily bars cover a session, intraday bars are aligned on the start
+of their session (i.e the 4 hours bars start at 17:00, 21:00, 01:00... New
+York time). A derived bar is stamped with the start of its period, like the
+intraday bars of TWS.
+
+resample converts an array of bars at once, a Resampler keeps a BarSeries
+of derived bars up to date with its base series while new bars arrive (see
+BarStore.derive).
+"""
+
+# variables :
+default_session = ("17:00", "America/New_York")
+day = 86400
+
+
+class Resampler:
+    """
+    Keeps the bars of a higher timeframe up to date with a base series.
+
+    ...
+
+    Attributes
+    ----------
+    base : BarSeries
+        The bars of the lowest timeframe (i.e 1 min).
+    series : BarSeries
+        The derived bars. Its bars before the first resampled bar are kept
+        (i.e a longer history asked to TWS), the others are replaced by the
+        resampled ones.
+    barsize : str
+        The barsize of the derived bars.
+    session : tuple
+        (start time, timezone) of the sessions.
+
+    Methods (external)
+    -------
+    update, reset
+    """
+
+    def __init__(self, base, series, barsize, base_barsize,
+                 session=default_session):
+        check_barsizes(barsize, base_barsize)
+        self.base = base
+        self.series = series
+        self.barsize = barsize
+        self.session = session
+        self.reset()
+
+    # external use
+    def update(self):
+        """
+        resamples the base bars added or revised since the last update,
+        everything when older bars changed.
+
+        Returns:
+            BarSeries: the derived series.
+        """
+        base, series = self.base, self.series
+        if base.version == self._version and base.size == self._base_size \
+                and series.version == self._series_version and \
+                (base.size == 0 or
+                 np.array_equal(base.view(1)[0], self._last_bar)):
+            return series
+
+        bars = base.view()
+        if base.version != self._version or base.size < self._base_size \
+                or series.version != self._series_version:
+            derived = resample(bars, self.barsize, self.session)
+            history = series.view()
+            if derived.shape[0]:
+                cut = np.searchsorted(history[:, 0], derived[0, 0])
+                if bars[0, 0] > derived[0, 0] and cut < history.shape[0] \
+                        and history[cut, 0] == derived[0, 0]:
+                    # the first bin misses its first bars, the complete bar
+                    # of the history is better
+                    cut += 1
+                    derived = derived[1:]
+                history = history[:cut]
+            bars_kept = np.concatenate((history, derived))
+            series.clear()
+            series.extend(bars_kept)
+        else:
+            derived = resample(bars[self._start:], self.barsize, self.session)
+            if derived.shape[0]:
+                series.upsert(*derived[0])
+                series.extend(derived[1:])
+
+        if derived.shape[0]:
+            self._start = int(np.searchsorted(bars[:, 0], derived[-1, 0]))
+        self._version = base.version
+        self._series_version = series.version
+        self._base_size = base.size
+        self._last_bar = bars[-1].copy() if bars.shape[0] else None
+        return series
+
+    def reset(self):
+        """resamples all the base bars at the next update."""
+        self._version = None
+        self._series_version = None
+        self._base_size = 0
+        self._last_bar = None
+        self._start = 0  # index in base of the first bar of the last bin
+
+
+# external use :
+def resample(bars, barsize, session=default_session):
+    """
+    converts bars to a higher timeframe.
+
+    Args:
+        bars (np.ndarray): market data (format of market_data.get_data).
+        barsize (str): the barsize of the output (i.e "15 mins", "4 hours",
+        "1 day").
+        session (tuple, optional): (start time, timezone) of the sessions.
+        Defaults to 17:00 New York time.
+
+    Returns:
+        np.ndarray: the bars, stamped with the start of their period.
+    """
+    if bars.shape[0] == 0:
+        return np.empty((0, 5), dtype=np.float64)
+    bins = get_bins(bars[:, 0], barsize, session)
+    starts = np.concatenate(([0], np.flatnonzero(bins[1:] != bins[:-1]) + 1))
+    ends = np.append(starts[1:], bars.shape[0]) - 1
+    out = np.empty((starts.shape[0], 5), dtype=np.float64)
+    out[:, 0] = bins[starts]
+    out[:, 1] = bars[starts, 1]
+    out[:, 2] = np.maximum.reduceat(bars[:, 2], starts)
+    out[:, 3] = np.minimum.reduceat(bars[:, 3], starts)
+    out[:, 4] = bars[ends, 4]
+    return out
+
+
+def get_bins(timestamps, barsize, session=default_session):
+    """returns the start of the period of every (sorted) timestamp."""
+    bar_seconds = barsize_to_seconds(barsize)
+    sessions = get_sessions(timestamps[0], timestamps[-1], *session)
+    # a few sessions searched in the timestamps rather than the opposite
+    nb_of_bars = np.diff(np.searchsorted(timestamps, sessions))
+    session_starts = np.repeat(sessions[:-1], nb_of_bars)
+    if bar_seconds == day:
+        return session_starts
+    return session_starts + np.floor(
+        (timestamps - session_starts) / bar_seconds) * bar_seconds
+
+
+def get_sessions(first, last, start_time, timezone):
+    """
+    returns the start timestamps of the sessions from before first to after
+    last.
+    """
+    zone = ZoneInfo(timezone)
+    hour, minute = (int(x) for x in start_time.split(":"))
+    start_day = datetime.fromtimestamp(first, zone).date() - timedelta(1)
+    nb_of_days = (datetime.fromtimestamp(last, zone).date() - start_day).days
+    return np.array([datetime.combine(start_day + timedelta(i),
+                                      day_time(hour, minute),
+                                      zone).timestamp()
+                     for i in range(nb_of_days + 2)])
+
+
+def check_barsizes(barsize, base_barsize):
+    """
+    raises a ValueError if barsize can't be resampled from base_barsize.
+    """
+    bar_seconds = barsize_to_seconds(barsize)
+    base_seconds = barsize_to_seconds(base_barsize)
+    if bar_seconds % base_seconds or (bar_seconds != day and day % bar_seconds):
+        raise ValueError(f"{barsize} bars can't be resampled from "
+                         f"{base_barsize} bars")
+
+
+def is_derivable(barsize, base_barsize):
+    try:
+        check_barsizes(barsize, base_barsize)
+    except ValueError:
+        return False
+    return barsize_to_seconds(barsize) > barsize_to_seconds(base_barsize)
+
+
+# program :
+if __name__ == "__main__":
+    import time
+
+    import pandas as pd
+
+    from bar_store import BarSeries
+
+    # 2 years of 1 min bars, without the weekends
+    rng = np.random.default_rng(0)
+    timestamps = 1.6e9 + 60 * np.arange(2 * 365 * 1440)
+    weekday = pd.to_datetime(timestamps, unit="s", utc=True) \
+        .tz_convert("America/New_York").shift(7, freq="h").dayofweek
+    timestamps = timestamps[weekday < 5]
+    close = 1.2 + np.cumsum(rng.normal(0, 1e-4, timestamps.shape[0]))
+    open_ = np.concatenate(([close[0]], close[:-1]))
+    bars = np.column_stack((timestamps, open_,
+                            np.maximum(open_, close) + 5e-5,
+                            np.minimum(open_, close) - 5e-5, close))
+
+    # pandas with the same session alignment : shifting the New York time
+    # by 7 hours puts the start of the sessions at midnight
+    frame = pd.DataFrame(bars[:, 1:], columns=["open", "high", "low", "close"],
+                         index=pd.to_datetime(bars[:, 0], unit="s", utc=True)
+                         .tz_convert("America/New_York").shift(7, freq="h")
+                         .tz_localize(None))
+    aggregation = {"open": "first", "high": "max", "low": "min",
+                   "close": "last"}
+    for barsize, rule in (("5 mins", "5min"), ("1 hour", "1h"),
+                          ("4 hours", "4h"), ("1 day", "1D")):
+        start = time.perf_counter()
+        out = resample(bars, barsize)
+        elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        expected = frame.resample(rule).agg(aggregation).dropna()
+        elapsed_pandas = time.perf_counter() - start
+        print(f"{barsize:<8} {bars.shape[0]} bars -> {out.shape[0]} in "
+              f"{elapsed * 1000:5.1f} ms (pandas {elapsed_pandas * 1000:5.1f} "
+              f"ms), same as pandas : {np.array_equal(out[:, 1:], expected)}")
+
+    # incremental : the bars arrive one by one with a revision of each one
+    base, derived = BarSeries(), BarSeries()
+    base.extend(bars[:-5000])
+    resampler = Resampler(base, derived, "4 hours", "1 min")
+    resampler.update()
+    start = time.perf_counter()
+    for bar in bars[-5000:]:
+        revision = bar.copy()
+        revision[2] += 1e-3
+        base.upsert(*revision)
+        resampler.update()
+        base.upsert(*bar)
+        resampler.update()
+    elapsed = time.perf_counter() - start
+    print(f"incremental 4 hours bars : {elapsed / 10000 * 1e6:.1f} us per "
+          f"update, same as batch : "
+          f"{np.array_equal(derived.view(), resample(bars, '4 hours'))}")
@@ -3,6 +3,9 @@ import time
 
 import settings
 import log
+import bar_cache
+import order_journal
+import recorder
 
 
 def start_session(ib):
@@ -14,6 +17,19 @@ def start_session(ib):
     paper_trading = settings.get_settings("paper_trading")
     port = 7496 if not paper_trading else 7497
 
+    journal_path = settings.get_settings("callback_journal_path")
+    if journal_path:
+        log.log(f"recording the callbacks to {journal_path}")
+        ib.recorder = recorder.Recorder(journal_path)
+        ib.recorder.attach(ib)
+
+    journal_dir = settings.get_settings("order_journal_dir")
+    if journal_dir:
+        log.log(f"loading the orders of {journal_dir}")
+        ib.order_journal = order_journal.OrderJournal(journal_dir, ib.orders)
+        ib.order_journal.load()
+        log.log(f"{len(ib.orders)} orders loaded")
+
     log.log("connecting to the broker")
     ib.connect("127.0.0.1", port, 0)
     time.sleep(2)
@@ -34,9 +50,17 @@ def start_session(ib):
 
 
 def stop_session(ib):
+    log.log("saving market data")
+    bar_cache.save_all(ib.market)
     log.log("disconnecting from tws")
     ib.reqAccountUpdates(True, ib.account)
     ib.disconnect()
+    if ib.recorder != None:
+        ib.recorder.close()
+        ib.recorder = None
+    if ib.order_journal != None:
+        ib.order_journal.close()
+        ib.order_journal = None
 
 
 def start_bot(ib):
@@ -1,8 +1,15 @@
 import os
 import os.path
 import json
+import stat
+import tempfile
+import threading
 
-"""This module will handle everything setting related """
+"""
+This module will handle everything setting related. The settings file is
+parsed once and the settings are then served from memory. The file is only
+parsed again when its modification time or size changes.
+"""
 
 # variables
 path = r".settings.json"
@@ -20,8 +27,17 @@ default_settings = {
                    ("1 day", "2 Y")],
 
     "freecurrencyapi_key": "",  # get one at https://freecurrencyapi.net/
+    "bar_cache_dir": ".bar_cache",
+    # the daily sessions the bars are resampled on (see resample)
+    "session_start": ("17:00", "America/New_York"),
+    "callback_journal_path": "",  # records the callbacks when set (recorder)
+    "order_journal_dir": "",  # journals the orders when set (order_journal)
 
 }
+cached_settings = None
+cached_signature = None  # (mtime, size) of the file when it was parsed
+subscribers = []  # [(callback, keys), ...]
+lock = threading.RLock()
 
 
 # external use
@@ -31,9 +47,7 @@ def get_all_settings():
     Returns:
         dict: a dictionnary describing the user settings.
     """
-    with open(path, "r") as f:
-        settings = json.load(f)
-    return settings
+    return dict(load_settings())
 
 
 def get_settings(*keys):
@@ -47,27 +61,50 @@ def get_settings(*keys):
         * or list: the values of the settings. If multiple settings are asked,
         it returns a list with every value in order.
     """
-    settings = get_all_settings()
+    settings = load_settings()
     if len(keys) > 1:
         values = []
         for key in keys:
-            values.append(settings[key])
+            values.append(get_value(settings, key))
         return values
     else:
-        return settings[keys[0]]
+        return get_value(settings, keys[0])
 
 
 def update_settings(key, value):
     """
-    updates a setting.
+    updates a setting and notifies the subscribers of this setting.
 
     Args:
         key (string): the name of the setting.
         value (*): the new value of the specified setting.
     """
-    settings = get_all_settings()
-    settings[key] = value
-    dump_settings(settings)
+    with lock:
+        settings = dict(load_settings())
+        old_settings = cached_settings
+        settings[key] = value
+        dump_settings(settings)
+    notify(old_settings, settings)
+
+
+def subscribe(callback, *keys):
+    """
+    registers a function called when settings change (after update_settings
+    or when the settings file is modified by someone else).
+
+    Args:
+        callback (function): called as callback(key, value) for every
+        changed setting.
+        keys (str, optional): the settings to watch. Defaults to every
+        setting.
+    """
+    with lock:
+        subscribers.append((callback, set(keys)))
+
+
+def unsubscribe(callback):
+    with lock:
+        subscribers[:] = [s for s in subscribers if s[0] != callback]
 
 
 # internal use
@@ -84,15 +121,97 @@ def init_settings():
             json.dump(default_settings, f)
 
 
+def load_settings():
+    """
+    returns the cached settings, after parsing the settings file again if
+    it changed since the last parsing.
+    """
+    global cached_settings, cached_signature
+    with lock:
+        signature = get_signature()
+        if signature == cached_signature and cached_settings != None:
+            return cached_settings
+
+        old_settings = cached_settings
+        with open(path, "r") as f:
+            cached_settings = json.load(f)
+        cached_signature = signature
+        settings = cached_settings
+    if old_settings != None:
+        notify(old_settings, settings)
+    return settings
+
+
+def get_value(settings, key):
+    """
+    returns the value of a setting, or its default value if the settings
+    file was created before the setting existed.
+    """
+    if key in settings:
+        return settings[key]
+    return default_settings[key]
+
+
 def dump_settings(settings):
     """
-    overrides the settings with new settings.
+    overrides the settings with new settings. The file is replaced
+    atomically so a reader never sees a partially written file.
 
     Args:
         settings (dict): the new settings
     """
-    with open(path, "w") as f:
-        json.dump(settings, f)
+    global cached_settings, cached_signature
+    dirname = os.path.dirname(os.path.abspath(path))
+    with lock:
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".settings",
+                                        suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(settings, f)
+                f.flush()
+                os.fsync(f.fileno())
+            # mkstemp creates the file with the mode 0600
+            os.chmod(tmp_path, get_file_mode())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        cached_settings = settings
+        cached_signature = get_signature()
+
+
+def get_file_mode():
+    """
+    returns the permissions of the settings file, the default permissions
+    of a new file if it doesn't exist yet.
+    """
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def get_signature():
+    info = os.stat(path)
+    return (info.st_mtime_ns, info.st_size)
+
+
+def notify(old_settings, new_settings):
+    """calls the subscribers of the settings that changed."""
+    changed = [key for key in new_settings
+               if old_settings == None or key not in old_settings
+               or old_settings[key] != new_settings[key]]
+    if not changed:
+        return
+    with lock:
+        subs = list(subscribers)
+    for callback, keys in subs:
+        for key in changed:
+            if not keys or key in keys:
+                callback(key, new_settings[key])
 
 
 # program
@@ -0,0 +1,439 @@
+from collections import deque
+import math
+
+import numpy as np
+
+from vectorized_ema import ewma_vectorized_safe as ewma
+
+"""
+Module storing streaming versions of the technical indicators of the
+indicators module. They keep a state and update it with one bar at a time in
+constant time, instead of computing the indicator over the whole history.
+
+Rules for the classes :
+    - update(bar) takes a bar [timestamp, open, high, low, close]. A bar
+        with the same timestamp as the previous one is a revision of the
+        last bar (i.e a historicalDataUpdate), a bar with a greater timestamp
+        is a new bar.
+    - update returns the row of the batch version for this bar :
+        np.ndarray([timestamp, value1,...]), with np.nan when there is no
+        value yet.
+    - for the same bars, the rows are the same as the output of the
+        function of the indicators module with the same name (see
+        streaming_classes).
+"""
+
+# variables :
+resync_interval = 1000  # rolling sums are recomputed exactly this often
+
+
+class StreamingIndicator:
+    """
+    Base class of the streaming indicators. The state only contains the
+    committed bars ; the last bar stays pending until a newer bar arrives,
+    so it can be revised any number of times.
+
+    ...
+
+    Methods (external)
+    -------
+    update, run, warm_start
+
+    Methods (to implement)
+    -------
+    _compute(bar) : returns the values for the pending bar, without changing
+        the state.
+    _commit(bar) : adds the pending bar to the state.
+    _restore(data, result) : (optional) sets the averages of the state from
+        the output of the batch function, see warm_start.
+    """
+    nb_of_values = 1
+    lookback = None  # bars needed to refill the windows, None for all
+
+    def __init__(self):
+        self.timestamp = None
+        self.pending = None
+        self.last = None
+
+    # external use
+    def update(self, bar):
+        """
+        adds a new bar or revises the last one.
+
+        Args:
+            bar (array-like): [timestamp, open, high, low, close]
+
+        Returns:
+            np.ndarray: [timestamp, value1, ...]
+        """
+        timestamp = bar[0]
+        if self.timestamp != None:
+            if timestamp < self.timestamp:
+                raise ValueError("bars must be given in chronological order")
+            if timestamp > self.timestamp:
+                self._commit(self.pending)
+        self.timestamp = timestamp
+        self.pending = tuple(float(x) for x in bar[:5])
+        self.last = np.array((timestamp,) + tuple(self._compute(self.pending)),
+                             dtype=np.float64)
+        return self.last
+
+    def run(self, data):
+        """
+        updates the indicator with every bar of data.
+
+        Args:
+            data (np.ndarray): the bars (format of market_data.get_data).
+
+        Returns:
+            np.ndarray: one row per bar.
+        """
+        out = np.empty((data.shape[0], self.nb_of_values + 1), np.float64)
+        for i in range(data.shape[0]):
+            out[i] = self.update(data[i])
+        return out
+
+    def warm_start(self, data, result):
+        """
+        puts a new indicator in the state it would have after run(data)
+        without going through every bar : the windows are refilled with the
+        last {{lookback}} bars and the averages are taken from the output of
+        the batch function.
+
+        Args:
+            data (np.ndarray): the bars (format of market_data.get_data).
+            result (np.ndarray): the output of the batch function for data.
+        """
+        start = 0
+        if self.lookback != None:
+            start = max(data.shape[0] - self.lookback, 0)
+        for bar in data[start:]:
+            self.update(bar)
+        if start > 0:
+            self._restore(data, result)
+            self.last = np.array(
+                (self.timestamp,) + tuple(self._compute(self.pending)),
+                dtype=np.float64)
+
+    # internal use
+    def _compute(self, bar):
+        raise NotImplementedError
+
+    def _commit(self, bar):
+        raise NotImplementedError
+
+    def _restore(self, data, result):
+        pass
+
+
+class RollingWindow:
+    """
+    The last {{size}} values of a series and their sum, updated in O(1).
+    """
+
+    def __init__(self, size):
+        self.values = deque(maxlen=size)
+        self.sum = 0.0
+        self._nb_of_updates = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def full(self):
+        return len(self.values) == self.values.maxlen
+
+    def append(self, x):
+        """
+        adds a value, the oldest one is removed when the window is full.
+
+        Returns:
+            bool: True when the sum was recomputed exactly (every
+            resync_interval values), so the sums kept along it can be too.
+        """
+        if self.values.maxlen == 0:
+            return False
+        if self.full():
+            self.sum -= self.values[0]
+        self.values.append(x)
+        self.sum += x
+        self._nb_of_updates += 1
+        if self._nb_of_updates % resync_interval == 0:
+            # avoids the drift of the rounding errors
+            self.sum = math.fsum(self.values)
+            return True
+        return False
+
+
+class EwmaState:
+    """
+    An exponential moving average seeded with the first value, like
+    vectorized_ema.ewma_vectorized_safe.
+    """
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.value = None
+
+    def peek(self, x):
+        """returns the average after x, without changing the state."""
+        if self.value == None:
+            return x
+        return self.value + self.alpha * (x - self.value)
+
+    def push(self, x):
+        self.value = self.peek(x)
+
+
+class SMA(StreamingIndicator):
+    def __init__(self, window):
+        super().__init__()
+        self.window = window
+        self.lookback = window
+        self.closes = RollingWindow(window - 1)
+
+    def _compute(self, bar):
+        if len(self.closes) < self.window - 1:
+            return (np.nan,)
+        return ((self.closes.sum + bar[4]) / self.window,)
+
+    def _commit(self, bar):
+        self.closes.append(bar[4])
+
+
+class EMA(StreamingIndicator):
+    lookback = 1
+
+    def __init__(self, window):
+        super().__init__()
+        self.ewma = EwmaState(2 / (window + 1))
+
+    def _compute(self, bar):
+        return (self.ewma.peek(bar[4]),)
+
+    def _commit(self, bar):
+        self.ewma.push(bar[4])
+
+    def _restore(self, data, result):
+        self.ewma.value = result[-2, 1]
+
+
+class RSI(StreamingIndicator):
+    def __init__(self, period=14):
+        super().__init__()
+        self.period = period
+        self.lookback = period + 1
+        self.prev_close = None
+        self.gains = RollingWindow(period - 1)
+        self.losses = RollingWindow(period - 1)
+
+    def _compute(self, bar):
+        if self.prev_close == None or len(self.gains) < self.period - 1:
+            return (np.nan,)
+        delta = bar[4] - self.prev_close
+        gain = self.gains.sum + max(delta, 0.0)
+        loss = self.losses.sum + max(-delta, 0.0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            relative_strength = np.float64(gain) / np.float64(loss)
+            return (100 - (100 / (1 + relative_strength)),)
+
+    def _commit(self, bar):
+        if self.prev_close != None:
+            delta = bar[4] - self.prev_close
+            self.gains.append(max(delta, 0.0))
+            self.losses.append(max(-delta, 0.0))
+        self.prev_close = bar[4]
+
+
+class MACD(StreamingIndicator):
+    nb_of_values = 3
+    lookback = 1
+
+    def __init__(self, fast=12, slow=26, signal=9):
+        super().__init__()
+        self.fast = EwmaState(2 / (fast + 1))
+        self.slow = EwmaState(2 / (slow + 1))
+        self.signal = EwmaState(2 / (signal + 1))
+
+    def _compute(self, bar):
+        line = self.fast.peek(bar[4]) - self.slow.peek(bar[4])
+        signal = self.signal.peek(line)
+        return (line, signal, line - signal)
+
+    def _commit(self, bar):
+        line = self.fast.peek(bar[4]) - self.slow.peek(bar[4])
+        self.fast.push(bar[4])
+        self.slow.push(bar[4])
+        self.signal.push(line)
+
+    def _restore(self, data, result):
+        self.fast.value = ewma(data[:-1, 4], self.fast.alpha)[-1]
+        self.slow.value = self.fast.value - result[-2, 1]
+        self.signal.value = result[-2, 2]
+
+
+class BBands(StreamingIndicator):
+    """
+    Like indicators.bbands, the standard deviation of a bar is the one of
+    the {{period}} closes before it.
+    """
+    nb_of_values = 3
+
+    def __init__(self, period=20, std_multiplier=2):
+        super().__init__()
+        self.period = period
+        self.lookback = period + 1
+        self.std_multiplier = std_multiplier
+        self.closes = RollingWindow(period)
+        # sliding mean and sum of squared deviations of the closes (Welford)
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def _compute(self, bar):
+        n = len(self.closes)
+        if n < self.period - 1:
+            return (np.nan, np.nan, np.nan)
+
+        previous = self.closes.sum
+        if n == self.period:
+            previous -= self.closes.values[0]
+        middle = (previous + bar[4]) / self.period
+        if n < self.period:
+            return (middle, np.nan, np.nan)
+
+        sigma = math.sqrt(max(self.m2, 0.0) / self.period)
+        return (middle, middle + sigma * self.std_multiplier,
+                middle - sigma * self.std_multiplier)
+
+    def _commit(self, bar):
+        x = bar[4]
+        if self.closes.full():
+            y = self.closes.values[0]
+            n = len(self.closes) - 1
+            delta = y - self.mean
+            self.mean = self.mean - delta / n if n else 0.0
+            self.m2 -= delta * (y - self.mean)
+        if self.closes.append(x):
+            # the sliding updates drift like the rolling sums
+            closes = self.closes.values
+            self.mean = self.closes.sum / len(closes)
+            self.m2 = math.fsum((c - self.mean) ** 2 for c in closes)
+            return
+        n = len(self.closes)
+        delta = x - self.mean
+        self.mean += delta / n
+        self.m2 += delta * (x - self.mean)
+
+
+class ADX(StreamingIndicator):
+    nb_of_values = 3
+
+    def __init__(self, period=14):
+        super().__init__()
+        self.period = period
+        self.lookback = period + 1
+        self.prev_bar = None
+        self.true_ranges = RollingWindow(period - 1)
+        self.diplus = EwmaState(1 / period)
+        self.diminus = EwmaState(1 / period)
+        self.adx = EwmaState(1 / period)
+
+    def _compute(self, bar):
+        values = self._step(bar)
+        if values == None:
+            return (np.nan, np.nan, np.nan)
+        diplus, diminus, adx = self._peek(values)
+        return (100 * adx, 100 * diplus, 100 * diminus)
+
+    def _commit(self, bar):
+        values = self._step(bar)
+        if values != None:
+            diplus, diminus, adx = self._peek(values)
+            self.diplus.value = diplus
+            self.diminus.value = diminus
+            self.adx.value = adx
+        if self.prev_bar != None:
+            self.true_ranges.append(self._directional_moves(bar)[2])
+        self.prev_bar = bar
+
+    def _restore(self, data, result):
+        self.adx.value, self.diplus.value, self.diminus.value = \
+            result[-2, 1:] / 100
+
+    # internal use
+    def _directional_moves(self, bar):
+        prev = self.prev_bar
+        dmp = bar[2] - prev[2]
+        dmn = prev[3] - bar[3]
+        # like indicators.adx, dmn is compared to the filtered dmp
+        dmp = dmp if dmp > 0 and dmp > dmn else 0.0
+        dmn = dmn if dmn > 0 and dmn > dmp else 0.0
+        true_range = max(abs(bar[2] - bar[3]), abs(bar[2] - prev[4]),
+                         abs(prev[4] - bar[3]))
+        return dmp, dmn, true_range
+
+    def _step(self, bar):
+        """
+        returns the raw (not averaged) directional indicators of the bar, or
+        None if there isn't enough bars yet.
+        """
+        if self.prev_bar == None or len(self.true_ranges) < self.period - 1:
+            return None
+        dmp, dmn, true_range = self._directional_moves(bar)
+        atr = np.float64(self.true_ranges.sum + true_range) / self.period
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (dmp / atr, dmn / atr)
+
+    def _peek(self, values):
+        diplus = self.diplus.peek(values[0])
+        diminus = self.diminus.peek(values[1])
+        total = diplus + diminus
+        ratio = 0.0
+        if total != 0:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ratio = np.abs(diplus - diminus) / total
+        return diplus, diminus, self.adx.peek(ratio)
+
+
+streaming_classes = {"sma": SMA, "ema": EMA, "rsi": RSI, "macd": MACD,
+                     "bbands": BBands, "adx": ADX}
+
+
+# program :
+if __name__ == "__main__":
+    # checks that the streaming indicators give the same results as the
+    # batch ones on the test data, with and without revisions of the last
+    # bar.
+    import indicators
+    from data import market_data as test_data
+
+    cases = [("sma", (20,)), ("ema", (20,)), ("rsi", (14,)),
+             ("macd", (12, 26, 9)), ("bbands", (20, 2)), ("adx", (14,))]
+    rng = np.random.default_rng(0)
+    for name, params in cases:
+        expected = getattr(indicators, name)(test_data, *params)
+        streaming = streaming_classes[name](*params)
+        result = streaming.run(test_data)
+        same = np.allclose(result, expected, rtol=1e-7, atol=1e-9,
+                           equal_nan=True)
+
+        # every bar is first sent with a random close, then revised
+        revised = streaming_classes[name](*params)
+        out = np.empty_like(expected)
+        for i, bar in enumerate(test_data):
+            fake = bar.copy()
+            fake[4] += rng.normal(0, 1e-3)
+            revised.update(fake)
+            out[i] = revised.update(bar)
+        same_revised = np.allclose(out, expected, rtol=1e-7, atol=1e-9,
+                                   equal_nan=True)
+
+        # warm started on the first bars then updated with the others
+        warm = streaming_classes[name](*params)
+        half = test_data.shape[0] // 2
+        warm.warm_start(test_data[:half],
+                        getattr(indicators, name)(test_data[:half], *params))
+        out = np.concatenate(([warm.last], warm.run(test_data[half:])))
+        same_warm = np.allclose(out, expected[half - 1:], rtol=1e-7,
+                                atol=1e-9, equal_nan=True)
+        print(f"{name:<8} new bars : {same}   revised bars : {same_revised}"
+              f"   warm start : {same_warm}")
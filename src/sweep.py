@@ -0,0 +1,202 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import itertools
+import json
+import os
+
+import numpy as np
+
+import backtest
+
+"""
+This module will handle the parameter sweeps of the strategies : the same
+market data is backtested (see backtest.run) with every combination of
+parameters of a strategy, on all the cores.
+
+The bars are copied once in shared memory, every process of the pool maps
+them without a copy, so only the parameters and the stats of the backtests
+go through the pipes. The results are yielded as they finish and appended
+to a JSONL file, an interrupted sweep started again with the same file only
+runs the combinations missing from it.
+"""
+
+# variables :
+_data = None  # the market data in the processes of the pool
+_shared_memory = None
+
+
+# external use :
+def grid(**params):
+    """
+    returns every combination of parameters.
+
+    i.e grid(fast=[5, 10], slow=[20, 50]) -> [{"fast": 5, "slow": 20},
+    {"fast": 5, "slow": 50}, {"fast": 10, "slow": 20}, ...]
+    """
+    names = list(params)
+    return [dict(zip(names, values))
+            for values in itertools.product(*params.values())]
+
+
+def sweep(data, strategy, param_grid, results_path=None, processes=None,
+          batch_size=None, **run_kwargs):
+    """
+    backtests a strategy with every combination of parameters, yielding the
+    results as they finish (in any order).
+
+    Args:
+        data (np.ndarray): market data (format of market_data.get_data).
+        strategy (str): the name of the strategy in backtest.strategies (i.e
+        "ema crossover").
+        param_grid (dict or list of dict): the values of every parameter
+        (see grid) or the list of combinations.
+        results_path (str, optional): the JSONL file the results are
+        appended to. The combinations it already has are skipped. Defaults
+        to None which means the results aren't saved.
+        processes (int, optional): the number of processes. Defaults to
+        None which means one per core.
+        batch_size (int, optional): the number of combinations sent to a
+        process at once. Defaults to None which means about 4 batches per
+        process.
+        **run_kwargs: the parameters of backtest.run (size, commission...).
+
+    Yields:
+        dict: {"strategy", "params", "stats"} of a backtest.
+    """
+    if strategy not in backtest.strategies:
+        raise KeyError(f"unknown strategy {strategy!r}")
+    combinations = grid(**param_grid) if isinstance(param_grid, dict) \
+        else list(param_grid)
+    done = set()
+    if results_path != None:
+        done = {get_key(r["params"]) for r in load_results(results_path)
+                if r["strategy"] == strategy}
+    todo = [params for params in combinations if get_key(params) not in done]
+    if not todo:
+        return
+
+    processes = processes or os.cpu_count()
+    if batch_size == None:
+        batch_size = max(1, min(16, len(todo) // (4 * processes)))
+    batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+
+    data = np.ascontiguousarray(data, dtype=np.float64)
+    memory = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+    file = None
+    try:
+        np.ndarray(data.shape, np.float64, buffer=memory.buf)[:] = data
+        if results_path != None:
+            file = open(results_path, "a")
+        with ProcessPoolExecutor(
+                processes, initializer=attach_data,
+                initargs=(memory.name, data.shape)) as executor:
+            futures = [executor.submit(run_batch, strategy, batch, run_kwargs)
+                       for batch in batches]
+            try:
+                for future in as_completed(futures):
+                    for result in future.result():
+                        if file != None:
+                            file.write(json.dumps(result) + "\n")
+                            file.flush()
+                        yield result
+            finally:
+                for future in futures:
+                    future.cancel()
+    finally:
+        if file != None:
+            file.close()
+        memory.close()
+        memory.unlink()
+
+
+def load_results(path):
+    """
+    returns the results saved by sweep, [] if the file doesn't exist. A line
+    cut by an interruption is ignored.
+    """
+    if not os.path.exists(path):
+        return []
+    results = []
+    with open(path) as file:
+        for line in file:
+            try:
+                results.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return results
+
+
+# internal use :
+def get_key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+def attach_data(name, shape):
+    """maps the shared market data in a process of the pool."""
+    global _data, _shared_memory
+    _shared_memory = shared_memory.SharedMemory(name=name)
+    _data = np.ndarray(shape, np.float64, buffer=_shared_memory.buf)
+    _data.flags.writeable = False
+
+
+def run_batch(strategy, batch, run_kwargs):
+    function = backtest.strategies[strategy]
+    results = []
+    for params in batch:
+        signals = function(_data, **params)
+        stats = backtest.run(_data, signals, **run_kwargs).stats
+        results.append({"strategy": strategy, "params": params,
+                        "stats": stats})
+    return results
+
+
+# program :
+if __name__ == "__main__":
+    import tempfile
+    import time
+
+    rng = np.random.default_rng(0)
+    nb_of_bars = 100_000
+    close = 1.2 + np.cumsum(rng.normal(0, 1e-4, nb_of_bars))
+    open_ = np.concatenate(([close[0]], close[:-1]))
+    data = np.column_stack((1.6e9 + 60 * np.arange(nb_of_bars), open_,
+                            np.maximum(open_, close) + 5e-5,
+                            np.minimum(open_, close) - 5e-5, close))
+    param_grid = {"fast": list(range(5, 55, 5)),
+                  "slow": list(range(60, 260, 20))}
+    run_kwargs = {"size": 10000, "commission": 2e-5}
+
+    # the results are the same as the backtests run one by one
+    results = list(sweep(data, "ema crossover", param_grid, **run_kwargs))
+    same = all(r["stats"] == backtest.run(
+        data, backtest.ema_crossover(data, **r["params"]), **run_kwargs).stats
+        for r in results[:5])
+    assert same
+    print(f"{len(results)} backtests, same stats as backtest.run : {same}")
+
+    # an interrupted sweep only runs the missing combinations
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "sweep.jsonl")
+        results = sweep(data, "ema crossover", param_grid, path, **run_kwargs)
+        for _ in range(30):
+            next(results)
+        results.close()
+        saved = len(load_results(path))
+        resumed = list(sweep(data, "ema crossover", param_grid, path,
+                             **run_kwargs))
+        assert saved + len(resumed) == len(load_results(path)) == 100
+        print(f"interrupted after {saved} results, {len(resumed)} run on "
+              f"resume, {len(load_results(path))} saved")
+
+    # scaling with the number of processes
+    elapsed = {}
+    for processes in sorted({1, 2, 4, os.cpu_count()}):
+        if processes > os.cpu_count():
+            continue
+        start = time.perf_counter()
+        for _ in sweep(data, "ema crossover", param_grid, processes=processes,
+                       **run_kwargs):
+            pass
+        elapsed[processes] = time.perf_counter() - start
+        print(f"{processes:>3} processes : {elapsed[processes]:6.2f} s, "
+              f"speedup {elapsed[1] / elapsed[processes]:5.2f}")
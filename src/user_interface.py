@@ -8,6 +8,9 @@ import ib_interface
 import log
 import account
 import session
+import market_data
+import backtest
+import plot
 
 
 def run_in_thread(fn):
@@ -160,6 +163,73 @@ class MainFrame(ttk.Frame):
         self.update_portfolio()
 
 
+class BacktestFrame(ttk.Frame):
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.parent = parent
+        self.widget_dict = {}
+        self.results = None
+
+        self.settings_frame = self.get_settings_frame()
+        self.results_frame = self.get_results_frame()
+
+        self.settings_frame.pack(fill="both", padx=20, pady=10)
+        self.results_frame.pack(fill="both", expand="yes", padx=20, pady=10)
+
+    def get_settings_frame(self):
+        frame = ttk.LabelFrame(self, text="Backtest")
+        lab_names = ["Strategy", "Symbol", "Barsize", "Size", "Commission"]
+        defaults = [list(backtest.strategies)[0], "EUR/USD", "1 hour",
+                    "10000", "0.00002"]
+        for i in range(len(lab_names)):
+            ttk.Label(frame, text=lab_names[i]).grid(row=0, column=i, padx=10)
+            if lab_names[i] == "Strategy":
+                entry = ttk.Combobox(frame, state="readonly",
+                                     values=list(backtest.strategies))
+                entry.set(defaults[i])
+            else:
+                entry = ttk.Entry(frame)
+                entry.insert(0, defaults[i])
+            entry.grid(row=1, column=i, padx=10, pady=5)
+            self.widget_dict[lab_names[i]] = entry
+
+        run_button = tk.Button(frame, text="run", foreground="green",
+                               command=self.run_butt_action)
+        plot_button = tk.Button(frame, text="plot",
+                                command=self.plot_butt_action)
+        run_button.grid(row=1, column=len(lab_names), padx=10)
+        plot_button.grid(row=1, column=len(lab_names) + 1, padx=10)
+        return frame
+
+    def get_results_frame(self):
+        frame = ttk.LabelFrame(self, text="Results")
+        lab = ttk.Label(frame, anchor="nw", justify="left", font=20)
+        self.widget_dict["results"] = lab
+        lab.pack(fill="both", expand="yes")
+        return frame
+
+    def run_butt_action(self):
+        symbol = self.widget_dict["Symbol"].get()
+        barsize = self.widget_dict["Barsize"].get()
+        data = market_data.get_data(self.parent.ib, symbol, barsize)
+        if len(data) < 2:
+            log.log(f"no market data to backtest for {symbol} {barsize}")
+            return
+        strategy = backtest.strategies[self.widget_dict["Strategy"].get()]
+        self.results = backtest.run(
+            data, strategy, size=float(self.widget_dict["Size"].get()),
+            commission=float(self.widget_dict["Commission"].get()))
+        self.widget_dict["results"].config(text=self.results.summary())
+
+    def plot_butt_action(self):
+        if self.results != None:
+            plot.plot_strategy_results(
+                self.results, title=self.widget_dict["Strategy"].get())
+
+    def update(self):
+        pass
+
+
 class App(tk.Tk):
     def __init__(self, ib):
         super().__init__()
@@ -193,7 +263,7 @@ class App(tk.Tk):
         return toolbar
 
     def get_status_bar(self):
-        status = [x.strip() for x in log.get_last_log().split(":")[-2:]]
+        status = get_status()
         statusbar = ttk.Label(self)
         color = "red" if status[0] == "ERROR" else "black"
         statusbar.config(text=status[1], borderwidth=2, relief="sunken",
@@ -206,7 +276,7 @@ class App(tk.Tk):
                          "orders": None,
                          "market data": None,
                          "plots": None,
-                         "backtesting": None,
+                         "backtesting": BacktestFrame,
                          "settings": None}
         if self.frame:
             self.frame.pack_forget()
@@ -216,7 +286,7 @@ class App(tk.Tk):
         self.frame = frame
 
     def update(self):
-        status = [x.strip() for x in log.get_last_log().split(":")[-2:]]
+        status = get_status()
         color = "red" if status[0] == "ERROR" else "black"
         self.statusbar.config(text=status[1], foreground=color)
         self.frame.update()
@@ -224,6 +294,12 @@ class App(tk.Tk):
 
 
 # internal use
+def get_status():
+    """returns the level and the message of the last log."""
+    record = log.get_last_record()
+    if record == None:
+        return ("INFO", "")
+    return (record.level, record.msg)
 
 
 def doNothing():
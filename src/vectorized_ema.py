@@ -1,24 +1,34 @@
-# tested with python3 & numpy 1.15.2
+# tested with python3 & numpy 1.15.2 to 2.4
 import numpy as np
 
 """
 copied code from stackoverflow to get a fast ema calculator.
 https://stackoverflow.com/questions/42869495/
+Changed since : the offsets of the rows of ewma_vectorized_safe are computed
+at once instead of in a loop, the row size depends on the precision of the
+dtype instead of the smallest float, the average can be seeded with a simple
+average (seed_window) and it works with numpy 2.
 """
 
 
-def ewma_vectorized_safe(data, alpha, row_size=None, dtype=None, order='C', out=None):
+def ewma_vectorized_safe(data, alpha, row_size=None, dtype=None, order='C',
+                         out=None, seed_window=None):
     """
-    Reshapes data before calculating EWMA, then iterates once over the rows
-    to calculate the offset without precision issues
+    Reshapes data before calculating EWMA, then calculates the offset of
+    every row at once without precision issues.
+    Gives the same results as pandas' ewm(alpha=alpha, adjust=False).mean()
+    (or ewm(span=window, ...) with alpha = 2 / (window + 1)) on data without
+    NaN, within a relative tolerance of 1e-12 in float64 and 1e-5 in
+    float32 (checked up to windows of 5000 values, the powers of 1 - alpha
+    are computed in float64). Like the recursive formula, a NaN makes all
+    the following averages NaN.
     :param data: Input data, will be flattened.
     :param alpha: scalar float in range (0,1)
         The alpha parameter for the moving average.
     :param row_size: int, optional
-        The row size to use in the computation. High row sizes need higher precision,
-        low values will impact performance. The optimal value depends on the
-        platform and the alpha being used. Higher alpha values require lower
-        row size. Default depends on dtype.
+        The row size to use in the computation. Defaults to
+        get_max_row_size(alpha, dtype), where the scaling factors of a row
+        reach the precision of dtype. Smaller values are slower.
     :param dtype: optional
         Data type used for calculations. Defaults to float64 unless
         data.dtype is float32, then it will use float32.
@@ -28,84 +38,140 @@ def ewma_vectorized_safe(data, alpha, row_size=None, dtype=None, order='C', out=
         A location into which the result is stored. If provided, it must have
         the same shape as the desired output. If not provided or `None`,
         a freshly-allocated array is returned.
+    :param seed_window: int, optional
+        If set, the moving average starts with the simple average of the
+        first seed_window values, at index seed_window - 1 (NaN before).
+        Defaults to None, which means it starts with the first value
+        (pandas' adjust=False).
     :return: The flattened result.
     """
-    data = np.array(data, copy=False)
-
-    if dtype is None:
-        if data.dtype == np.float32:
-            dtype = np.float32
-        else:
-            dtype = np.float
-    else:
-        dtype = np.dtype(dtype)
-
-    row_size = int(row_size) if row_size is not None else get_max_row_size(
-        alpha, dtype)
-
-    if data.size <= row_size:
-        # The normal function can handle this input, use that
-        return ewma_vectorized(data, alpha, dtype=dtype, order=order, out=out)
+    data = np.asarray(data)
+    dtype = get_dtype(data, dtype)
 
     if data.ndim > 1:
         # flatten input
         data = np.reshape(data, -1, order=order)
 
     if out is None:
-        out = np.empty_like(data, dtype=dtype)
+        out = np.empty(data.shape, dtype=dtype)
     else:
         assert out.shape == data.shape
         assert out.dtype == dtype
 
-    row_n = int(data.size // row_size)  # the number of rows to use
-    trailing_n = int(data.size % row_size)  # the amount of data leftover
-    first_offset = data[0]
+    if data.size < 1:
+        # empty input, return empty array
+        return out
 
-    if trailing_n > 0:
-        # set temporary results to slice view of out parameter
-        out_main_view = np.reshape(out[:-trailing_n], (row_n, row_size))
-        data_main_view = np.reshape(data[:-trailing_n], (row_n, row_size))
+    if seed_window is not None:
+        seed_window = int(seed_window)
+        assert seed_window >= 1
+        out[:seed_window - 1] = np.nan
+        if data.size < seed_window:
+            return out
+        out[seed_window - 1] = np.mean(data[:seed_window], dtype=dtype)
+        offset = out[seed_window - 1]
+        data = data[seed_window:]
+        out_view = out[seed_window:]
     else:
-        out_main_view = out
-        data_main_view = data
+        offset = data[0]
+        out_view = out
+
+    row_size = int(row_size) if row_size is not None else get_max_row_size(
+        alpha, dtype)
+    ewma_rows(data, alpha, offset, row_size, dtype, out_view)
+
+    nan_indexes = np.flatnonzero(np.isnan(data))
+    if nan_indexes.size > 0:
+        out_view[nan_indexes[0]:] = np.nan
+    return out
+
+
+def ewma_rows(data, alpha, offset, row_size, dtype, out):
+    """
+    Calculates the EWMA of 1D data by rows of row_size values. The offset
+    of a row is the last average of the previous one :
+        offsets[i] = offsets[i - 1] * (1 - alpha) ** row_size + raw[i - 1]
+    raw[i] being the last average of row i with a 0 offset. Unrolled, it is
+    a convolution of raw with the powers of (1 - alpha) ** row_size, which
+    is truncated where the powers fall below the precision of dtype.
+    """
+    if data.size <= row_size:
+        # The normal function can handle this input, use that
+        return ewma_vectorized(data, alpha, offset=offset, dtype=dtype,
+                               out=out)
+
+    row_n = int(data.size // row_size)  # the number of rows to use
+    main_n = row_n * row_size
+    data_main_view = np.reshape(data[:main_n], (row_n, row_size))
+    out_main_view = np.reshape(out[:main_n], (row_n, row_size))
 
     # get all the scaled cumulative sums with 0 offset
     ewma_vectorized_2d(data_main_view, alpha, axis=1, offset=0, dtype=dtype,
                        order='C', out=out_main_view)
 
-    scaling_factors = (1 - alpha) ** np.arange(1, row_size + 1)
-    last_scaling_factor = scaling_factors[-1]
-
-    # create offset array
-    offsets = np.empty(out_main_view.shape[0], dtype=dtype)
-    offsets[0] = first_offset
-    # iteratively calculate offset for each row
-    for i in range(1, out_main_view.shape[0]):
-        offsets[i] = offsets[i - 1] * \
-            last_scaling_factor + out_main_view[i - 1, -1]
+    scaling_factors = get_scaling_factors(alpha, 1, row_size + 1, dtype)
+    last_scaling_factor = (1. - float(alpha)) ** row_size
+
+    # terms[i] is the last average before row i, without its own offset.
+    # The offsets are summed in float64 : in float32 their error would add
+    # up over the rows of a long window.
+    terms = np.empty(row_n, dtype=np.float64)
+    terms[0] = offset
+    terms[1:] = out_main_view[:-1, -1]
+    offsets = terms.copy()
+    epsilon = np.finfo(dtype).eps
+    power = last_scaling_factor
+    k = 1
+    while k < row_n and power > epsilon:
+        offsets[k:] += power * terms[:-k]
+        power *= last_scaling_factor
+        k += 1
 
     # add the offsets to the result
-    out_main_view += offsets[:, np.newaxis] * scaling_factors[np.newaxis, :]
+    out_main_view += offsets.astype(dtype)[:, np.newaxis] * \
+        scaling_factors[np.newaxis, :]
 
-    if trailing_n > 0:
+    if main_n < data.size:
         # process trailing data in the 2nd slice of the out parameter
-        ewma_vectorized(data[-trailing_n:], alpha, offset=out_main_view[-1, -1],
-                        dtype=dtype, order='C', out=out[-trailing_n:])
+        ewma_vectorized(data[main_n:], alpha, offset=out_main_view[-1, -1],
+                        dtype=dtype, order='C', out=out[main_n:])
     return out
 
 
 def get_max_row_size(alpha, dtype=float):
-    assert 0. <= alpha < 1.
-    # This will return the maximum row size possible on
-    # your platform for the given dtype. I can find no impact on accuracy
-    # at this value on my machine.
-    # Might not be the optimal value for speed, which is hard to predict
-    # due to numpy's optimizations
-    # Use np.finfo(dtype).eps if you  are worried about accuracy
-    # and want to be extra safe.
-    epsilon = np.finfo(dtype).tiny
-    # If this produces an OverflowError, make epsilon larger
-    return int(np.log(epsilon)/np.log(1-alpha)) + 1
+    """
+    returns the row size at which the scaling factors (1 - alpha) ** k
+    reach the precision of dtype. Up to it, the scaled cumulative sums of
+    a row keep the precision of dtype, and a row's offset only depends on
+    the end of the previous row.
+    """
+    assert 0. < alpha < 1.
+    epsilon = np.finfo(dtype).eps
+    return int(np.log(epsilon) / np.log(1. - alpha)) + 1
+
+
+def get_scaling_factors(alpha, start, stop, dtype):
+    """
+    returns (1 - alpha) ** k for k in [start, stop) (alpha can be a vector,
+    one row per alpha). They are computed in float64 and then converted to
+    dtype : 1 - alpha rounded to float32 is off by up to 1e-4 relative for a
+    window of 5000, and the error would grow with k.
+    """
+    alpha = np.asarray(alpha, dtype=np.float64)
+    return np.power(1. - alpha[..., np.newaxis],
+                    np.arange(start, stop, dtype=np.float64)).astype(dtype)
+
+
+def get_dtype(data, dtype=None):
+    """
+    returns the data type used for calculations : dtype if given, else
+    float32 for float32 data and float64 otherwise.
+    """
+    if dtype is not None:
+        return np.dtype(dtype)
+    if data.dtype == np.float32:
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
 
 
 def ewma_vectorized(data, alpha, offset=None, dtype=None, order='C', out=None):
@@ -127,19 +193,12 @@ def ewma_vectorized(data, alpha, offset=None, dtype=None, order='C', out=None):
         the same shape as the input. If not provided or `None`,
         a freshly-allocated array is returned.
     """
-    data = np.array(data, copy=False)
-
-    if dtype is None:
-        if data.dtype == np.float32:
-            dtype = np.float32
-        else:
-            dtype = np.float64
-    else:
-        dtype = np.dtype(dtype)
+    data = np.asarray(data)
+    dtype = get_dtype(data, dtype)
 
     if data.ndim > 1:
         # flatten input
-        data = data.reshape(-1, order)
+        data = data.reshape(-1, order=order)
 
     if out is None:
         out = np.empty_like(data, dtype=dtype)
@@ -154,12 +213,10 @@ def ewma_vectorized(data, alpha, offset=None, dtype=None, order='C', out=None):
     if offset is None:
         offset = data[0]
 
-    alpha = np.array(alpha, copy=False).astype(dtype, copy=False)
-
     # scaling_factors -> 0 as len(data) gets large
     # this leads to divide-by-zeros below
-    scaling_factors = np.power(1. - alpha, np.arange(data.size + 1, dtype=dtype),
-                               dtype=dtype)
+    scaling_factors = get_scaling_factors(alpha, 0, data.size + 1, dtype)
+    alpha = np.asarray(alpha).astype(dtype, copy=False)
     # create cumulative sum array
     np.multiply(data, (alpha * scaling_factors[-2]) / scaling_factors[:-1],
                 dtype=dtype, out=out)
@@ -169,7 +226,7 @@ def ewma_vectorized(data, alpha, offset=None, dtype=None, order='C', out=None):
     out /= scaling_factors[-2::-1]
 
     if offset != 0:
-        offset = np.array(offset, copy=False).astype(dtype, copy=False)
+        offset = np.asarray(offset).astype(dtype, copy=False)
         # add offsets
         out += offset * scaling_factors[1:]
 
@@ -198,17 +255,11 @@ def ewma_vectorized_2d(data, alpha, axis=None, offset=None, dtype=None, order='C
         the same shape as the desired output. If not provided or `None`,
         a freshly-allocated array is returned.
     """
-    data = np.array(data, copy=False)
+    data = np.asarray(data)
 
     assert data.ndim <= 2
 
-    if dtype is None:
-        if data.dtype == np.float32:
-            dtype = np.float32
-        else:
-            dtype = np.float64
-    else:
-        dtype = np.dtype(dtype)
+    dtype = get_dtype(data, dtype)
 
     if out is None:
         out = np.empty_like(data, dtype=dtype)
@@ -231,7 +282,7 @@ def ewma_vectorized_2d(data, alpha, axis=None, offset=None, dtype=None, order='C
     # create reshaped data views
     out_view = out
     if axis < 0:
-        axis = data.ndim - int(axis)
+        axis += data.ndim
 
     if axis == 0:
         # transpose data views so columns are treated as rows
@@ -244,21 +295,14 @@ def ewma_vectorized_2d(data, alpha, axis=None, offset=None, dtype=None, order='C
     elif np.size(offset) == 1:
         offset = np.reshape(offset, (1,))
 
-    alpha = np.array(alpha, copy=False).astype(dtype, copy=False)
-
     # calculate the moving average
     row_size = data.shape[1]
-    row_n = data.shape[0]
-    scaling_factors = np.power(1. - alpha, np.arange(row_size + 1, dtype=dtype),
-                               dtype=dtype)
+    scaling_factors = get_scaling_factors(alpha, 0, row_size + 1, dtype)
+    alpha = np.asarray(alpha).astype(dtype, copy=False)
     # create a scaled cumulative sum array
-    np.multiply(
-        data,
-        np.multiply(alpha * scaling_factors[-2], np.ones((row_n, 1), dtype=dtype),
-                    dtype=dtype)
-        / scaling_factors[np.newaxis, :-1],
-        dtype=dtype, out=out_view
-    )
+    np.multiply(data,
+                (alpha * scaling_factors[-2] / scaling_factors[:-1])[np.newaxis, :],
+                dtype=dtype, out=out_view)
     np.cumsum(out_view, axis=1, dtype=dtype, out=out_view)
     out_view /= scaling_factors[np.newaxis, -2::-1]
 
@@ -270,17 +314,131 @@ def ewma_vectorized_2d(data, alpha, axis=None, offset=None, dtype=None, order='C
     return out
 
 
+def ewma_vectorized_2d_safe(data, alpha, offset=None, row_size=None,
+                            dtype=None, out=None):
+    """
+    Calculates the exponential moving average of every row of a 2D array,
+    each row with its own alpha. The rows are processed by blocks of columns
+    (like ewma_vectorized_safe does with the rows of a 1D input) so long rows
+    don't have precision issues, and every block is one vectorized pass over
+    all the rows.
+    :param data: Input data, 2D array (one series per row).
+    :param alpha: scalar float or vector with one element for each row of
+        data, in range (0,1).
+    :param offset: optional
+        The offset for the moving average. Must be scalar or a
+        vector with one element for each row of data. If set to None,
+        defaults to the first value of each row.
+    :param row_size: int, optional
+        The number of columns processed at once. Defaults to the largest
+        size keeping the scaling factors of the greatest alpha above
+        sqrt(finfo(dtype).tiny).
+    :param dtype: optional
+        Data type used for calculations. Defaults to float64 unless
+        data.dtype is float32, then it will use float32.
+    :param out: ndarray, or None, optional
+        A location into which the result is stored. If provided, it must have
+        the same shape as data. If not provided or `None`,
+        a freshly-allocated array is returned.
+    """
+    data = np.asarray(data)
+    assert data.ndim == 2
+
+    dtype = get_dtype(data, dtype)
+
+    if out is None:
+        out = np.empty(data.shape, dtype=dtype)
+    else:
+        assert out.shape == data.shape
+        assert out.dtype == dtype
+
+    if data.size < 1:
+        # empty input, return empty array
+        return out
+
+    row_n, col_n = data.shape
+    scaling_factors_alpha = np.broadcast_to(
+        np.asarray(alpha, dtype=np.float64), (row_n,))
+    alpha = np.broadcast_to(np.asarray(alpha, dtype=dtype), (row_n,))
+    if offset is None:
+        offset = data[:, 0]
+    offset = np.broadcast_to(np.asarray(offset, dtype=dtype), (row_n,))
+
+    if row_size is None:
+        # keeps the scaling factors far from the subnormal numbers, which
+        # are slow and imprecise
+        epsilon = np.sqrt(np.finfo(dtype).tiny)
+        row_size = int(np.log(epsilon) / np.log(1. - float(alpha.max()))) + 1
+    row_size = max(min(int(row_size), col_n), 1)
+
+    # scaling_factors[i, k] = (1 - alpha[i]) ** k
+    scaling_factors = get_scaling_factors(scaling_factors_alpha, 0,
+                                          row_size + 1, dtype)
+
+    weights = None
+    for start in range(0, col_n, row_size):
+        size = min(row_size, col_n - start)
+        factors = scaling_factors[:, :size + 1]
+        if weights is None or weights.shape[1] != size:
+            # the same for every full block
+            weights = alpha[:, np.newaxis] * factors[:, size - 1:size] \
+                / factors[:, :-1]
+            inverse_factors = 1. / factors[:, size - 1::-1]
+        out_view = out[:, start:start + size]
+        # create a scaled cumulative sum array
+        np.multiply(data[:, start:start + size], weights, dtype=dtype,
+                    out=out_view)
+        np.cumsum(out_view, axis=1, dtype=dtype, out=out_view)
+        out_view *= inverse_factors
+        # add the offsets (the last average of the previous block)
+        out_view += offset[:, np.newaxis] * factors[:, 1:]
+        offset = out_view[:, -1]
+
+    return out
+
+
 if __name__ == "__main__":
+    # compares ewma_vectorized_safe with pandas' ewm : max relative
+    # difference and throughput (values/s) from 1e3 to 1e7 values, 1e8 with
+    # "python vectorized_ema.py 1e8" (needs a few GB of memory).
+    import sys
+    import time
+
     import pandas as pd
-    data = np.arange(0, 100, 2)
-    window = 20
-    alpha = 2 / (window+1)
-    out = ewma_vectorized_safe(data, alpha)
-    pt = pd.DataFrame(data).ewm(span=window, adjust=False).mean()
-    rs = []
-    # for i in range(len(data)):
-    #     rs.append(out[i] - pt.loc[i, 0])
-    # rs = np.array(rs)
-    # print(np.mean(rs))
-    # print(np.max(rs))
-    # print(np.min(rs))
+
+    max_size = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**7
+    tolerances = {np.float64: 1e-12, np.float32: 1e-5}
+    rng = np.random.default_rng(0)
+    sizes = [10**i for i in range(3, 9) if 10**i <= max_size]
+    for size in sizes:
+        prices = 1.2 + np.cumsum(rng.normal(0, 1e-4, size))
+        for window in (2, 20, 200, 2000, 5000):
+            alpha = 2 / (window + 1)
+            start = time.perf_counter()
+            expected = pd.Series(prices).ewm(alpha=alpha, adjust=False).mean()
+            pandas_time = time.perf_counter() - start
+            expected = expected.to_numpy()
+            line = f"{size:>10.0e} values, window {window:>4} : " \
+                f"pandas {size / pandas_time:10.3g}/s"
+            for dtype, tolerance in tolerances.items():
+                data = prices.astype(dtype)
+                start = time.perf_counter()
+                out = ewma_vectorized_safe(data, alpha)
+                elapsed = time.perf_counter() - start
+                error = np.max(np.abs(out - expected) / np.abs(expected))
+                assert error < tolerance, (size, window, dtype, error)
+                line += f", {np.dtype(dtype).name} {size / elapsed:10.3g}/s" \
+                    f" (error {error:.1e})"
+            print(line)
+
+    # seeding with a simple average, and NaN like the recursive formula
+    data = rng.normal(0, 1, 5000)
+    data[4000] = np.nan
+    alpha = 2 / 11
+    expected = np.full(data.size, np.nan)
+    expected[9] = data[:10].mean()
+    for i in range(10, data.size):
+        expected[i] = expected[i - 1] + alpha * (data[i] - expected[i - 1])
+    out = ewma_vectorized_safe(data, alpha, seed_window=10)
+    assert np.allclose(out, expected, rtol=1e-12, atol=1e-12, equal_nan=True)
+    print("sma seed and NaN : ok")
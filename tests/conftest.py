@@ -0,0 +1,17 @@
+import os
+import sys
+import tempfile
+
+"""
+The modules of src import each other by name, and read or write their
+files (settings, logs, caches) in the working directory : the tests run
+from a temporary directory, with the logs muted.
+"""
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "src"))
+os.chdir(tempfile.mkdtemp(prefix="trading_bot_tests_"))
+
+import log  # noqa: E402
+
+log.log = lambda *args, **kwargs: None
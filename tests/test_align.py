@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+
+import indicators
+from align import FeatureMatrix, align
+from bar_dates import barsize_to_seconds
+from bar_store import BarStore
+from indicator_cache import IndicatorCache
+from resample import resample
+
+
+class FakeIB:
+    def __init__(self):
+        self.market = BarStore()
+        self.indicators = IndicatorCache(self.market)
+
+
+specs = [("1 hour", "adx", 14), ("4 hours", "macd", 12, 26, 9),
+         ("1 min", "rsi", 14)]
+
+
+@pytest.fixture(scope="module")
+def bars():
+    """3 weeks of 1 min bars without the weekends."""
+    rng = np.random.default_rng(0)
+    timestamps = 1.6e9 + 60 * np.arange(21 * 1440, dtype=np.float64)
+    timestamps = timestamps[(timestamps // 86400 + 4) % 7 < 5]
+    close = 1.2 + np.cumsum(rng.normal(0, 1e-4, timestamps.shape[0]))
+    open_ = np.concatenate(([close[0]], close[:-1]))
+    return np.column_stack((timestamps, open_,
+                            np.maximum(open_, close) + 5e-5,
+                            np.minimum(open_, close) - 5e-5, close))
+
+
+@pytest.fixture(scope="module")
+def features(bars):
+    hours, four_hours = resample(bars, "1 hour"), resample(bars, "4 hours")
+    return [("1 hour", indicators.adx(hours, 14)),
+            ("4 hours", indicators.macd(four_hours, 12, 26, 9)),
+            ("1 min", indicators.rsi(bars, 14))]
+
+
+def get_close(timestamps, i, seconds):
+    close = timestamps[i] + seconds
+    if i + 1 < timestamps.shape[0]:
+        close = min(close, timestamps[i + 1])
+    return close
+
+
+def align_loop(timestamps, barsize, features):
+    """the last bar of every feature closed at the close of each base bar,
+    found one bar at a time (it only moves forward)."""
+    out = np.empty((timestamps.shape[0],
+                    sum(values.shape[1] - 1 for _, values in features)))
+    column = 0
+    for feature_barsize, values in features:
+        seconds = barsize_to_seconds(feature_barsize)
+        width = values.shape[1] - 1
+        last = -1
+        for i in range(timestamps.shape[0]):
+            close_time = get_close(timestamps, i, barsize_to_seconds(barsize))
+            while last + 1 < values.shape[0] and \
+                    get_close(values[:, 0], last + 1, seconds) <= close_time:
+                last += 1
+            out[i, column:column + width] = np.nan if last < 0 \
+                else values[last, 1:]
+        column += width
+    return out
+
+
+def test_align_matches_a_loop(bars, features):
+    matrix = align(bars[:, 0], "1 min", features)
+    np.testing.assert_allclose(matrix, align_loop(bars[:, 0], "1 min",
+                                                  features), equal_nan=True)
+
+
+def test_no_lookahead(bars, features):
+    matrix = align(bars[:, 0], "1 min", features)
+    hours = features[0][1]
+    # a base bar only sees the hours closed at its own close
+    i = 3000
+    close_time = bars[i + 1, 0]
+    changed = hours.copy()
+    changed[changed[:, 0] + 3600 > close_time, 1:] = -1
+    row = align(bars[:, 0], "1 min", [("1 hour", changed)] + features[1:])[i]
+    np.testing.assert_array_equal(row, matrix[i])
+    assert np.all(matrix[:1, :3] != matrix[:1, :3])  # nothing closed yet
+
+
+def test_gaps_close_at_the_end_of_the_bar(bars, features):
+    # the last 1 min bar before a weekend closes 1 min after its start, not
+    # at the start of the next one
+    gap = np.flatnonzero(np.diff(bars[:, 0]) > 60)[0]
+    matrix = align(bars[:, 0], "1 min", features)
+    rsi = features[2][1]
+    assert matrix[gap, 6] == rsi[gap, 1]
+    hour = np.searchsorted(features[0][1][:, 0], bars[gap, 0], "right") - 1
+    np.testing.assert_array_equal(matrix[gap, :3], features[0][1][hour, 1:])
+
+
+def test_feature_matrix_updates_match_the_batch(bars, features):
+    ib = FakeIB()
+    ib.market.reset("EUR/USD", "1 min").extend(bars[:-300])
+    ib.market.derive("EUR/USD", "1 hour", "1 min")
+    ib.market.derive("EUR/USD", "4 hours", "1 min")
+    live = FeatureMatrix(ib, "EUR/USD", "1 min", specs)
+    live.update()
+    series = ib.market.get("EUR/USD", "1 min")
+    for bar in bars[-300:]:
+        revision = bar.copy()
+        revision[4] += 1e-3
+        series.upsert(*revision)
+        live.update()
+        series.upsert(*bar)
+        values = live.update()
+    np.testing.assert_allclose(values, align(bars[:, 0], "1 min", features),
+                               equal_nan=True)
+    assert len(live.columns) == values.shape[1] == 7
+    assert not values.flags.writeable
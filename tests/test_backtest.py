@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+import backtest
+from data import market_data as test_data
+
+
+def equity_loop(data, positions, commission, slippage, initial_capital):
+    """the account value at every close, one bar at a time."""
+    cash, position = initial_capital, 0.0
+    equity = []
+    for i, bar in enumerate(data):
+        quantity = positions[i] - position
+        if quantity != 0:
+            price = bar[1] + slippage * np.sign(quantity)
+            cash -= quantity * price + abs(quantity) * price * commission
+            position = positions[i]
+        equity.append(cash + position * bar[4])
+    return np.array(equity)
+
+
+@pytest.mark.parametrize("name", list(backtest.strategies))
+def test_equity_matches_a_loop(name):
+    results = backtest.run(test_data, backtest.strategies[name], size=10000,
+                           commission=2e-5, slippage=1e-5)
+    expected = equity_loop(test_data, results.positions, 2e-5, 1e-5, 10000)
+    np.testing.assert_allclose(results.equity, expected, rtol=1e-12)
+    assert results.trades["pnl"].sum() == pytest.approx(
+        results.stats["total_pnl"], rel=1e-9)
+
+
+def test_positions_follow_the_targets_a_bar_later():
+    signals = np.full(test_data.shape[0], np.nan)
+    signals[[10, 20, 30]] = [1, -1, 0]
+    results = backtest.run(test_data, signals, size=2)
+    assert results.fills["index"].tolist() == [11, 21, 31]
+    assert results.fills["quantity"].tolist() == [2, -4, 2]
+    np.testing.assert_array_equal(results.fills["price"],
+                                  test_data[[11, 21, 31], 1])
+    assert results.stats["nb_of_trades"] == 2
+    assert results.trades["closed"].all()
+
+
+def test_fractional_targets_charge_the_traded_quantity():
+    # 1 -> 0.5 -> -0.25 -> 0 : every fill pays the commission of its own
+    # quantity
+    signals = np.full(test_data.shape[0], np.nan)
+    signals[[100, 200, 300, 400]] = [1, 0.5, -0.25, 0]
+    commission = 1e-3
+    results = backtest.run(test_data, signals, size=10000,
+                           commission=commission, slippage=1e-5)
+    fills = results.fills
+    costs = np.abs(fills["quantity"]) * fills["price"] * commission
+    assert fills["quantity"].tolist() == [10000, -5000, -7500, 2500]
+    expected = equity_loop(test_data, results.positions, commission, 1e-5,
+                           10000)
+    np.testing.assert_allclose(results.equity, expected, rtol=1e-12)
+    assert results.trades["pnl"].sum() == pytest.approx(
+        results.stats["total_pnl"], rel=1e-9)
+    gross = results.trades["position"] * (results.trades["exit_price"] -
+                                          results.trades["entry_price"])
+    assert (gross - results.trades["pnl"]).sum() == pytest.approx(
+        costs.sum(), rel=1e-12)
+
+
+def test_open_trade_is_valued_at_the_last_close():
+    signals = np.zeros(test_data.shape[0])
+    signals[-50:] = -1
+    results = backtest.run(test_data, signals, commission=1e-4)
+    assert results.trades["closed"].tolist() == [False]
+    assert results.trades["exit_price"][0] == test_data[-1, 4]
+    assert results.trades["pnl"].sum() == pytest.approx(
+        results.stats["total_pnl"], rel=1e-9)
+
+
+def test_forward_fill():
+    out = backtest.forward_fill(np.array([np.nan, 1, np.nan, -1, np.nan]))
+    assert out.tolist() == [0, 1, 1, -1, -1]
@@ -0,0 +1,131 @@
+import numpy as np
+import pytest
+
+from brackets import (BracketSimulator, first_touch, resolve, sparse_table,
+                      tie_rules)
+
+
+def resolve_loop(data, entries, actions, stops, limits, tie_rule):
+    """one trade and one bar at a time."""
+    out = []
+    for entry, action, stop, limit in zip(entries, actions, stops, limits):
+        long = action == "BUY"
+        for i in range(entry, data.shape[0]):
+            _, open_, high, low, _ = data[i]
+            stop_hit = low <= stop if long else high >= stop
+            limit_hit = high >= limit if long else low <= limit
+            if not (stop_hit or limit_hit):
+                continue
+            stop_price = min(stop, open_) if long else max(stop, open_)
+            limit_price = max(limit, open_) if long else min(limit, open_)
+            if stop_hit and limit_hit:
+                if (open_ <= stop) if long else (open_ >= stop):
+                    stop_hit = True
+                elif (open_ >= limit) if long else (open_ <= limit):
+                    stop_hit = False
+                elif tie_rule == "nearest":
+                    stop_hit = abs(open_ - stop) <= abs(limit - open_)
+                else:
+                    stop_hit = tie_rule == "stop"
+            out.append((i, stop_price, "stop") if stop_hit else
+                       (i, limit_price, "limit"))
+            break
+        else:
+            out.append((data.shape[0] - 1, data[-1, 4], "end"))
+    return out
+
+
+@pytest.fixture(scope="module")
+def data():
+    rng = np.random.default_rng(0)
+    close = 1.2 + np.cumsum(rng.normal(0, 1e-4, 5000))
+    open_ = np.concatenate(([close[0]], close[:-1])) + \
+        rng.normal(0, 2e-5, 5000)
+    return np.column_stack((1.6e9 + 60 * np.arange(5000), open_,
+                            np.maximum(open_, close) + 5e-5,
+                            np.minimum(open_, close) - 5e-5, close))
+
+
+@pytest.fixture(scope="module")
+def trades(data):
+    rng = np.random.default_rng(1)
+    entries = rng.integers(0, data.shape[0], 1000)
+    actions = np.where(rng.random(1000) < 0.5, "BUY", "SELL")
+    sides = np.where(actions == "BUY", 1, -1)
+    # tight levels for bars reaching both, wide ones for open trades
+    distances = rng.choice([3e-5, 1e-3, 0.5], (2, 1000),
+                           p=[0.3, 0.6, 0.1]) * \
+        rng.uniform(0.5, 1.5, (2, 1000))
+    stops = data[entries, 1] - sides * distances[0]
+    limits = data[entries, 1] + sides * distances[1]
+    return entries, actions, stops, limits
+
+
+@pytest.mark.parametrize("tie_rule", tie_rules)
+def test_resolve_matches_a_loop(data, trades, tie_rule):
+    out = resolve(data, *trades, tie_rule=tie_rule)
+    expected = resolve_loop(data, *trades, tie_rule)
+    assert out["exit_index"].tolist() == [i for i, _, _ in expected]
+    assert out["exit_price"].tolist() == [price for _, price, _ in expected]
+    assert out["reason"].tolist() == [reason for _, _, reason in expected]
+    np.testing.assert_array_equal(out["entry_price"], data[trades[0], 1])
+    assert set(out["reason"].tolist()) == {"limit", "stop", "end"}
+
+
+def test_numeric_actions(data, trades):
+    entries, actions, stops, limits = trades
+    simulator = BracketSimulator(data)
+    by_name = simulator.resolve(entries, actions, stops, limits)
+    by_sign = simulator.resolve(entries, np.where(actions == "BUY", 1, -1),
+                                stops, limits)
+    for key in by_name:
+        np.testing.assert_array_equal(by_name[key], by_sign[key])
+
+
+def test_gap_over_the_stop():
+    data = np.array([[0, 1.00, 1.01, 0.99, 1.00],
+                     [60, 1.00, 1.01, 0.995, 1.00],
+                     [120, 0.95, 0.96, 0.94, 0.95]])
+    out = resolve(data, [0], ["BUY"], [0.98], [1.05])
+    assert out["exit_index"].tolist() == [2]
+    assert out["exit_price"].tolist() == [0.95]
+    assert out["reason"].tolist() == ["stop"]
+
+
+def test_invalid_arguments(data):
+    with pytest.raises(ValueError):
+        BracketSimulator(data, tie_rule="first")
+    with pytest.raises(IndexError):
+        resolve(data, [data.shape[0]], ["BUY"], [1.0], [2.0])
+
+
+def test_first_touch_matches_a_scan():
+    rng = np.random.default_rng(2)
+    values = rng.normal(0, 1, 1000)
+    table = sparse_table(values, np.minimum)
+    for k, row in enumerate(table):
+        width = 1 << k
+        exact = [values[i:i + width].min() for i in range(1001 - width)]
+        assert row.dtype == np.float32
+        assert (row <= exact).all()
+        np.testing.assert_allclose(row, exact, rtol=2.4e-7)
+    starts = rng.integers(0, 1000, 200)
+    # levels equal to values, where the float32 table can't tell them apart
+    levels = np.concatenate((rng.uniform(-3.5, 0, 100),
+                             values[rng.integers(0, 1000, 100)] - 1e-12))
+    expected = [next((i for i in range(start, 1000) if values[i] <= level),
+                     1000) for start, level in zip(starts, levels)]
+    assert first_touch(table, starts, levels, below=True,
+                       values=values).tolist() == expected
+
+
+def test_rounded_table_is_checked_on_the_exact_values():
+    # both values round to the same float32, only the second one reaches
+    # the level
+    values = np.array([1.1 + 1e-9, 1.1, 1.2])
+    table = sparse_table(values, np.minimum)
+    assert first_touch(table, np.array([0]), np.array([1.1]), below=True,
+                       values=values).tolist() == [1]
+    table = sparse_table(-values, np.maximum)
+    assert first_touch(table, np.array([0]), np.array([-1.1]), below=False,
+                       values=-values).tolist() == [1]
@@ -0,0 +1,109 @@
+import threading
+import time
+
+import pytest
+
+import data_scheduler
+from data_scheduler import HistoricalDataScheduler
+from request_registry import RequestRegistry
+
+pacing_violation = ("Historical Market Data Service error message:API "
+                    "historical data query cancelled: pacing violation")
+
+
+class FakeClient:
+    """answers every request after a delay, the first attempts of the
+    symbols of fail_once with a pacing violation."""
+
+    def __init__(self, delay=0.01, fail_once=()):
+        self.nextReqId = 0
+        self.data_requests = RequestRegistry()
+        self.delay = delay
+        self.fail_once = set(fail_once)
+        self.max_in_flight = 0
+        self.sent = []  # (time, symbol, barsize)
+
+    def reqHistoricalData(self, reqId, contract, endDateTime, durationStr,
+                          barSizeSetting, whatToShow, useRTH, formatDate,
+                          keepUpToDate, chartOptions):
+        self.data_requests.start(reqId, keepUpToDate)
+        symbol, barsize = self.data_requests.get_info(reqId)
+        self.sent.append((time.monotonic(), symbol, barsize))
+        self.max_in_flight = max(self.max_in_flight,
+                                 len(self.data_requests.pending()))
+        if symbol in self.fail_once:
+            self.fail_once.discard(symbol)
+            answer = (self.data_requests.fail, (reqId, 162, pacing_violation))
+        else:
+            answer = (self.data_requests.end, (reqId,))
+        threading.Timer(self.delay, *answer).start()
+
+    def cancelHistoricalData(self, reqId):
+        self.data_requests.cancel(reqId)
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    """scaled down limits so a batch takes about a second."""
+    values = {"max_in_flight": 8, "max_per_window": 12, "window": 0.5,
+              "max_per_contract": 3, "contract_window": 0.2,
+              "identical_request_delay": 0.3, "backoff_start": 0.2}
+    for name, value in values.items():
+        monkeypatch.setattr(data_scheduler, name, value)
+    return values
+
+
+def count_in_windows(times, length):
+    """the max number of times in any period of length seconds."""
+    times = sorted(times)
+    first, most = 0, 0
+    for last, t in enumerate(times):
+        while times[first] <= t - length:
+            first += 1
+        most = max(most, last - first + 1)
+    return most
+
+
+def test_batch_respects_the_pacing_limits(limits):
+    symbols = ["EUR/USD", "GBP/USD", "USD/JPY", "AUD/USD"]
+    barsizes = ["1 min", "5 mins", "1 hour", "1 day", "4 hours", "15 mins"]
+    batch = [(s, bs, "1 W") for s in symbols for bs in barsizes]
+    client = FakeClient()
+
+    done = HistoricalDataScheduler(client).run(batch, timeout=30)
+
+    assert len(done) == len(batch)
+    assert sorted((s, bs) for _, s, bs in client.sent) == \
+        sorted((s, bs) for s, bs, _ in batch)
+    # a small tolerance for the timers
+    assert count_in_windows([t for t, _, _ in client.sent],
+                            limits["window"] - 0.01) <= \
+        limits["max_per_window"]
+    for symbol in symbols:
+        times = [t for t, s, _ in client.sent if s == symbol]
+        assert count_in_windows(times, limits["contract_window"] - 0.01) <= \
+            limits["max_per_contract"]
+    assert client.max_in_flight <= limits["max_in_flight"]
+
+
+def test_priority_barsizes_are_sent_first(limits):
+    batch = [("EUR/USD", bs, "1 W") for bs in ("1 min", "1 day", "1 hour")]
+    client = FakeClient()
+    HistoricalDataScheduler(client).run(batch, priority=["1 hour", "1 day"])
+    assert [bs for _, _, bs in client.sent] == ["1 hour", "1 day", "1 min"]
+
+
+def test_pacing_violation_is_retried_after_a_backoff(limits):
+    client = FakeClient(fail_once=["EUR/USD"])
+    scheduler = HistoricalDataScheduler(client)
+
+    done = scheduler.run([("EUR/USD", "1 hour", "1 W")], timeout=10)
+
+    assert len(done) == 1
+    assert scheduler.nb_of_pacing_errors == 1
+    assert len(client.sent) == 2
+    first, second = client.sent[0][0], client.sent[1][0]
+    # the identical request delay applies to the retry too
+    assert second - first >= max(limits["backoff_start"],
+                                 limits["identical_request_delay"]) - 0.01
+    assert client.data_requests.get(done[0].reqId).state == "done"
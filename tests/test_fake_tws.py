@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+from ibapi.order import Order
+
+import contract
+import data_scheduler
+import ib_interface
+import market_data
+from fake_tws import FakeTWS
+from order_store import FILLED, SUBMITTED
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def session(monkeypatch):
+    """an IBApi client connected to a FakeTWS accepting 3 historical data
+    requests per 0.5 second, the 4th gets a pacing violation."""
+    monkeypatch.setattr(data_scheduler, "backoff_start", 0.05)
+    monkeypatch.setattr(data_scheduler, "identical_request_delay", 0)
+    with FakeTWS(latency=(0.005, 0.02), max_per_window=3, window=0.5,
+                 seed=0) as tws:
+        ib = ib_interface.IBApi()
+        ib.connect("127.0.0.1", tws.port, 0)
+        thread = threading.Thread(target=ib.run, daemon=True)
+        thread.start()
+        assert wait_until(lambda: ib.nextOrderId != 0)
+        yield tws, ib
+        ib.disconnect()
+        thread.join(5)
+
+
+def test_data_and_bracket_order_end_to_end(session):
+    tws, ib = session
+    symbols = ["EUR/USD", "GBP/USD"]
+    # the 5 mins bars are derived from the 1 min ones, not asked
+    timeframes = [("1 min", "2 D"), ("5 mins", "2 D"), ("1 day", "1 M")]
+    market_data.ask_data(ib, symbols, timeframes, timeout=10,
+                         use_cache=False)
+
+    assert tws.nb_of_data_requests == 4 + tws.nb_of_pacing_errors
+    assert tws.nb_of_pacing_errors >= 1
+    for symbol in symbols:
+        for barsize, _ in timeframes:
+            assert ib.market.get(symbol, barsize).size > 0, (symbol, barsize)
+        assert ib.market.is_derived(symbol, "5 mins")
+
+    # a bracket : the market parent is filled, then its children work
+    orders = []
+    for orderType, transmit in (("MKT", False), ("LMT", False),
+                                ("STP", True)):
+        order = Order()
+        order.orderId = ib.nextOrderId
+        ib.nextOrderId += 1
+        order.action = "BUY" if orderType == "MKT" else "SELL"
+        order.orderType = orderType
+        order.totalQuantity = 20000
+        if orderType == "LMT":
+            order.lmtPrice = 2.0
+        if orderType == "STP":
+            order.auxPrice = 0.5
+        order.parentId = orders[0].orderId if orders else 0
+        order.transmit = transmit
+        orders.append(order)
+        ib.placeOrder(order.orderId, contract.get_contract("EUR/USD"), order)
+
+    parent, take_profit, stop_loss = (ib.orders[o.orderId] for o in orders)
+    assert wait_until(lambda: parent.status == FILLED and
+                      parent.commission == 2.0 and
+                      take_profit.status == SUBMITTED and
+                      stop_loss.status == SUBMITTED)
+    assert parent.filled == 20000
+    assert parent.avgFillPrice == tws.prices["EUR/USD"]
+    assert ib.orders.children(parent.orderId) == [take_profit, stop_loss]
+    assert sorted(r.orderId for r in ib.orders.working()) == \
+        [take_profit.orderId, stop_loss.orderId]
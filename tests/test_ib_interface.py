@@ -0,0 +1,30 @@
+import ib_interface
+import request_registry
+
+
+def make_ib():
+    ib = ib_interface.IBApi()
+    ib.data_requests.add(1, "EUR/USD", "1 min")
+    ib.data_requests.start(1)
+    return ib
+
+
+def test_error_of_a_request_fails_it():
+    ib = make_ib()
+    ib.error(1, 162, "Historical Market Data Service error message")
+    assert ib.data_requests.get(1).state == request_registry.FAILED
+
+
+def test_warning_doesnt_fail_the_request():
+    ib = make_ib()
+    ib.error(1, 2106, "HMDS data farm connection is OK")
+    assert ib.data_requests.get(1).state == request_registry.PENDING
+
+
+def test_order_error_doesnt_fail_a_request_with_the_same_id():
+    ib = make_ib()
+    ib.init_order(1)
+    ib.error(1, 201, "Order rejected")
+    assert ib.data_requests.get(1).state == request_registry.PENDING
+    ib.error(1, 162, "Historical Market Data Service error message")
+    assert ib.data_requests.get(1).state == request_registry.FAILED
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+import indicators
+from bar_store import BarStore
+from data import market_data as test_data
+from indicator_cache import IndicatorCache
+
+cases = [("sma", (20,)), ("ema", (20,)), ("rsi", (14,)),
+         ("macd", (12, 26, 9)), ("bbands", (20, 2)), ("adx", (14,))]
+
+
+def make_cache(nb_of_bars):
+    store = BarStore()
+    series = store.reset("EUR/USD", "1 hour")
+    series.extend(test_data[:nb_of_bars])
+    return series, IndicatorCache(store)
+
+
+@pytest.mark.parametrize("name, params", cases)
+def test_extended_results_match_the_batch_indicator(name, params):
+    # the bars arrive one by one, with a revision of each one
+    half = test_data.shape[0] // 2
+    series, cache = make_cache(half)
+    rng = np.random.default_rng(0)
+    for bar in test_data[half:]:
+        revision = bar.copy()
+        revision[4] += rng.normal(0, 1e-3)
+        series.upsert(*revision)
+        cache.get("EUR/USD", "1 hour", name, *params)
+        series.upsert(*bar)
+        values = cache.get("EUR/USD", "1 hour", name, *params)
+        np.testing.assert_allclose(
+            values, getattr(indicators, name)(series.view(), *params),
+            rtol=1e-7, atol=1e-9, equal_nan=True)
+    assert cache.misses == 1
+    assert cache.extensions > 0
+
+
+def test_unchanged_series_is_a_hit():
+    series, cache = make_cache(100)
+    first = cache.get("EUR/USD", "1 hour", "ema", 20)
+    second = cache.get("EUR/USD", "1 hour", "ema", 20)
+    assert cache.stats()["hits"] == 1
+    np.testing.assert_array_equal(first, second)
+    assert not second.flags.writeable
+
+
+def test_revision_only_changes_the_last_row_of_a_view():
+    series, cache = make_cache(100)
+    values = cache.get("EUR/USD", "1 hour", "ema", 20)
+    kept = values.copy()
+    revision = test_data[99].copy()
+    revision[4] += 1e-2
+    series.upsert(*revision)
+    cache.get("EUR/USD", "1 hour", "ema", 20)
+    np.testing.assert_array_equal(values[:-1], kept[:-1])
+    assert values[-1, 1] != kept[-1, 1]
+
+
+def test_change_of_older_bars_computes_again():
+    series, cache = make_cache(100)
+    cache.get("EUR/USD", "1 hour", "rsi", 14)
+    series.clear()
+    series.extend(test_data[1:101])
+    values = cache.get("EUR/USD", "1 hour", "rsi", 14)
+    assert cache.misses == 2
+    np.testing.assert_allclose(values, indicators.rsi(test_data[1:101], 14),
+                               equal_nan=True)
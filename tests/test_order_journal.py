@@ -0,0 +1,200 @@
+import os
+
+import numpy as np
+from ibapi.commission_report import CommissionReport
+from ibapi.execution import Execution
+from ibapi.order import Order
+
+import contract
+from order_journal import OrderJournal, journal_name, load_archive
+from order_store import FILLED, SUBMITTED, OrderStore
+
+
+def make_execution(orderId):
+    execution = Execution()
+    execution.orderId, execution.permId = orderId, 1000 + orderId
+    execution.execId = f"0001f4e8.{orderId}.01.01"
+    execution.shares, execution.price, execution.side = 20000, 1.1, "BOT"
+    return execution
+
+
+def make_report(execution, commission=2.0):
+    report = CommissionReport()
+    report.execId, report.commission = execution.execId, commission
+    return report
+
+
+def status(orderId, status, filled):
+    return (orderId, status, filled, 20000.0 - filled, 1.1, 1000 + orderId,
+            0, 1.1, 0, "", 0.0)
+
+
+class Session:
+    """sends the events to the store, then to the journal, like IBApi."""
+
+    def __init__(self, directory, grace=300):
+        self.store = OrderStore()
+        self.journal = OrderJournal(directory, self.store, compact_every=0,
+                                    grace=grace)
+        self.journal.load()
+
+    def place(self, orderId):
+        order = Order()
+        order.orderId, order.action, order.orderType = orderId, "BUY", "LMT"
+        order.totalQuantity, order.lmtPrice = 20000, 1.1
+        order.permId = 1000 + orderId
+        symbol_contract = contract.get_contract("EUR/USD")
+        self.store.add(orderId, symbol_contract, order)
+        self.journal.write_placement(orderId, symbol_contract, order)
+        self.status(*status(orderId, SUBMITTED, 0.0))
+
+    def status(self, *args):
+        self.store.update_status(*args)
+        self.journal.write_status(*args)
+
+    def execution(self, execution):
+        self.store.add_execution(execution)
+        self.journal.write_execution(execution, None)
+
+    def commission(self, report):
+        self.store.add_commission(report)
+        self.journal.write_commission(report)
+
+    def fill(self, orderId):
+        execution = make_execution(orderId)
+        self.status(*status(orderId, FILLED, 20000.0))
+        self.execution(execution)
+        self.commission(make_report(execution))
+        return execution
+
+
+def test_repeated_fill_after_compaction(tmp_path):
+    session = Session(str(tmp_path))
+    session.place(1)
+    execution = session.fill(1)
+    assert session.journal.compact() == 1 and len(session.store) == 0
+
+    session.status(*status(1, FILLED, 20000.0))
+    session.execution(execution)
+    session.commission(make_report(execution))
+    assert len(session.store) == 0 and session.store.working() == []
+    session.journal.close()
+
+    orders, fills = load_archive(str(tmp_path))
+    assert orders["orderId"].tolist() == [1]
+    assert orders["commission"].tolist() == [2.0]
+    assert orders["nb_of_fills"].tolist() == [1]
+    assert fills["execId"].tolist() == [execution.execId]
+
+
+def test_late_execution_after_grace(tmp_path):
+    # the fill is archived without its execution after the grace
+    session = Session(str(tmp_path), grace=-1)
+    session.place(1)
+    session.status(*status(1, FILLED, 20000.0))
+    assert session.journal.compact() == 1
+
+    execution = make_execution(1)
+    session.execution(execution)
+    session.commission(make_report(execution, 1.5))
+    assert len(session.store) == 0 and session.store.working() == []
+    session.journal.close()
+
+    orders, fills = load_archive(str(tmp_path))
+    assert orders["orderId"].tolist() == [1]
+    assert orders["nb_of_fills"].tolist() == [1]
+    assert orders["commission"].tolist() == [1.5]
+    assert fills["execId"].tolist() == [execution.execId]
+    assert fills["commission"].tolist() == [1.5]
+
+
+def test_late_status_moves_the_archived_fill_forward(tmp_path):
+    session = Session(str(tmp_path), grace=-1)
+    session.place(1)
+    session.status(*status(1, "Cancelled", 5000.0))
+    session.journal.compact()
+    session.status(*status(1, FILLED, 20000.0))
+    session.status(*status(1, SUBMITTED, 0.0))
+    session.journal.close()
+    orders, _ = load_archive(str(tmp_path))
+    assert orders["status"].tolist() == [FILLED]
+    assert orders["filled"].tolist() == [20000.0]
+
+
+def test_archived_orders_stay_archived_after_a_reload(tmp_path):
+    session = Session(str(tmp_path))
+    session.place(1)
+    execution = session.fill(1)
+    session.journal.close()
+
+    session = Session(str(tmp_path))
+    session.status(*status(1, FILLED, 20000.0))
+    session.commission(make_report(execution))
+    assert len(session.store) == 0
+    session.journal.close()
+    orders, fills = load_archive(str(tmp_path))
+    assert orders["orderId"].tolist() == [1]
+    assert fills["commission"].tolist() == [2.0]
+
+
+def test_waiting_commissions_wait_for_their_execution(tmp_path):
+    session = Session(str(tmp_path))
+    session.place(1)
+    execution = make_execution(1)
+    session.commission(make_report(execution))
+    session.journal.compact()
+    assert session.store.get_waiting_commissions() != []
+    session.journal.close()
+
+    # the commission is still waiting after a reload
+    session = Session(str(tmp_path))
+    session.status(*status(1, FILLED, 20000.0))
+    session.execution(execution)
+    assert session.store.get(1).commission == 2.0
+    assert session.journal.compact() == 1
+    session.journal.close()
+    orders, fills = load_archive(str(tmp_path))
+    assert orders["commission"].tolist() == [2.0]
+
+
+def test_reload_rebuilds_the_working_orders(tmp_path):
+    session = Session(str(tmp_path))
+    for orderId in range(1, 6):
+        session.place(orderId)
+    session.fill(2)
+    session.status(*status(3, SUBMITTED, 5000.0))
+    # a crash : the last record is cut
+    session.journal._file.write(b"\x00" * 7)
+    session.journal._file.close()
+    session.journal._file = None
+
+    reloaded = Session(str(tmp_path)).store
+    assert sorted(reloaded) == [1, 3, 4, 5]
+    assert reloaded.get(3).filled == 5000.0
+    assert reloaded.get(4).order.lmtPrice == 1.1
+    orders, _ = load_archive(str(tmp_path))
+    assert orders["orderId"].tolist() == [2]
+
+
+def test_crash_between_the_archive_and_the_journal(tmp_path):
+    session = Session(str(tmp_path))
+    session.place(1)
+    session.place(2)
+    execution = session.fill(1)
+    path = os.path.join(str(tmp_path), journal_name)
+    with open(path, "rb") as file:
+        journal = file.read()
+    session.journal.compact()
+    session.journal._file.close()
+    with open(path, "wb") as file:
+        file.write(journal)
+
+    session = Session(str(tmp_path))
+    assert sorted(session.store) == [2]
+    session.status(*status(1, FILLED, 20000.0))
+    session.commission(make_report(execution))
+    assert sorted(session.store) == [2]
+    session.journal.close()
+    orders, fills = load_archive(str(tmp_path))
+    assert orders["orderId"].tolist() == [1]
+    np.testing.assert_array_equal(fills["commission"], [2.0])
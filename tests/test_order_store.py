@@ -0,0 +1,167 @@
+import threading
+
+from ibapi.commission_report import CommissionReport
+from ibapi.execution import Execution
+from ibapi.order import Order
+
+from order_store import CANCELLED, FILLED, PLACED, SUBMITTED, OrderStore
+
+
+def make_order(orderId, parentId=0):
+    order = Order()
+    order.orderId, order.permId, order.parentId = orderId, 1000 + orderId, \
+        parentId
+    return order
+
+
+def make_execution(orderId, number=1, shares=10000.0):
+    execution = Execution()
+    execution.orderId, execution.permId = orderId, 1000 + orderId
+    execution.execId = f"0001f4e8.{orderId}.{number:02d}.01"
+    execution.shares = shares
+    return execution
+
+
+def make_report(execution, commission=2.0):
+    report = CommissionReport()
+    report.execId, report.commission = execution.execId, commission
+    return report
+
+
+def status(orderId, status, filled, remaining, parentId=0):
+    return (orderId, status, filled, remaining, 1.1, 1000 + orderId,
+            parentId, 1.1, 0, "", 0.0)
+
+
+def test_records_are_indexed():
+    store = OrderStore()
+    parent = store.add(1, None, make_order(1))
+    child = store.add(2, None, make_order(2, parentId=1))
+    store.update_status(*status(2, SUBMITTED, 0.0, 10000.0, parentId=1))
+    execution = make_execution(1)
+    store.add_execution(execution)
+
+    assert store.get(1) is parent and 1 in store and len(store) == 2
+    assert store.get_by_permId(1002) is child
+    assert store.get_by_execId(execution.execId) is parent
+    assert store.children(1) == [child]
+    assert store.with_status(SUBMITTED) == [child]
+    assert store.with_status(PLACED) == [parent]
+    assert sorted(r.orderId for r in store.working()) == [1, 2]
+
+
+def test_executions_are_created_with_the_first_fill():
+    store = OrderStore()
+    record = store.add(1, None, make_order(1))
+    assert record.executions == None and record.commissions == None
+    assert record.commission == 0.0
+    execution = make_execution(1)
+    store.add_execution(execution)
+    store.add_commission(make_report(execution))
+    assert list(record.executions) == [execution.execId]
+    assert record.commission == 2.0
+
+
+def test_callbacks_in_any_order():
+    store = OrderStore()
+    execution = make_execution(7)
+    # the commission report before its execution, for an order of another
+    # session
+    assert store.add_commission(make_report(execution, 1.5)) == None
+    store.update_status(*status(7, FILLED, 10000.0, 0.0))
+    record = store.add_execution(execution)
+    assert record.orderId == 7 and record.status == FILLED
+    assert record.commission == 1.5
+    assert store.pop_waiting_commissions() == []
+
+
+def test_late_status_keeps_the_order_finished():
+    store = OrderStore()
+    store.add(3, None, make_order(3))
+    store.update_status(*status(3, SUBMITTED, 0.0, 10000.0))
+    store.update_status(*status(3, FILLED, 10000.0, 0.0))
+    record = store.update_status(*status(3, SUBMITTED, 0.0, 10000.0))
+    assert record.status == FILLED and record.filled == 10000.0
+    assert store.working() == []
+    # a cancel after a partial fill moves the fill forward
+    store.add(4, None, make_order(4))
+    store.update_status(*status(4, CANCELLED, 0.0, 10000.0))
+    record = store.update_status(*status(4, SUBMITTED, 5000.0, 5000.0))
+    assert record.status == CANCELLED and record.filled == 5000.0
+
+
+def test_remove_forgets_the_indexes():
+    store = OrderStore()
+    store.add(1, None, make_order(1))
+    store.add(2, None, make_order(2, parentId=1))
+    execution = make_execution(2)
+    store.add_execution(execution)
+    store.remove(2)
+    assert store.get(2) == None and store.get_by_permId(1002) == None
+    assert store.get_by_execId(execution.execId) == None
+    assert store.children(1) == []
+    store.remove(2)
+
+
+def test_clear_keeps_the_lock():
+    store = OrderStore()
+    lock = store._lock
+    store.add(1, None, make_order(1))
+    store.add_commission(make_report(make_execution(5)))
+    store.clear()
+    assert store._lock is lock
+    assert len(store) == 0 and store.working() == []
+    assert store.pop_waiting_commissions() == []
+
+
+def test_callbacks_from_several_threads():
+    store = OrderStore()
+
+    def fill(first):
+        for orderId in range(first, first + 500):
+            store.add(orderId, None, make_order(orderId))
+            execution = make_execution(orderId)
+            store.add_commission(make_report(execution))
+            store.update_status(*status(orderId, FILLED, 10000.0, 0.0))
+            store.add_execution(execution)
+
+    threads = [threading.Thread(target=fill, args=(i * 500,))
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(store) == 2000 and store.working() == []
+    assert all(store.get(i).commission == 2.0 for i in store)
+
+
+def test_archived_orders_get_late_events():
+    store = OrderStore()
+    store.add(1, None, make_order(1))
+    store.update_status(*status(1, FILLED, 10000.0, 0.0))
+    execution = make_execution(1)
+    store.add_execution(execution)
+    store.remove(1, archived=True)
+
+    assert store.update_status(*status(1, FILLED, 10000.0, 0.0)) == None
+    assert store.add_execution(make_execution(1, number=2)) == None
+    assert store.add_commission(make_report(execution)) == None
+    assert len(store) == 0
+    assert [name for name, _ in store.pop_late_events()] == [
+        "status", "execution", "commission"]
+    assert store.pop_late_events() == []
+    # a new order placed with the same orderId
+    order = make_order(1)
+    order.permId = 5000
+    store.add(1, None, order)
+    assert store.update_status(1, SUBMITTED, 0.0, 10000.0, 0.0, 5000, 0, 0.0,
+                               0, "", 0.0).status == SUBMITTED
+
+
+def test_waiting_commissions_are_popped_by_age():
+    store = OrderStore()
+    store.add_commission(make_report(make_execution(1)))
+    assert store.pop_waiting_commissions(received_before=0) == []
+    assert len(store.get_waiting_commissions()) == 1
+    assert [r.execId for r in store.pop_waiting_commissions()] == [
+        make_execution(1).execId]
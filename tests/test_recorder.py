@@ -0,0 +1,72 @@
+from decimal import Decimal
+
+import numpy as np
+from ibapi.common import BarData
+from ibapi.order import Order
+
+import contract
+import ib_interface
+import recorder
+import resample
+
+
+def make_bar(i, volume):
+    bar = BarData()
+    bar.date = str(1623965460 + 60 * i)
+    bar.open, bar.high, bar.low, bar.close = 1.1, 1.2, 1.0, 1.1 + i * 1e-4
+    bar.volume, bar.average, bar.barCount = volume, 1.15, 3
+    return bar
+
+
+def record_session(path):
+    """a disconnected IBApi receiving the callbacks of a request and an
+    order, with 5 mins bars derived from the 1 min ones."""
+    ib = ib_interface.IBApi()
+    with recorder.Recorder(path) as journal:
+        journal.attach(ib)
+        ib.market.derive("EUR/USD", "5 mins", "1 min")
+        ib.data_requests.add(1, "EUR/USD", "1 min")
+        ib.reqHistoricalData(1, contract.get_contract("EUR/USD"), "", "1 D",
+                             "1 min", "BID", 0, 2, False, [])
+        for i in range(50):
+            ib.historicalData(1, make_bar(i, Decimal("1234.5")))
+        ib.historicalDataEnd(1, "", "")
+        order = Order()
+        order.action, order.orderType = "BUY", "LMT"
+        order.totalQuantity, order.lmtPrice = 20000, 1.05
+        ib.placeOrder(7, contract.get_contract("EUR/USD"), order)
+    return ib
+
+
+def test_replay_gives_the_same_state(tmp_path):
+    path = str(tmp_path / "session.journal")
+    ib = record_session(path)
+    replayed = ib_interface.IBApi()
+
+    stats = recorder.replay(path, replayed)
+
+    assert stats["by_callback"]["historicalData"][0] == 50
+    np.testing.assert_array_equal(replayed.market.get("EUR/USD", "1 min")
+                                  .view(),
+                                  ib.market.get("EUR/USD", "1 min").view())
+    assert replayed.market.is_derived("EUR/USD", "5 mins")
+    derived = replayed.market.get("EUR/USD", "5 mins").view()
+    np.testing.assert_array_equal(derived, resample.resample(
+        replayed.market.get("EUR/USD", "1 min").view(), "5 mins"))
+    np.testing.assert_array_equal(derived, ib.market.get("EUR/USD", "5 mins")
+                                  .view())
+    record = replayed.orders[7]
+    assert record.contract.symbol == "EUR" and \
+        record.contract.currency == "USD"
+    assert (record.order.action, record.order.lmtPrice,
+            record.order.totalQuantity) == ("BUY", 1.05, 20000)
+
+
+def test_bars_are_recorded_exactly(tmp_path):
+    path = str(tmp_path / "session.journal")
+    record_session(path)
+    bars = [args[1] for _, name, args in recorder.read_journal(path)
+            if name == "historicalData"]
+    expected = make_bar(3, Decimal("1234.5"))
+    assert [getattr(bars[3], name) for name in recorder.BarData.__slots__] \
+        == [getattr(expected, name) for name in recorder.BarData.__slots__]
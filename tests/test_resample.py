@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from bar_store import BarSeries
+from resample import Resampler, check_barsizes, is_derivable, resample
+
+
+@pytest.fixture(scope="module")
+def bars():
+    """2 months of 1 min bars around a daylight saving change, without the
+    weekends."""
+    rng = np.random.default_rng(0)
+    timestamps = 1.613e9 + 60 * np.arange(60 * 1440)
+    weekday = pd.to_datetime(timestamps, unit="s", utc=True) \
+        .tz_convert("America/New_York").shift(7, freq="h").dayofweek
+    timestamps = timestamps[weekday < 5]
+    close = 1.2 + np.cumsum(rng.normal(0, 1e-4, timestamps.shape[0]))
+    open_ = np.concatenate(([close[0]], close[:-1]))
+    return np.column_stack((timestamps, open_,
+                            np.maximum(open_, close) + 5e-5,
+                            np.minimum(open_, close) - 5e-5, close))
+
+
+@pytest.mark.parametrize("barsize, rule", [
+    ("5 mins", "5min"), ("1 hour", "1h"), ("4 hours", "4h"), ("1 day", "1D")])
+def test_resample_matches_pandas(bars, barsize, rule):
+    # shifting the New York time by 7 hours puts the start of the sessions
+    # (17:00) at midnight
+    index = pd.to_datetime(bars[:, 0], unit="s", utc=True) \
+        .tz_convert("America/New_York").shift(7, freq="h")
+    frame = pd.DataFrame(bars[:, 1:], columns=["open", "high", "low", "close"],
+                         index=index.tz_localize(None))
+    expected = frame.resample(rule).agg({
+        "open": "first", "high": "max", "low": "min", "close": "last"}) \
+        .dropna()
+    starts = (expected.index + pd.Timedelta(hours=-7)) \
+        .tz_localize("America/New_York").tz_convert("UTC")
+
+    out = resample(bars, barsize)
+
+    np.testing.assert_array_equal(out[:, 1:], expected.to_numpy())
+    np.testing.assert_array_equal(out[:, 0], starts.as_unit("s").asi8)
+
+
+def test_resampler_updates_match_the_batch(bars):
+    base, derived = BarSeries(), BarSeries()
+    base.extend(bars[:-600])
+    resampler = Resampler(base, derived, "4 hours", "1 min")
+    resampler.update()
+    for bar in bars[-600:]:
+        revision = bar.copy()
+        revision[2] += 1e-3
+        base.upsert(*revision)
+        resampler.update()
+        base.upsert(*bar)
+        resampler.update()
+    np.testing.assert_array_equal(derived.view(), resample(bars, "4 hours"))
+
+
+def test_resampler_keeps_the_older_history(bars):
+    history = resample(bars[:20000], "1 hour")
+    base, derived = BarSeries(), BarSeries()
+    derived.extend(history)
+    base.extend(bars[10000:])
+    Resampler(base, derived, "1 hour", "1 min").update()
+    expected = resample(bars, "1 hour")
+    np.testing.assert_array_equal(derived.view(), expected)
+
+
+def test_barsizes_that_cant_be_derived():
+    with pytest.raises(ValueError):
+        check_barsizes("7 mins", "1 min")
+    with pytest.raises(ValueError):
+        check_barsizes("5 mins", "2 mins")
+    assert is_derivable("1 day", "1 min")
+    assert not is_derivable("1 min", "1 min")
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+import indicators
+from data import market_data as test_data
+from streaming_indicators import streaming_classes
+
+cases = [("sma", (20,)), ("ema", (20,)), ("rsi", (14,)),
+         ("macd", (12, 26, 9)), ("bbands", (20, 2)), ("adx", (14,))]
+
+
+def assert_same(result, expected):
+    np.testing.assert_allclose(result, expected, rtol=1e-7, atol=1e-9,
+                               equal_nan=True)
+
+
+@pytest.mark.parametrize("name, params", cases)
+def test_new_bars_match_the_batch_indicator(name, params):
+    expected = getattr(indicators, name)(test_data, *params)
+    result = streaming_classes[name](*params).run(test_data)
+    assert result.shape == expected.shape
+    assert_same(result, expected)
+
+
+@pytest.mark.parametrize("name, params", cases)
+def test_revised_bars_match_the_batch_indicator(name, params):
+    # every bar is first sent with a random close, then revised
+    rng = np.random.default_rng(0)
+    expected = getattr(indicators, name)(test_data, *params)
+    streaming = streaming_classes[name](*params)
+    out = np.empty_like(expected)
+    for i, bar in enumerate(test_data):
+        revision = bar.copy()
+        revision[4] += rng.normal(0, 1e-3)
+        streaming.update(revision)
+        out[i] = streaming.update(bar)
+    assert_same(out, expected)
+
+
+@pytest.mark.parametrize("name, params", cases)
+def test_warm_start_matches_the_batch_indicator(name, params):
+    expected = getattr(indicators, name)(test_data, *params)
+    half = test_data.shape[0] // 2
+    streaming = streaming_classes[name](*params)
+    streaming.warm_start(test_data[:half],
+                         getattr(indicators, name)(test_data[:half], *params))
+    out = np.concatenate(([streaming.last], streaming.run(test_data[half:])))
+    assert_same(out, expected[half - 1:])
+
+
+def test_long_streams_dont_drift():
+    # the sliding sums are recomputed regularly, the errors don't add up
+    # over a long live session
+    rng = np.random.default_rng(0)
+    close = 1.2 + np.cumsum(rng.normal(0, 1e-4, 200000))
+    data = np.column_stack((60 * np.arange(close.shape[0]), close,
+                            close + 5e-5, close - 5e-5, close))
+    expected = indicators.bbands(data, 20, 2)
+    result = streaming_classes["bbands"](20, 2).run(data)
+    np.testing.assert_allclose(result[:, 2] - result[:, 3],
+                               expected[:, 2] - expected[:, 3], rtol=1e-7,
+                               equal_nan=True)
+    assert_same(result, expected)
@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+import pytest
+
+import backtest
+from sweep import get_key, grid, load_results, sweep
+
+param_grid = {"fast": [5, 10, 20], "slow": [40, 60, 100]}
+run_kwargs = {"size": 10000, "commission": 2e-5}
+
+
+@pytest.fixture(scope="module")
+def data():
+    rng = np.random.default_rng(0)
+    close = 1.2 + np.cumsum(rng.normal(0, 1e-4, 5000))
+    open_ = np.concatenate(([close[0]], close[:-1]))
+    return np.column_stack((1.6e9 + 60 * np.arange(5000), open_,
+                            np.maximum(open_, close) + 5e-5,
+                            np.minimum(open_, close) - 5e-5, close))
+
+
+def run_one_by_one(data, params):
+    signals = backtest.ema_crossover(data, **params)
+    return backtest.run(data, signals, **run_kwargs).stats
+
+
+def test_grid():
+    assert grid(fast=[5, 10], slow=[20]) == [{"fast": 5, "slow": 20},
+                                             {"fast": 10, "slow": 20}]
+
+
+def test_sweep_matches_the_backtests_one_by_one(data):
+    results = list(sweep(data, "ema crossover", param_grid, processes=2,
+                         **run_kwargs))
+    assert sorted(get_key(r["params"]) for r in results) == \
+        sorted(get_key(p) for p in grid(**param_grid))
+    for result in results:
+        assert result["strategy"] == "ema crossover"
+        assert result["stats"] == run_one_by_one(data, result["params"])
+
+
+def test_interrupted_sweep_runs_the_missing_combinations(data, tmp_path):
+    path = os.path.join(str(tmp_path), "sweep.jsonl")
+    results = sweep(data, "ema crossover", param_grid, path, processes=2,
+                    batch_size=1, **run_kwargs)
+    for _ in range(3):
+        next(results)
+    results.close()
+    saved = load_results(path)
+    assert 3 <= len(saved) < 9
+
+    resumed = list(sweep(data, "ema crossover", param_grid, path,
+                         processes=2, **run_kwargs))
+    assert len(resumed) == 9 - len(saved)
+    keys = [get_key(r["params"]) for r in load_results(path)]
+    assert sorted(keys) == sorted(get_key(p) for p in grid(**param_grid))
+    assert list(sweep(data, "ema crossover", param_grid, path)) == []
+
+
+def test_load_results_skips_a_cut_line(tmp_path):
+    path = os.path.join(str(tmp_path), "sweep.jsonl")
+    assert load_results(path) == []
+    with open(path, "w") as file:
+        file.write('{"strategy": "ema crossover", "params": {}, '
+                   '"stats": {}}\n{"strategy": "ema cr')
+    assert len(load_results(path)) == 1
+
+
+def test_unknown_strategy(data):
+    with pytest.raises(KeyError):
+        next(sweep(data, "unknown", param_grid))
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from vectorized_ema import ewma_vectorized_2d_safe, ewma_vectorized_safe
+
+tolerances = {np.float64: 1e-12, np.float32: 1e-5}
+
+
+@pytest.fixture(scope="module")
+def prices():
+    rng = np.random.default_rng(0)
+    return 1.2 + np.cumsum(rng.normal(0, 1e-4, 200000))
+
+
+@pytest.mark.parametrize("dtype", list(tolerances))
+@pytest.mark.parametrize("window", [2, 20, 200, 2000, 5000])
+def test_matches_the_recursive_formula(prices, window, dtype):
+    alpha = 2 / (window + 1)
+    expected = pd.Series(prices).ewm(alpha=alpha, adjust=False).mean()
+    out = ewma_vectorized_safe(prices.astype(dtype), alpha)
+    assert out.dtype == dtype
+    np.testing.assert_allclose(out, expected.to_numpy(),
+                               rtol=tolerances[dtype])
+
+
+def test_seed_window_and_nan(prices):
+    out = ewma_vectorized_safe(prices[:1000], 0.1, seed_window=20)
+    assert np.isnan(out[:19]).all()
+    assert out[19] == pytest.approx(prices[:20].mean(), rel=1e-15)
+    data = prices[:1000].copy()
+    data[500] = np.nan
+    out = ewma_vectorized_safe(data, 0.1)
+    assert np.isnan(out[500:]).all() and not np.isnan(out[:500]).any()
+
+
+@pytest.mark.parametrize("dtype", list(tolerances))
+def test_rows_with_their_own_alpha(prices, dtype):
+    windows = np.array([2, 200, 5000])
+    alphas = 2 / (windows + 1)
+    data = np.tile(prices[:50000], (3, 1)).astype(dtype)
+    out = ewma_vectorized_2d_safe(data, alphas)
+    for row, alpha in zip(out, alphas):
+        expected = pd.Series(prices[:50000]).ewm(alpha=alpha,
+                                                 adjust=False).mean()
+        np.testing.assert_allclose(row, expected.to_numpy(),
+                                   rtol=tolerances[dtype])